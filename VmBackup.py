@@ -66,6 +66,9 @@
 # => To accomplish the vm backup this script uses the following xe commands
 #   vm-export:  (a) vm-snapshot, (b) template-param-set, (c) vm-export, (d) vm-uninstall on vm-snapshot
 #   vdi-export: (a) vdi-snapshot, (b) vdi-param-set, (c) vdi-export, (d) vdi-destroy on vdi-snapshot
+#   note - (a), (b) and (d) are done with the equivalent XenAPI calls
+#   (VM.snapshot, VM.set_is_a_template, VM.destroy, VDI.snapshot,
+#   VDI.set_name_label, VDI.destroy) on the existing xapi session
 
 # See README for usage and installation documentation.
 # See example.cfg for config file example usage.
@@ -76,7 +79,18 @@
 # Usage w/ config file for multiple vm backups, where you can specify either vm-export or vdi-export:
 #    ./VmBackup.py <password> <config-file-path>
 
-import sys, time, os, datetime, subprocess, re, shutil, XenAPI, smtplib, re, base64, socket, threading, ssl
+import sys, time, os, datetime, subprocess, re, shutil, XenAPI, smtplib, re, base64, socket, threading, ssl, traceback
+import urllib, urllib2, zlib, multiprocessing, collections, hashlib, signal, errno, json, csv, BaseHTTPServer
+import tempfile, gzip, mmap, xmlrpclib, httplib, urlparse, tarfile, StringIO, struct, functools
+# optional compress_codec modules - not part of the XenServer dom0 python
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
 from email.MIMEText import MIMEText
 from subprocess import PIPE
 from subprocess import STDOUT
@@ -92,6 +106,71 @@ DEFAULT_BACKUP_DIR = '/snapshots/BACKUPS'
 # note - some NAS file servers may fail with ':', so change to your desired format
 BACKUP_DIR_PATTERN = '%s/backup-%04d-%02d-%02d-(%02d:%02d:%02d)'
 DEFAULT_STATUS_LOG = '/snapshots/NAUbackup/status.log'
+DEFAULT_MAX_PARALLEL = 1 # number of vm backups that may run at the same time
+DEFAULT_MAX_PER_SR = 0   # max concurrent exports reading from one SR (0 = no limit)
+DEFAULT_MAX_PER_HOST = 0 # max concurrent exports of vms resident on one host (0 = no limit)
+DEFAULT_ORDER = 'config' # vm backup order: 'config', 'size' or 'history'
+DEFAULT_EXPORT_METHOD = 'xe' # 'xe' runs xe vm-export/vdi-export, 'http' streams the xapi export in VmBackup
+DEFAULT_EXPORT_CHUNK_SIZE = 1024 # KB read and written per chunk by export_method=http
+EXPORT_PROGRESS_SECS = 60 # export_method=http logs progress this often
+DEFAULT_COMPRESS_CODEC = 'none' # export_method=http compression in VmBackup: 'none', 'gzip', 'zstd' or 'lz4'
+DEFAULT_COMPRESS_PROCS = 0 # compress_codec processes, 0 = one per cpu
+COMPRESS_BLOCK_SIZE = 4 * 1024 * 1024 # compress_codec compresses the export stream in blocks of this size
+COMPRESS_SUFFIX = {'gzip': '.gz', 'zstd': '.zst', 'lz4': '.lz4'}
+COMPRESS_DEFAULT_LEVEL = {'gzip': 6, 'zstd': 3, 'lz4': 0}
+DEFAULT_BACKUP_STORE = 'file' # 'file' = one export file per backup, 'chunks' = deduplicated chunk store
+CHUNKSTORE_DIR = '.chunkstore' # backup_store=chunks: chunk files below backup_dir/CHUNKSTORE_DIR
+# backup_store=chunks content defined chunking: a chunk may end at any
+# 512 byte sector boundary where the crc32 of the last 64 bytes has the
+# low CHUNK_MASK bits clear, so chunks average ~CHUNK_MIN_SIZE + 1MB
+CHUNK_MIN_SIZE = 256 * 1024
+CHUNK_MAX_SIZE = 4 * 1024 * 1024
+CHUNK_MASK = 0x7ff
+DEFAULT_VDI_EXPORT_CBT = 'false' # vdi-export only the blocks changed since the last backup (XenServer 7.3+)
+DEFAULT_CBT_FULL_EVERY = 7 # vdi_export_cbt: every Nth backup is a full backup
+CBT_BLOCK_SIZE = 64 * 1024 # VDI.list_changed_blocks: one bit per 64KB block
+CBT_NBD_READ_SIZE = 4 * 1024 * 1024 # vdi_export_cbt: largest NBD read of a run of changed blocks
+XAPI_CACHE_CLASSES = ['VM', 'VBD', 'VDI', 'SR', 'VIF', 'network', 'host', 'pool'] # prefetched by XapiCache
+DEFAULT_XAPI_EVENTS = 'false' # keep XapiCache current with event.from during the run
+XAPI_EVENT_CLASSES = ['VM', 'VBD', 'VDI', 'SR'] # xapi_events: classes watched with event.from
+VM_ATTRIBUTE_SELECTORS = ['tag', 'sr', 'pool-host', 'other_config'] # vm-selector attribute:value, see vm_record_matches
+XAPI_EVENT_TIMEOUT = 10.0 # xapi_events: seconds one event.from call waits for events
+DEFAULT_RPO = 24 # daemon: hours between the backups of a vm
+DEFAULT_START_TIME = '00:00' # daemon: new backups only start between start_time and stop_time
+DEFAULT_STOP_TIME = '24:00'
+DAEMON_TICK_SECS = 60 # daemon: check for due vms at least this often
+DAEMON_SELECT_SECS = 600 # daemon: re-expand the vm selection of the config file this often
+DAEMON_RETRY_SECS = 3600 # daemon: wait this long before retrying a failed vm backup
+DEFAULT_SHARD_BY_HOST = 'false' # back up only the vms resident on this pool member, see ShardLeases
+SHARD_LEASE_DIR = '.leases' # shard_by_host: one lease file per vm being backed up, below backup_dir
+SHARD_LEASE_HEARTBEAT_SECS = 60 # shard_by_host: renew the held leases this often
+SHARD_LEASE_STALE_SECS = 600 # shard_by_host: a lease not renewed this long belongs to a dead worker
+DEFAULT_VDI_EXPORT_SPARSE = 'true' # raw vdi-export with export_method=http: skip zero blocks, the file is sparse
+SPARSE_BLOCK_SIZE = 64 * 1024
+SPARSE_ZERO_BLOCK = '\0' * SPARSE_BLOCK_SIZE
+DEFAULT_ADAPTIVE_PARALLEL = 'false' # true - find the best number of concurrent exports up to max_parallel
+ADAPTIVE_SAMPLE_SECS = 30 # adaptive_parallel: sample throughput, storage latency and dom0 load this often
+ADAPTIVE_MIN_GAIN = 0.05 # adaptive_parallel: keep an added export only if it raised the throughput by 5%
+ADAPTIVE_HOLD_SAMPLES = 4 # adaptive_parallel: samples to wait after a decrease before probing again
+ADAPTIVE_LATENCY_FACTOR = 4 # adaptive_parallel: storage is congested at 4x the best write latency seen ...
+ADAPTIVE_LATENCY_MIN_MS = 50 # ... and at least 50ms
+ADAPTIVE_LOAD_FACTOR = 1.0 # adaptive_parallel: dom0 is overloaded at a 1 minute load average over cpus * 1.0
+DEFAULT_RUN_REPORT = 'none' # none, json and/or csv - per phase timings beside the status_log
+RUN_REPORT_PHASES = ['lookup', 'metadata', 'snapshot', 'param_set', 'export', 'snapshot_removal', 'cleanup']
+DEFAULT_METRICS_PORT = '0' # [address:]port serving prometheus metrics on /metrics, 0 - off
+DEFAULT_METRICS_TEXTFILE = '' # node_exporter textfile collector file for the metrics, '' - off
+METRICS_TEXTFILE_SECS = 15 # rewrite metrics_textfile this often
+DEFAULT_THROTTLE_MBPS = 0 # MB/s cap of all exports together, 0 - unlimited
+DEFAULT_THROTTLE_MBPS_JOB = 0 # MB/s cap of each vm backup, 0 - unlimited
+DEFAULT_RESUME_WINDOW = 0 # hours a failed raw vdi-export may be resumed on the next run, 0 - always start over
+RESUME_SEGMENT_SIZE = 64 * 1024 * 1024 # resume_window: raw exports are checkpointed every 64MB
+DEFAULT_CHECKSUM = 'none' # none or sha256 - hash each export while it is written, see HashWriter
+CHECKSUM_SUFFIX = '.sha256' # checksum: sidecar beside the backup file, in sha256sum format
+DEFAULT_VERIFY_PARALLEL = 2 # verify=: backup files re-hashed at the same time
+VERIFY_READ_SIZE = 1024 * 1024 # verify= and validate-xva=: read size
+DEFAULT_XVA_VALIDATE = 'false' # true - a vm-export is only successful if its xva is complete, see XvaValidator
+XVA_CHUNK_SIZE = 1024 * 1024 # xva: disk data is stored in Ref:<vdi>/<chunk> members of 1MB
+DEFAULT_RESTORE_PARALLEL = 4 # restore=: vms imported at the same time
 
 ############################# OPTIONAL
 # optional email may be triggered by configure next 3 parameters then find MAIL_ENABLE and uncommenting out the desired lines
@@ -102,16 +181,36 @@ MAIL_SMTP_SERVER = 'your-mail-server'
 
 config = {}
 all_vms = []
-expected_keys = ['pool_db_backup', 'max_backups', 'backup_dir', 'status_log', 'vdi_export_format', 'vm-export', 'vdi-export', 'exclude']
+vm_selectors = {} # selector -> compiled regex, None for a plain vm name, see get_selector_pattern
+# vdi-export=vm-name:disks=xvda,xvdb - devices to export per vm name, all disks if not present
+vdi_export_disks = {}
+expected_keys = ['pool_db_backup', 'max_backups', 'backup_dir', 'status_log', 'vdi_export_format', 'max_parallel', 'max_per_sr', 'max_per_host', 'adaptive_parallel', 'order', 'export_method', 'export_chunk_size', 'compress_codec', 'compress_level', 'compress_procs', 'backup_store', 'vdi_export_cbt', 'cbt_full_every', 'vdi_export_sparse', 'resume_window', 'checksum', 'xva_validate', 'throttle_mbps', 'throttle_mbps_job', 'throttle_window', 'run_report', 'metrics_port', 'metrics_textfile', 'xapi_events', 'rpo', 'vm-rpo', 'start_time', 'stop_time', 'blackout', 'shard_by_host', 'vm-export', 'vdi-export', 'exclude']
 message = ''
 xe_path = '/opt/xensource/bin' 
+xapi_url = 'http://localhost/'
+compress_pool = None
+compress_pool_size = 0
+chunkstore_gc_needed = False
+run_begin_time = time.time()
+daemon_stopping = False
+shard_host = None # shard_by_host: name-label of the pool member this worker backs up for
+shard_leases = None # shard_by_host: ShardLeases of this worker during main/daemon_main
+global_throttle = None # throttle_mbps/throttle_window: TokenBucket shared by all exports
+concurrency_controller = None # adaptive_parallel: ConcurrencyController during main/daemon_main
+metrics_exporter = None # metrics_port/metrics_textfile: MetricsExporter during main/daemon_main
+running_reports = {} # vm_name -> job_report of the vm backups running now, see new_job_report
+status_cnt = {'success': 0, 'warning': 0, 'error': 0}
+# locks for state shared by the max_parallel worker threads
+status_lock = threading.Lock()
+status_log_lock = threading.Lock()
+report_lock = threading.Lock()
+log_lock = threading.RLock()
+# per worker thread: xapi session and vm_name being processed
+thread_data = threading.local()
+xapi_cache = None
 
 def main(session): 
 
-    success_cnt = 0
-    warning_cnt = 0
-    error_cnt = 0 
-
     #setting autoflush on (aka unbuffered)
     sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
     
@@ -143,382 +242,1472 @@ def main(session):
     if int(config['pool_db_backup']):
         log('*** begin backup_pool_metadata ***')
         if not backup_pool_metadata(server_name):
-            error_cnt += 1 
+            count_status('error')
 
     ######################################################################
-    # Iterate through all vdi-export= in cfg
-    log('************ vdi-export= ***************')
+    # Iterate through all vdi-export= and then all vm-export= in cfg
+    # note - with max_parallel=1 the vms are processed one at a time in
+    #   config order, otherwise by a pool of max_parallel worker threads
+    jobs = []
     for vm_parm in config['vdi-export']:
-        log('*** vdi-export begin %s' % vm_parm)
-        beginTime = datetime.datetime.now()
-        this_status = 'success'
+        jobs.append(new_backup_job('vdi-export', vm_parm))
+    for vm_parm in config['vm-export']:
+        jobs.append(new_backup_job('vm-export', vm_parm))
+    log('************ vdi-export= (cnt) %s vm-export= (cnt) %s max_parallel=%s ***************' \
+        % (len(config['vdi-export']), len(config['vm-export']), config['max_parallel']))
+    if int(config['max_per_sr']) > 0 or int(config['max_per_host']) > 0 or config['order'] == 'size':
+        log('*** placement of vms - max_per_sr=%s max_per_host=%s' % (config['max_per_sr'], config['max_per_host']))
+        for job in jobs:
+            set_job_placement(job)
+    if config['order'] != 'config':
+        jobs = order_backup_jobs(jobs, config['order'])
+    if config['shard_by_host'] == 'true':
+        jobs = [job for job in jobs if is_shard_vm(job['vm_name'])]
+        log('*** shard_by_host - %s vms on %s' % (len(jobs), shard_host))
+        start_shard_leases(server_name)
+    if config['compress_codec'] != 'none':
+        # note - the pool is started before any worker threads exist
+        start_compress_pool()
+    start_throttle()
+    if config['xapi_events'] == 'true':
+        xapi_cache.start_watch()
+    try:
+        run_backup_jobs(server_name, jobs, int(config['max_parallel']))
+    finally:
+        xapi_cache.stop_watch()
+        stop_compress_pool()
+        stop_shard_leases()
+
+    if chunkstore_gc_needed:
+        log('===========================')
+        chunkstore_gc()
+    ######################################################################
 
-        # get values from vdi-export=
-        vm_name = get_vm_name(vm_parm)
-        vm_max_backups = get_vm_max_backups(vm_parm)
-        log('vdi-export - vm_name: %s max_backups: %s' % (vm_name, vm_max_backups))
+    log('===========================')
+    df_snapshots('Space status: df -Th %s' % config['backup_dir'])
+    log_run_summary(server_name)
 
-        if config_specified:
-            status_log_vdi_export_begin(server_name, '%s' % vm_name)
+    # done with main()
+    ######################################################################
 
-        # verify vm_name exists with only one instance for this name
-        #  returns error-message or vm_object if success
-        vm_object = verify_vm_name(vm_name)
-        if 'ERROR' in vm_object:
-            log('verify_vm_name: %s' % vm_object)
-            if config_specified:
-                status_log_vdi_export_end(server_name, 'ERROR verify_vm_name %s' % vm_name)
-            error_cnt += 1
-            # next vm
-            continue
+def log_run_summary(server_name):
+    # gather a final VmBackup.py status
+    success_cnt = status_cnt['success']
+    warning_cnt = status_cnt['warning']
+    error_cnt = status_cnt['error']
+    summary = 'S:%s W:%s E:%s' % (success_cnt, warning_cnt, error_cnt)
+    status_log = config['status_log']
+    if (error_cnt > 0):
+        if config_specified:
+            status_log_end(server_name, 'ERROR,%s' % summary)
+            # MAIL_ENABLE: optional email may be enabled by uncommenting out the next two lines
+            #send_email(MAIL_TO_ADDR, 'ERROR ' + os.uname()[1] + ' VmBackup.py', status_log)
+            #open('%s' % status_log, 'w').close() # trunc status log after email
+        log('VmBackup ended - **ERRORS DETECTED** - %s' % summary)
+    elif (warning_cnt > 0):
+        if config_specified:
+            status_log_end(server_name, 'WARNING,%s' % summary)
+            # MAIL_ENABLE: optional email may be enabled by uncommenting out the next two lines
+            #send_email(MAIL_TO_ADDR,'WARNING ' + os.uname()[1] + ' VmBackup.py', status_log)
+            #open('%s' % status_log, 'w').close() # trunc status log after email
+        log('VmBackup ended - **WARNING(s)** - %s' % summary)
+    else:
+        if config_specified:
+            status_log_end(server_name, 'SUCCESS,%s' % summary)
+            # MAIL_ENABLE: optional email may be enabled by uncommenting out the next two lines
+            #send_email(MAIL_TO_ADDR, 'Success ' + os.uname()[1] + ' VmBackup.py', status_log)
+            #open('%s' % status_log, 'w').close() # trunc status log after email
+        log('VmBackup ended - Success - %s' % summary)
 
-        vm_backup_dir = os.path.join(config['backup_dir'], vm_name) 
-        # cleanup any old unsuccessful backups and create new full_backup_dir
-        full_backup_dir = process_backup_dir(vm_backup_dir)
-
-        # gather_vm_meta produces status: empty or warning-message 
-        #   and globals: vm_uuid, xvda_uuid, xvda_uuid
-        #   => now only need: vm_uuid
-        #   since all VM metadta go into an XML file
-        vm_meta_status = gather_vm_meta(vm_object, full_backup_dir)
-        if vm_meta_status != '':
-            log('WARNING gather_vm_meta: %s' % vm_meta_status)
-            this_status = 'warning'
-            # non-fatal - finsh processing for this vm
+def daemon_main(tmp_cfg_file):
+    # daemon=true: instead of one pass over all vms, keep the xapi session and
+    # the event-driven xapi_cache warm and start the backup of each vm whenever
+    # it is due by its rpo, as max_parallel/max_per_sr/max_per_host slots free up.
+    # New backups only start between start_time and stop_time and outside of
+    # any blackout window. Runs until SIGTERM or ctrl-c, then waits for the
+    # running backups and writes the usual summary.
+    global chunkstore_gc_needed
+    global run_begin_time
+    global message
+    sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
+    server_name = os.uname()[1].split('.')[0]
+    status_log_begin(server_name)
+    log('===========================')
+    log('VmBackup daemon running on %s ...' % server_name)
+    signal.signal(signal.SIGTERM, daemon_stop)
+
+    scheduler = BackupScheduler([], int(config['max_per_sr']), int(config['max_per_host']))
+    use_placement = int(config['max_per_sr']) > 0 or int(config['max_per_host']) > 0
+    running = {}
+    last_try = {}
+    done = threading.Condition()
+
+    def worker(job):
+        thread_data.vm_name = job['vm_name']
+        thread_data.session = None
+        try:
+            try:
+                thread_data.session = xapi_login()
+            except Exception, e:
+                # e.g. the pool master restarts - the vm is retried after DAEMON_RETRY_SECS
+                log('ERROR xapi login for %s %s - %s' % (job['export_type'], job['vm_parm'], e))
+                count_status('error')
+                return
+            run_backup_job(server_name, job)
+        finally:
+            if thread_data.session is not None:
+                xapi_logout(thread_data.session)
+                thread_data.session = None
+            scheduler.job_done(job)
+            done.acquire()
+            try:
+                del running[job['vm_name']]
+                done.notifyAll()
+            finally:
+                done.release()
+
+    if config['compress_codec'] != 'none':
+        start_compress_pool()
+    start_throttle()
+    if config['shard_by_host'] == 'true':
+        start_shard_leases(server_name)
+    start_concurrency_controller(scheduler, int(config['max_parallel']))
+    start_metrics(scheduler)
+    xapi_cache.start_watch()
+    last_select = 0
+    try:
+        while not daemon_stopping:
+            now = time.time()
+            if now - last_select >= DAEMON_SELECT_SECS:
+                daemon_select_vms(tmp_cfg_file)
+                last_select = now
+                # the log is only kept for send_email, do not let it grow forever
+                log_lock.acquire()
+                try:
+                    message = ''
+                finally:
+                    log_lock.release()
+            done.acquire()
+            try:
+                if len(running) == 0 and chunkstore_gc_needed:
+                    # no export is writing chunks now, so everything may be collected
+                    run_begin_time = now
+                    chunkstore_gc_needed = False
+                    chunkstore_gc()
+                if is_daemon_window_open(now):
+                    due = []
+                    for (export_type, vm_parm) in [('vdi-export', x) for x in config['vdi-export']] + [('vm-export', x) for x in config['vm-export']]:
+                        vm_name = get_vm_name(vm_parm)
+                        if vm_name in running:
+                            continue
+                        if config['shard_by_host'] == 'true' and not is_shard_vm(vm_name):
+                            continue
+                        last_backup = get_last_backup_time(vm_name)
+                        if last_try.get(vm_name, 0) > last_backup and now - last_try[vm_name] < DAEMON_RETRY_SECS:
+                            # the last try failed, do not retry at once
+                            continue
+                        if now - last_backup >= get_vm_rpo(vm_name) * 3600:
+                            job = new_backup_job(export_type, vm_parm)
+                            if use_placement:
+                                set_job_placement(job, False)
+                            due.append((last_backup, job))
+                    # most overdue first
+                    due.sort(key=lambda x: x[0])
+                    scheduler.set_pending([job for (last_backup, job) in due])
+                    while len(running) < int(config['max_parallel']):
+                        job = scheduler.next_job(False)
+                        if job is None:
+                            break
+                        log('daemon: %s %s is due (rpo %sh)' % (job['export_type'], job['vm_name'], get_vm_rpo(job['vm_name'])))
+                        running[job['vm_name']] = job
+                        last_try[job['vm_name']] = now
+                        t = threading.Thread(target=worker, args=(job,), name='daemon-%s' % job['vm_name'])
+                        t.setDaemon(True)
+                        t.start()
+                # woken up early when a backup finishes
+                done.wait(DAEMON_TICK_SECS)
+            finally:
+                done.release()
+    except KeyboardInterrupt:
+        log('daemon: interrupted')
+    log('daemon: stopping - waiting for %s running backups' % len(running))
+    while len(running) > 0:
+        time.sleep(1)
+    stop_metrics()
+    stop_concurrency_controller()
+    xapi_cache.stop_watch()
+    stop_compress_pool()
+    stop_shard_leases()
+    if chunkstore_gc_needed:
+        chunkstore_gc()
+    log_run_summary(server_name)
+
+def daemon_stop(signum, frame):
+    global daemon_stopping
+    daemon_stopping = True
+
+def daemon_select_vms(tmp_cfg_file):
+    # daemon: re-expand the vm-export/vdi-export/exclude selectors of the
+    # config file against the vms of the (event-driven) xapi_cache, so that new,
+    # renamed or removed vms are picked up without a restart
+    # note - the other config keys are only loaded at daemon start
+    global vdi_export_disks
+    set_all_vms(get_pool_vms())
+    config['vm-export'] = []
+    config['vdi-export'] = []
+    config['exclude'] = []
+    # a new dict, not clear() - running backups may be reading the old one
+    vdi_export_disks = {}
+    save_to_config_selectors([(key, value) for (key, value) in config_lines(tmp_cfg_file)
+        if key in ['exclude', 'vm-export', 'vdi-export']])
+    cleanup_vmexport_vdiexport_dups()
+    log('daemon: vdi-export= (cnt) %s vm-export= (cnt) %s' % (len(config['vdi-export']), len(config['vm-export'])))
+
+def get_vm_rpo(vm_name):
+    # hours between backups of vm_name: the first matching vm-rpo=vm-selector:hours, else rpo
+    for vm_rpo in config['vm-rpo']:
+        (vm_selector, hours) = vm_rpo.rsplit(':', 1)
+        if vm_matches(vm_selector, vm_name):
+            return float(hours)
+    return float(config['rpo'])
+
+def get_last_backup_time(vm_name):
+    # time of the newest successful backup of vm_name, 0 if none
+    vm_backup_dir = os.path.join(config['backup_dir'], vm_name)
+    if not os.path.isdir(vm_backup_dir):
+        return 0
+    dirs = os.listdir(vm_backup_dir)
+    dirs.sort()
+    for dir in reversed(dirs):
+        for marker in ['success', 'success_compress']:
+            if os.path.exists(os.path.join(vm_backup_dir, dir, marker)):
+                return os.path.getmtime(os.path.join(vm_backup_dir, dir, marker))
+    return 0
+
+def time_of_day_minutes(tmp_hhmm):
+    (hours, minutes) = tmp_hhmm.split(':')
+    return int(hours) * 60 + int(minutes)
+
+def is_time_in_window(tmp_minutes, tmp_window_start, tmp_window_end):
+    # note - a window with its end before its start wraps over midnight
+    begin = time_of_day_minutes(tmp_window_start)
+    end = time_of_day_minutes(tmp_window_end)
+    if begin <= end:
+        return begin <= tmp_minutes < end
+    return tmp_minutes >= begin or tmp_minutes < end
+
+def is_daemon_window_open(tmp_now):
+    # may a new backup start now - between start_time and stop_time and not in a blackout
+    local = time.localtime(tmp_now)
+    minutes = local.tm_hour * 60 + local.tm_min
+    if not is_time_in_window(minutes, config['start_time'], config['stop_time']):
+        return False
+    for blackout in config['blackout']:
+        (blackout_start, blackout_end) = blackout.split('-')
+        if is_time_in_window(minutes, blackout_start, blackout_end):
+            return False
+    return True
 
-        # vdi-export only uses xvda_uuid, xvda_uuid
-        if xvda_uuid == '':
-            log('ERROR gather_vm_meta has no xvda-uuid')
-            if config_specified:
-                status_log_vdi_export_end(server_name, 'ERROR xvda-uuid not found %s' % vm_name)
-            error_cnt += 1
-            # next vm
+def count_status(tmp_status):
+    # tally one vm result - 'success', 'warning' or 'error'
+    # note - called from the worker threads, so guard the shared counters
+    status_lock.acquire()
+    try:
+        status_cnt[tmp_status] += 1
+    finally:
+        status_lock.release()
+
+def new_backup_job(export_type, vm_parm):
+    # one unit of work for run_backup_jobs
+    #   host - uuid of the host the vm is resident on ('' if not running)
+    #   srs  - uuids of the SRs that the export reads from
+    #   size - estimated bytes the export has to read
+    #   last_backup - shard_by_host: time of the last successful backup when the job was made
+    job = {'export_type': export_type, 'vm_parm': vm_parm, 'vm_name': get_vm_name(vm_parm),
+            'host': '', 'srs': [], 'size': 0}
+    if config['shard_by_host'] == 'true':
+        job['last_backup'] = get_last_backup_time(job['vm_name'])
+    return job
+
+def set_job_placement(job, tmp_log=True):
+    # find the resident host, the SRs and the size of the disks this job will export
+    # note - vdi-export only reads the disks= subset if given, vm-export reads all disks
+    #   a raw vdi-export streams the whole virtual_size, otherwise only
+    #   the allocated physical_utilisation is exported
+    job['host'] = ''
+    job['srs'] = []
+    job['size'] = 0
+    vm_refs = [x for x in xapi_cache.get_by_name_label('VM', job['vm_name']) if not xapi_cache.get_record('VM', x)['is_a_snapshot']]
+    if len(vm_refs) != 1:
+        # verify_vm_name reports this once the job runs
+        return
+    vm_record = xapi_cache.get_record('VM', vm_refs[0])
+    if vm_record['resident_on'] != 'OpaqueRef:NULL':
+        job['host'] = xapi_cache.get_record('host', vm_record['resident_on'])['uuid']
+    disks_part = vdi_export_disks.get(job['vm_name'])
+    for vbd in vm_record['VBDs']:
+        vbd_record = xapi_cache.get_record('VBD', vbd)
+        if vbd_record['type'].lower() != 'disk' or vbd_record['VDI'] == 'OpaqueRef:NULL':
             continue
-        if xvda_name_label == '':
-            log('ERROR gather_vm_meta has no xvda-name-label')
-            if config_specified:
-                status_log_vdi_export_end(server_name, 'ERROR xvda-name-label not found %s' % vm_name)
-            error_cnt += 1
-            # next vm
+        if job['export_type'] == 'vdi-export' and disks_part is not None \
+            and vbd_record['device'] not in disks_part:
             continue
-
-        # -----------------------------------------
-        # --- begin vdi-export command sequence ---
-        log ('*** vdi-export begin xe command sequence')
-        # is vm currently running?
-        cmd = '%s/xe vm-list name-label="%s" params=power-state | /bin/grep running' % (xe_path, vm_name)
-        if run_log_out_wait_rc(cmd) == 0:
-            log ('vm is running')
+        vdi_record = xapi_cache.get_record('VDI', vbd_record['VDI'])
+        sr_uuid = xapi_cache.get_record('SR', vdi_record['SR'])['uuid']
+        if sr_uuid not in job['srs']:
+            job['srs'].append(sr_uuid)
+        if job['export_type'] == 'vdi-export' and config['vdi_export_format'] == 'raw':
+            job['size'] += int(vdi_record['virtual_size'])
         else:
-            log ('vm is NOT running')
-
-        # list the vdi we will backup
-        cmd = '%s/xe vdi-list uuid=%s' % (xe_path, xvda_uuid)
-        log('1.cmd: %s' % cmd)
-        if run_log_out_wait_rc(cmd) != 0:
-            log('ERROR %s' % cmd)
-            if config_specified:
-                status_log_vdi_export_end(server_name, 'VDI-LIST-FAIL %s' % vm_name)
-            error_cnt += 1
-            # next vm
-            continue
-
-        # check for old vdi-snapshot for this xvda
-        snap_vdi_name_label = 'SNAP_%s_%s' % (vm_name, xvda_name_label)
-        # replace all spaces with '-'
-        snap_vdi_name_label = re.sub(r' ', r'-', snap_vdi_name_label)
-        log ('check for prev-vdi-snapshot: %s' % snap_vdi_name_label)
-        cmd = "%s/xe vdi-list name-label='%s' params=uuid | /bin/awk -F': ' '{print $2}' | /bin/grep '-'" % (xe_path, snap_vdi_name_label)
-        old_snap_vdi_uuid = run_get_lastline(cmd)
-        if old_snap_vdi_uuid != '':
-            log ('cleanup old-snap-vdi-uuid: %s' % old_snap_vdi_uuid)
-            # vdi-destroy old vdi-snapshot
-            cmd = '%s/xe vdi-destroy uuid=%s' % (xe_path, old_snap_vdi_uuid)
-            log('cmd: %s' % cmd)
-            if run_log_out_wait_rc(cmd) != 0:
-                log('WARNING %s' % cmd)
-                this_status = 'warning'
-                # non-fatal - finish processing for this vm
-
-        # === pre_cleanup code goes in here ===
-        if pre_clean:
-           pre_cleanup ( vm_backup_dir, vm_max_backups)
-
-        # take a vdi-snapshot of this vm
-        cmd = '%s/xe vdi-snapshot uuid=%s' % (xe_path, xvda_uuid)
-        log('2.cmd: %s' % cmd)
-        snap_vdi_uuid = run_get_lastline(cmd)
-        log ('snap-uuid: %s' % snap_vdi_uuid)
-        if snap_vdi_uuid == '':
-            log('ERROR %s' % cmd)
-            if config_specified:
-                status_log_vdi_export_end(server_name, 'VDI-SNAPSHOT-FAIL %s' % vm_name)
-            error_cnt += 1
-            # next vm
+            job['size'] += int(vdi_record['physical_utilisation'])
+    if tmp_log:
+        log('placement %s %s - host: %s srs: %s size: %sG' \
+            % (job['export_type'], job['vm_name'], job['host'], ' '.join(job['srs']), job['size'] / (1024 * 1024 * 1024)))
+
+def order_backup_jobs(jobs, order):
+    # longest jobs first, so that with max_parallel the big vms do not
+    # start last and drag out the end of the backup window
+    #   size    - by the size found by set_job_placement
+    #   history - by the last elapse: of this vm in the status_log,
+    #             vms without history go first since they could be big
+    # note - sort is stable, so equal jobs keep their config order
+    if order == 'size':
+        jobs = sorted(jobs, key=lambda job: job['size'], reverse=True)
+    elif order == 'history':
+        history = get_status_log_elapse()
+        unknown = sys.maxint
+        jobs = sorted(jobs, key=lambda job: history.get((job['export_type'], job['vm_name']), unknown), reverse=True)
+    str = ''
+    for job in jobs:
+        str += '%s, ' % job['vm_name']
+    if len(str) > 1:
+        str = str[:-2]
+    log('*** order=%s: %s' % (order, str))
+    return jobs
+
+def get_status_log_elapse():
+    # last elapse: minutes per (export_type, vm_name) from the status_log
+    # records look like: 2019/08/07 01:02:03,vm-export,server,end,SUCCESS vm_name,elapse:5 size:3G
+    history = {}
+    if not os.path.exists(config['status_log']):
+        return history
+    for line in open(config['status_log'], 'r'):
+        fields = line.rstrip('\n').split(',')
+        if len(fields) < 6 or fields[1] not in ['vm-export', 'vdi-export'] or fields[3] != 'end':
             continue
+        status_vm = fields[4].split(' ', 1)
+        m = re.match('^elapse:(\d+) ', fields[-1])
+        if len(status_vm) == 2 and m is not None:
+            history[(fields[1], status_vm[1])] = int(m.group(1))
+    return history
+
+class BackupScheduler:
+    # hands out jobs to the run_backup_jobs workers so that no more than
+    # max_per_sr exports read from one SR and no more than max_per_host
+    # exports stream from one host at the same time (0 = unlimited).
+    # Of the jobs allowed to start, the one on the least busy SRs/host is
+    # picked, config order breaks ties.
+
+    def __init__(self, jobs, max_per_sr, max_per_host, refresh_placement=False):
+        self.pending = list(jobs)
+        self.max_per_sr = max_per_sr
+        self.max_per_host = max_per_host
+        # with xapi_events the placement of the pending jobs follows
+        # migrations and disk changes from the event-driven xapi_cache
+        self.refresh_placement = refresh_placement
+        self.sr_running = {}
+        self.host_running = {}
+        # adaptive_parallel: no more than max_running jobs at a time, None - unlimited
+        self.running = 0
+        self.max_running = None
+        self.cond = threading.Condition()
+
+    def load(self, job):
+        # number of running exports sharing a SR or the host with job
+        # returns -1 if job would exceed max_per_sr or max_per_host
+        load = 0
+        for sr in job['srs']:
+            cnt = self.sr_running.get(sr, 0)
+            if self.max_per_sr > 0 and cnt >= self.max_per_sr:
+                return -1
+            load += cnt
+        if job['host'] != '':
+            cnt = self.host_running.get(job['host'], 0)
+            if self.max_per_host > 0 and cnt >= self.max_per_host:
+                return -1
+            load += cnt
+        return load
+
+    def set_max_running(self, max_running):
+        self.cond.acquire()
+        try:
+            self.max_running = max_running
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
 
-        # change vdi-snapshot to unique name-label for easy id and cleanup
-        cmd = '%s/xe vdi-param-set uuid=%s name-label="%s"' % (xe_path, snap_vdi_uuid, snap_vdi_name_label)
-        log('3.cmd: %s' % cmd)
-        if run_log_out_wait_rc(cmd) != 0:
-            log('ERROR %s' % cmd)
-            if config_specified:
-                status_log_vdi_export_end(server_name, 'VDI-PARAM-SET-FAIL %s' % vm_name)
-            error_cnt += 1
-            # next vm
-            continue
+    def get_running(self):
+        self.cond.acquire()
+        try:
+            return self.running
+        finally:
+            self.cond.release()
 
-        # actual-backup: vdi-export vdi-snapshot
-        cmd = '%s/xe vdi-export format=%s uuid=%s' % (xe_path, config['vdi_export_format'], snap_vdi_uuid)
-        full_path_backup_file = os.path.join(full_backup_dir, vm_name + '.%s' % config['vdi_export_format'])
-        cmd = '%s filename="%s"' % (cmd, full_path_backup_file) 
-        log('4.cmd: %s' % cmd)
-        if run_log_out_wait_rc(cmd) == 0:
-            log('vdi-export success')
+    def take_pending(self):
+        # the jobs never handed out, e.g. every worker failed to log in
+        self.cond.acquire()
+        try:
+            jobs = self.pending
+            self.pending = []
+            return jobs
+        finally:
+            self.cond.release()
+
+    def set_pending(self, jobs):
+        # daemon: replace the jobs waiting to be handed out
+        self.cond.acquire()
+        try:
+            self.pending = list(jobs)
+        finally:
+            self.cond.release()
+
+    def next_job(self, wait=True):
+        # wait for a job that may start now, None when all jobs are handed out
+        # wait=False - None if no job may start now
+        self.cond.acquire()
+        try:
+            while True:
+                if len(self.pending) == 0:
+                    return None
+                if self.max_running is not None and self.running >= self.max_running:
+                    if not wait:
+                        return None
+                    self.cond.wait(5)
+                    continue
+                if self.refresh_placement:
+                    for job in self.pending:
+                        set_job_placement(job, False)
+                best_ix = -1
+                best_load = -1
+                for ix in range(len(self.pending)):
+                    load = self.load(self.pending[ix])
+                    if load >= 0 and (best_ix == -1 or load < best_load):
+                        best_ix = ix
+                        best_load = load
+                        if load == 0:
+                            break
+                if best_ix >= 0:
+                    job = self.pending.pop(best_ix)
+                    self.running += 1
+                    for sr in job['srs']:
+                        self.sr_running[sr] = self.sr_running.get(sr, 0) + 1
+                    if job['host'] != '':
+                        self.host_running[job['host']] = self.host_running.get(job['host'], 0) + 1
+                    return job
+                # every pending job is over a limit - wait for a running job to finish
+                if not wait:
+                    return None
+                self.cond.wait(5)
+        finally:
+            self.cond.release()
+
+    def job_done(self, job):
+        self.cond.acquire()
+        try:
+            self.running -= 1
+            for sr in job['srs']:
+                self.sr_running[sr] -= 1
+            if job['host'] != '':
+                self.host_running[job['host']] -= 1
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+class ConcurrencyController:
+    # adaptive_parallel: AIMD on the number of exports running at the same time,
+    # up to max_parallel. Every ADAPTIVE_SAMPLE_SECS the export throughput, the
+    # storage write latency (fsync of a probe file below backup_dir) and the dom0
+    # load average are sampled:
+    #   storage latency or dom0 load over the limit - halve the exports
+    #   all slots busy and the last added export raised the throughput by
+    #     ADAPTIVE_MIN_GAIN - add one more
+    #   all slots busy otherwise - past the knee, go back one and hold
+    # note - each decision is logged with the sample it was based on
+
+    def __init__(self, scheduler, max_parallel):
+        self.scheduler = scheduler
+        self.max_parallel = max_parallel
+        self.limit = 1
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.best_latency = None
+        self.last_rate = None # throughput before the last increase
+        self.hold = 0
+        self.stopping = threading.Event()
+        self.thread = None
+        self.probe_path = os.path.join(config['backup_dir'], '.latency-probe-%s' % os.getpid())
+
+    def add_bytes(self, nbytes):
+        self.lock.acquire()
+        try:
+            self.bytes += nbytes
+        finally:
+            self.lock.release()
+
+    def start(self):
+        log('*** adaptive_parallel - starting with 1 of max_parallel=%s exports' % self.max_parallel)
+        self.scheduler.set_max_running(self.limit)
+        self.thread = threading.Thread(target=self.run, name='adaptive-parallel')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+        self.scheduler.set_max_running(None)
+
+    def run(self):
+        last = time.time()
+        while not self.stopping.wait(ADAPTIVE_SAMPLE_SECS):
+            now = time.time()
+            self.lock.acquire()
+            try:
+                nbytes = self.bytes
+                self.bytes = 0
+            finally:
+                self.lock.release()
+            rate = nbytes / max(now - last, 0.001)
+            last = now
+            try:
+                latency = self.probe_latency()
+            except (IOError, OSError), e:
+                log('adaptive_parallel: storage latency probe failed - %s' % e)
+                latency = None
+            try:
+                self.adjust(rate, self.scheduler.get_running(), latency, os.getloadavg()[0])
+            except Exception, e:
+                log('***ERROR adaptive_parallel - %s' % e)
+
+    def probe_latency(self):
+        # ms to write and fsync a small file where the backups go
+        begin = time.time()
+        fd = os.open(self.probe_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        try:
+            os.write(fd, '\0' * 65536)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        latency = (time.time() - begin) * 1000
+        os.remove(self.probe_path)
+        return latency
+
+    def adjust(self, rate, running, latency, load):
+        sample = 'running %s, %.1fMB/s (%.1fMB/s per export), storage latency %s, dom0 load %.2f' \
+            % (running, rate / (1024 * 1024), rate / max(running, 1) / (1024 * 1024),
+            '-' if latency is None else '%dms' % latency, load)
+        if latency is not None and (self.best_latency is None or latency < self.best_latency):
+            self.best_latency = latency
+        cpus = multiprocessing.cpu_count()
+        reason = None
+        if latency is not None and latency > max(self.best_latency * ADAPTIVE_LATENCY_FACTOR, ADAPTIVE_LATENCY_MIN_MS):
+            reason = 'storage latency over %dms' % max(self.best_latency * ADAPTIVE_LATENCY_FACTOR, ADAPTIVE_LATENCY_MIN_MS)
+        elif load > cpus * ADAPTIVE_LOAD_FACTOR:
+            reason = 'dom0 load over %s cpus' % cpus
+        if reason is not None:
+            # multiplicative decrease
+            new_limit = max(1, self.limit / 2)
+            if new_limit < self.limit:
+                log('adaptive_parallel: %s -> %s exports, %s - %s' % (self.limit, new_limit, reason, sample))
+            self.limit = new_limit
+            self.last_rate = None
+            self.hold = ADAPTIVE_HOLD_SAMPLES
+        elif running < self.limit:
+            # not enough backups due to fill the slots, nothing to learn
+            return
+        elif self.hold > 0:
+            self.hold -= 1
+        elif self.last_rate is None or rate >= self.last_rate * (1 + ADAPTIVE_MIN_GAIN):
+            # additive increase
+            if self.limit < self.max_parallel:
+                log('adaptive_parallel: %s -> %s exports, throughput still rising - %s' % (self.limit, self.limit + 1, sample))
+                self.last_rate = rate
+                self.limit += 1
+                # let the added export get going before judging it
+                self.hold = 1
         else:
-            log('ERROR %s' % cmd)
-            if config_specified:
-                status_log_vdi_export_end(server_name, 'VDI-EXPORT-FAIL %s' % vm_name)
-            error_cnt += 1
-            # next vm
-            continue
-    
-        # cleanup: vdi-destroy vdi-snapshot
-        cmd = '%s/xe vdi-destroy uuid=%s' % (xe_path, snap_vdi_uuid)
-        log('5.cmd: %s' % cmd)
-        if run_log_out_wait_rc(cmd) != 0:
-            log('WARNING %s' % cmd)
-            this_status = 'warning'
-            # non-fatal - finsh processing for this vm
+            log('adaptive_parallel: %s -> %s exports, no gain over %.1fMB/s with one less - %s' \
+                % (self.limit, self.limit - 1, self.last_rate / (1024 * 1024), sample))
+            self.limit -= 1
+            self.last_rate = None
+            self.hold = ADAPTIVE_HOLD_SAMPLES
+        self.scheduler.set_max_running(self.limit)
+
+def start_concurrency_controller(scheduler, max_parallel):
+    global concurrency_controller
+    if config['adaptive_parallel'] == 'true' and max_parallel > 1:
+        concurrency_controller = ConcurrencyController(scheduler, max_parallel)
+        concurrency_controller.start()
+
+def stop_concurrency_controller():
+    global concurrency_controller
+    if concurrency_controller is not None:
+        concurrency_controller.stop()
+        concurrency_controller = None
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # metrics_port: GET /metrics
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.exporter.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes do not belong in the backup log
+        pass
+
+class MetricsExporter:
+    # live metrics of the run in prometheus text format: the vm backups running
+    # now with their phase, bytes exported, MB/s, eta and the time of their last
+    # progress (to alert on stalled exports), the queue depth and the
+    # success/warning/error counts. Served on metrics_port and/or rewritten
+    # every METRICS_TEXTFILE_SECS into metrics_textfile for node_exporter.
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.server = None
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if config['metrics_port'] != '0':
+            (address, port) = get_metrics_address()
+            self.server = BaseHTTPServer.HTTPServer((address, port), MetricsHandler)
+            self.server.exporter = self
+            t = threading.Thread(target=self.server.serve_forever, name='metrics-http')
+            t.setDaemon(True)
+            t.start()
+            log('*** metrics - serving http://%s:%s/metrics' % (address or '*', port))
+        if config['metrics_textfile'] != '':
+            self.write_textfile()
+            self.thread = threading.Thread(target=self.run, name='metrics-textfile')
+            self.thread.setDaemon(True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            # the final counts stay for node_exporter until the next run
+            self.write_textfile()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def run(self):
+        while not self.stopping.wait(METRICS_TEXTFILE_SECS):
+            self.write_textfile()
+
+    def write_textfile(self):
+        # node_exporter may read at any time, so replace the file atomically
+        tmp_path = config['metrics_textfile'] + '.tmp'
+        try:
+            open(tmp_path, 'w').write(self.render())
+            os.rename(tmp_path, config['metrics_textfile'])
+        except (IOError, OSError), e:
+            log('WARNING metrics_textfile %s - %s' % (config['metrics_textfile'], e))
+
+    def render(self):
+        now = time.time()
+        lines = []
+        def metric(name, metric_type, help_text, samples):
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            for (labels, value) in samples:
+                if labels:
+                    label_text = ','.join(['%s="%s"' % (k, metrics_label(v)) for (k, v) in labels])
+                    lines.append('%s{%s} %s' % (name, label_text, value))
+                else:
+                    lines.append('%s %s' % (name, value))
 
-        log ('*** vdi-export end')
-        # --- end vdi-export command sequence ---
-        # ---------------------------------------
+        status_lock.acquire()
+        try:
+            counts = dict(status_cnt)
+        finally:
+            status_lock.release()
+        self.scheduler.cond.acquire()
+        try:
+            pending = len(self.scheduler.pending)
+        finally:
+            self.scheduler.cond.release()
+        report_lock.acquire()
+        try:
+            running = [(x['vm_name'], x['export_type'], x['phase'], x['begin'], x['exported'], x['export_begin'],
+                x['size'], x['last_progress']) for x in running_reports.values()]
+        finally:
+            report_lock.release()
+        running.sort()
+
+        metric('vmbackup_run_start_time_seconds', 'gauge', 'Start of this VmBackup run.', [([], '%.0f' % run_begin_time)])
+        metric('vmbackup_backups_total', 'counter', 'Finished vm backups of this run by status.',
+            [([('status', x)], counts[x]) for x in ['success', 'warning', 'error']])
+        metric('vmbackup_queue_depth', 'gauge', 'Vm backups waiting to start.', [([], pending)])
+        metric('vmbackup_running_backups', 'gauge', 'Vm backups running now.', [([], len(running))])
+        samples = {'phase': [], 'begin': [], 'bytes': [], 'rate': [], 'eta': [], 'progress': []}
+        for (vm_name, export_type, phase, begin, exported, export_begin, size, last_progress) in running:
+            labels = [('vm', vm_name), ('export_type', export_type)]
+            samples['phase'].append((labels + [('phase', phase)], 1))
+            samples['begin'].append((labels, '%.0f' % begin))
+            samples['bytes'].append((labels, exported))
+            samples['progress'].append((labels, '%.0f' % last_progress))
+            rate = exported / (now - export_begin) if export_begin > 0 and now > export_begin else 0
+            samples['rate'].append((labels, '%.0f' % rate))
+            if rate > 0 and size > 0:
+                # note - size is estimated, see set_job_placement
+                samples['eta'].append((labels, '%.0f' % (max(size - exported, 0) / rate)))
+        metric('vmbackup_vm_phase', 'gauge', 'Phase of each running vm backup.', samples['phase'])
+        metric('vmbackup_vm_start_time_seconds', 'gauge', 'Start of each running vm backup.', samples['begin'])
+        metric('vmbackup_vm_exported_bytes', 'gauge', 'Bytes exported so far by each running vm backup.', samples['bytes'])
+        metric('vmbackup_vm_export_bytes_per_second', 'gauge', 'Export throughput of each running vm backup.', samples['rate'])
+        metric('vmbackup_vm_eta_seconds', 'gauge', 'Estimated seconds until the export of each running vm backup is done.', samples['eta'])
+        metric('vmbackup_vm_last_progress_time_seconds', 'gauge', 'Last phase change or exported data of each running vm backup.', samples['progress'])
+        return '\n'.join(lines) + '\n'
+
+def metrics_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def get_metrics_address():
+    # metrics_port=[address:]port, all addresses if none given
+    if ':' in config['metrics_port']:
+        (address, port) = config['metrics_port'].rsplit(':', 1)
+        return (address, int(port))
+    return ('', int(config['metrics_port']))
+
+def start_metrics(scheduler):
+    global metrics_exporter
+    if config['metrics_port'] != '0' or config['metrics_textfile'] != '':
+        metrics_exporter = MetricsExporter(scheduler)
+        try:
+            metrics_exporter.start()
+        except (IOError, OSError, socket.error), e:
+            # no metrics is no reason to skip the backups
+            log('WARNING metrics - %s' % e)
+
+def stop_metrics():
+    global metrics_exporter
+    if metrics_exporter is not None:
+        metrics_exporter.stop()
+        metrics_exporter = None
+
+def run_backup_jobs(server_name, jobs, tmp_max_parallel):
+    # run the jobs on a pool of tmp_max_parallel worker threads
+    # note - each worker logs in with its own xapi session, since one
+    #   XenAPI.Session must not be shared by concurrent requests
+    scheduler = BackupScheduler(jobs, int(config['max_per_sr']), int(config['max_per_host']),
+        config['xapi_events'] == 'true' and (int(config['max_per_sr']) > 0 or int(config['max_per_host']) > 0))
+
+    def worker():
+        try:
+            if tmp_max_parallel > 1:
+                thread_data.session = None
+                try:
+                    thread_data.session = xapi_login()
+                except Exception, e:
+                    # note - its jobs are left to the other workers, see take_pending
+                    log('ERROR xapi login for %s - %s' % (threading.currentThread().getName(), e))
+                    return
+            job = scheduler.next_job()
+            while job:
+                if tmp_max_parallel > 1:
+                    thread_data.vm_name = job['vm_name']
+                try:
+                    run_backup_job(server_name, job)
+                finally:
+                    thread_data.vm_name = None
+                    scheduler.job_done(job)
+                job = scheduler.next_job()
+        finally:
+            if tmp_max_parallel > 1 and thread_data.session is not None:
+                xapi_logout(thread_data.session)
+                thread_data.session = None
+
+    if tmp_max_parallel <= 1:
+        # sequential in config order, same as always
+        start_metrics(scheduler)
+        try:
+            worker()
+        finally:
+            stop_metrics()
+        return
 
-        elapseTime = datetime.datetime.now() - beginTime
-        backup_file_size = os.path.getsize(full_path_backup_file) / (1024 * 1024 * 1024)
-        final_cleanup( full_path_backup_file, backup_file_size, full_backup_dir, vm_backup_dir, vm_max_backups)
+    start_concurrency_controller(scheduler, tmp_max_parallel)
+    start_metrics(scheduler)
+    try:
+        workers = []
+        for ix in range(min(tmp_max_parallel, len(jobs))):
+            t = threading.Thread(target=worker, name='worker-%s' % (ix + 1))
+            t.setDaemon(True)
+            workers.append(t)
+            t.start()
+        for t in workers:
+            # join with timeout so that ctrl-c is still delivered to the main thread
+            while t.isAlive():
+                t.join(5)
+        for job in scheduler.take_pending():
+            log('ERROR %s %s - not backed up, no worker could log in' % (job['export_type'], job['vm_parm']))
+            count_status('error')
+    finally:
+        stop_metrics()
+        stop_concurrency_controller()
+
+def run_backup_job(server_name, job):
+    export_type = job['export_type']
+    vm_parm = job['vm_parm']
+    if shard_leases is not None:
+        holder = shard_leases.acquire(job['vm_name'])
+        if holder is not None:
+            log('*** %s %s skipped - leased by %s' % (export_type, vm_parm, holder))
+            return
+        if get_last_backup_time(job['vm_name']) > job['last_backup']:
+            # e.g. migrated here after a peer had backed it up
+            log('*** %s %s skipped - backed up by another worker meanwhile' % (export_type, vm_parm))
+            shard_leases.release(job['vm_name'])
+            return
+    if float(config['throttle_mbps_job']) > 0:
+        # note - shared by the disks of a vdi-export, see run_vdi_export_disks
+        thread_data.job_throttle = TokenBucket(lambda: float(config['throttle_mbps_job']) * 1024 * 1024)
+    job_size = job['size']
+    if metrics_exporter is not None and job_size == 0:
+        # the estimated export size gives the metrics an eta
+        # note - on a copy, the scheduler releases the placement the job started with
+        estimate = dict(job)
+        set_job_placement(estimate, False)
+        job_size = estimate['size']
+    # like job_throttle shared by the disks of a vdi-export
+    thread_data.job_report = new_job_report(job, job_size)
+    report_lock.acquire()
+    try:
+        running_reports[job['vm_name']] = thread_data.job_report
+    finally:
+        report_lock.release()
+    try:
+        if export_type == 'vdi-export':
+            this_status = backup_vdi_export(server_name, vm_parm)
+        else:
+            this_status = backup_vm_export(server_name, vm_parm)
+    except Exception, e:
+        # one failed vm must not take down the other workers
+        log('***ERROR EXCEPTION %s %s - %s' % (export_type, vm_parm, e))
+        for line in traceback.format_exc().splitlines():
+            log(line, False)
+        this_status = 'error'
+    finally:
+        end_open_phase()
+    thread_data.job_throttle = None
+    report_lock.acquire()
+    try:
+        del running_reports[job['vm_name']]
+    finally:
+        report_lock.release()
+    log_job_report(thread_data.job_report, this_status)
+    thread_data.job_report = None
+    if shard_leases is not None:
+        shard_leases.release(job['vm_name'])
+    count_status(this_status)
+
+def backup_vdi_export(server_name, vm_parm):
+    # vdi-export one vm and return this_status: 'success', 'warning' or 'error'
+    log('*** vdi-export begin %s' % vm_parm)
+    beginTime = datetime.datetime.now()
+    this_status = 'success'
+
+    # get values from vdi-export=
+    vm_name = get_vm_name(vm_parm)
+    vm_max_backups = get_vm_max_backups(vm_parm)
+    log('vdi-export - vm_name: %s max_backups: %s' % (vm_name, vm_max_backups))
 
-        if not check_all_backups_success(vm_backup_dir):
-            log('WARNING cleanup needed - not all backup history is successful')
+    if config_specified:
+        status_log_vdi_export_begin(server_name, '%s' % vm_name)
+
+    # verify vm_name exists with only one instance for this name
+    #  returns error-message or vm_object if success
+    phase_begin = begin_phase('lookup')
+    vm_object = verify_vm_name(vm_name)
+    if 'ERROR' in vm_object:
+        log('verify_vm_name: %s' % vm_object)
+        if config_specified:
+            status_log_vdi_export_end(server_name, 'ERROR verify_vm_name %s' % vm_name)
+        return 'error'
+    report_phase('lookup', phase_begin)
+
+    vm_backup_dir = os.path.join(config['backup_dir'], vm_name) 
+    # cleanup any old unsuccessful backups and create new full_backup_dir
+    phase_begin = begin_phase('cleanup')
+    full_backup_dir = process_backup_dir(vm_backup_dir)
+    report_phase('cleanup', phase_begin)
+
+    # gather_vm_meta produces status: empty or warning-message 
+    #   and vm_meta: vm_uuid, disks
+    #   since all VM metadta go into an XML file
+    phase_begin = begin_phase('metadata')
+    (vm_meta_status, vm_meta) = gather_vm_meta(vm_object, full_backup_dir)
+    report_phase('metadata', phase_begin)
+    if vm_meta_status != '':
+        log('WARNING gather_vm_meta: %s' % vm_meta_status)
+        this_status = 'warning'
+        # non-fatal - finsh processing for this vm
+
+    # vdi-export all disks of this vm, or the disks= subset of vdi-export=
+    disks = vm_meta['disks']
+    # note - looked up once, the daemon replaces vdi_export_disks on each select
+    disks_part = vdi_export_disks.get(vm_name)
+    if disks_part is not None:
+        for device in disks_part:
+            if device not in [disk['device'] for disk in disks]:
+                log('WARNING disks=%s not found on %s' % (device, vm_name))
+                this_status = 'warning'
+        disks = [disk for disk in disks if disk['device'] in disks_part]
+    if len(disks) == 0:
+        log('ERROR gather_vm_meta has no disk to vdi-export')
+        if config_specified:
+            status_log_vdi_export_end(server_name, 'ERROR no disk found %s' % vm_name)
+        return 'error'
+
+    # -----------------------------------------
+    # --- begin vdi-export command sequence ---
+    # note - snapshot, param-set and destroy go through the xapi session,
+    #   only the export itself runs the xe command
+    log ('*** vdi-export begin xe command sequence')
+    session = get_session()
+    # is vm currently running?
+    if session.xenapi.VM.get_power_state(vm_object) == 'Running':
+        log ('vm is running')
+    else:
+        log ('vm is NOT running')
+
+    # === pre_cleanup code goes in here ===
+    if pre_clean:
+        phase_begin = begin_phase('cleanup')
+        pre_cleanup ( vm_backup_dir, vm_max_backups)
+        report_phase('cleanup', phase_begin)
+
+    # the disks export concurrently, each into its DISK-<device> directory
+    backup_file_size = 0
+    backup_file_allocated = 0
+    disk_errors = []
+    for (disk, disk_result) in zip(disks, run_vdi_export_disks(vm_name, disks, full_backup_dir, vm_backup_dir)):
+        (disk_status, disk_error, disk_size, disk_allocated) = disk_result
+        backup_file_size += disk_size
+        backup_file_allocated += disk_allocated
+        if disk_status == 'error':
+            disk_errors.append('%s:%s' % (disk['device'], disk_error))
+        elif disk_status == 'warning':
             this_status = 'warning'
+    if len(disk_errors) > 0:
+        log('ERROR vdi-export %s' % ' '.join(disk_errors))
+        if config_specified:
+            status_log_vdi_export_end(server_name, '%s %s' % (' '.join(disk_errors), vm_name))
+        return 'error'
+
+    if is_export_resumable():
+        resume_cleanup(full_backup_dir)
+    log ('*** vdi-export end')
+    # --- end vdi-export command sequence ---
+    # ---------------------------------------
+
+    elapseTime = datetime.datetime.now() - beginTime
+    backup_file_size = backup_file_size / (1024 * 1024 * 1024)
+    # note - a sparse raw export allocates less than its (apparent) size
+    backup_file_allocated = backup_file_allocated / (1024 * 1024 * 1024)
+    log('vdi-export size: %sG allocated: %sG' % (backup_file_size, backup_file_allocated))
+    phase_begin = begin_phase('cleanup')
+    final_cleanup( full_backup_dir, backup_file_size, full_backup_dir, vm_backup_dir, vm_max_backups)
+
+    if not check_all_backups_success(vm_backup_dir):
+        log('WARNING cleanup needed - not all backup history is successful')
+        this_status = 'warning'
+    report_phase('cleanup', phase_begin)
 
-        if (this_status == 'success'):
-            success_cnt += 1
-            log('VmBackup vdi-export %s - ***Success*** t:%s' % (vm_name, str(elapseTime.seconds/60)))
-            if config_specified:
-                status_log_vdi_export_end(server_name, 'SUCCESS %s,elapse:%s size:%sG' % (vm_name, str(elapseTime.seconds/60), backup_file_size))
-
-        elif (this_status == 'warning'):
-            warning_cnt += 1
-            log('VmBackup vdi-export %s - ***WARNING*** t:%s' % (vm_name, str(elapseTime.seconds/60)))
-            if config_specified:
-                status_log_vdi_export_end(server_name, 'WARNING %s,elapse:%s size:%sG' % (vm_name, str(elapseTime.seconds/60), backup_file_size))
-
-        else:
-            # this should never occur since all errors do a continue on to the next vm_name
-            error_cnt += 1
-            log('VmBackup vdi-export %s - +++ERROR-INTERNAL+++ t:%s' % (vm_name, str(elapseTime.seconds/60)))
-            if config_specified:
-                status_log_vdi_export_end(server_name, 'ERROR-INTERNAL %s,elapse:%s size:%sG' % (vm_name, str(elapseTime.seconds/60), backup_file_size))
+    if (this_status == 'success'):
+        log('VmBackup vdi-export %s - ***Success*** t:%s' % (vm_name, str(elapseTime.seconds/60)))
+        if config_specified:
+            status_log_vdi_export_end(server_name, 'SUCCESS %s,elapse:%s size:%sG allocated:%sG' % (vm_name, str(elapseTime.seconds/60), backup_file_size, backup_file_allocated))
 
-    # end of for vm_parm in config['vdi-export']:
-    ######################################################################
+    elif (this_status == 'warning'):
+        log('VmBackup vdi-export %s - ***WARNING*** t:%s' % (vm_name, str(elapseTime.seconds/60)))
+        if config_specified:
+            status_log_vdi_export_end(server_name, 'WARNING %s,elapse:%s size:%sG allocated:%sG' % (vm_name, str(elapseTime.seconds/60), backup_file_size, backup_file_allocated))
 
+    else:
+        # this should never occur since all errors return before this point
+        this_status = 'error'
+        log('VmBackup vdi-export %s - +++ERROR-INTERNAL+++ t:%s' % (vm_name, str(elapseTime.seconds/60)))
+        if config_specified:
+            status_log_vdi_export_end(server_name, 'ERROR-INTERNAL %s,elapse:%s size:%sG allocated:%sG' % (vm_name, str(elapseTime.seconds/60), backup_file_size, backup_file_allocated))
 
-    ######################################################################
-    # Iterate through all vm-export= in cfg
-    log('************ vm-export= ***************')
-    for vm_parm in config['vm-export']:
-        log('*** vm-export begin %s' % vm_parm)
-        beginTime = datetime.datetime.now()
-        this_status = 'success'
+    return this_status
 
-        # get values from vdi-export=
-        vm_name = get_vm_name(vm_parm)
-        vm_max_backups = get_vm_max_backups(vm_parm)
-        log('vm-export - vm_name: %s max_backups: %s' % (vm_name, vm_max_backups))
+def run_vdi_export_disks(vm_name, disks, tmp_full_backup_dir, tmp_vm_backup_dir):
+    # vdi-export the disks of one vm concurrently, one thread per disk,
+    # so a vm takes as long as its largest disk instead of the sum
+    # returns a list of backup_vdi_export_disk results in disks order
+    # note - like the run_backup_jobs workers each thread has its own xapi session
+    results = [('error', 'INTERNAL', 0, 0)] * len(disks)
+    job_throttle = getattr(thread_data, 'job_throttle', None)
+    job_report = getattr(thread_data, 'job_report', None)
 
-        if config_specified:
-            status_log_vm_export_begin(server_name, '%s' % vm_name)
+    def disk_worker(ix):
+        disk = disks[ix]
+        try:
+            if len(disks) > 1:
+                thread_data.vm_name = '%s:%s' % (vm_name, disk['device'])
+                thread_data.job_throttle = job_throttle
+                thread_data.job_report = job_report
+                thread_data.session = xapi_login()
+            results[ix] = backup_vdi_export_disk(vm_name, disk, tmp_full_backup_dir, tmp_vm_backup_dir)
+        except Exception, e:
+            log('***ERROR EXCEPTION vdi-export %s %s - %s' % (vm_name, disk['device'], e))
+            for line in traceback.format_exc().splitlines():
+                log(line, False)
+            results[ix] = ('error', 'EXCEPTION', 0, 0)
+        finally:
+            end_open_phase()
+        if len(disks) > 1:
+            xapi_logout(getattr(thread_data, 'session', None))
+            thread_data.session = None
+
+    if len(disks) == 1:
+        disk_worker(0)
+        return results
+
+    disk_threads = []
+    for ix in range(len(disks)):
+        t = threading.Thread(target=disk_worker, args=(ix,), name='%s-%s' % (threading.currentThread().getName(), disks[ix]['device']))
+        t.setDaemon(True)
+        disk_threads.append(t)
+        t.start()
+    for t in disk_threads:
+        # join with timeout so that ctrl-c is still delivered to the main thread
+        while t.isAlive():
+            t.join(5)
+    return results
+
+def backup_vdi_export_disk(vm_name, disk, tmp_full_backup_dir, tmp_vm_backup_dir):
+    # vdi-export one disk of a vm into its DISK-<device> directory
+    # returns (disk_status, status_log_error, backup file bytes, allocated bytes)
+    #   disk_status: 'success', 'warning' or 'error'
+    session = get_session()
+    disk_status = 'success'
+    device = disk['device']
+    device_dir = os.path.join(tmp_full_backup_dir, 'DISK-%s' % device)
+    vdi_uuid = disk['vdi_uuid']
+    vdi_name_label = disk['name_label']
+    if vdi_name_label == '':
+        log('ERROR gather_vm_meta has no vdi-name-label for %s' % device)
+        return ('error', 'VDI-NAME-LABEL-NOT-FOUND', 0, 0)
+
+    # list the vdi we will backup
+    log('1.xapi: VDI.get_by_uuid %s' % vdi_uuid)
+    try:
+        vdi_ref = xapi_cache.get_by_uuid('VDI', vdi_uuid)
+        log('vdi: %s virtual_size: %s' % (vdi_name_label, xapi_cache.get_record('VDI', vdi_ref)['virtual_size']))
+    except XenAPI.Failure, e:
+        log('ERROR VDI.get_by_uuid %s - %s' % (vdi_uuid, e))
+        return ('error', 'VDI-LIST-FAIL', 0, 0)
+
+    # resume_window: continue the export of this disk in a resumed backup dir
+    resume_snap_vdi = None
+    if is_export_resumable():
+        resume_cfg = read_disk_cfg(device_dir, 'resume.cfg')
+        if resume_cfg is not None and resume_cfg['state'] == 'done':
+            log('resume: DISK-%s was already exported' % device)
+            backup_file = os.path.join(device_dir, resume_cfg['file'])
+            return ('success', '', get_backup_file_size(backup_file), get_backup_file_allocated(backup_file))
+        if resume_cfg is not None:
+            resume_snap_vdi = resume_get_snapshot(resume_cfg, vdi_ref)
+
+    # check for old vdi-snapshot for this vdi
+    # note - only snapshots of this vdi, other disks may have the same name-label
+    snap_vdi_name_label = 'SNAP_%s_%s' % (vm_name, vdi_name_label)
+    # replace all spaces with '-'
+    snap_vdi_name_label = re.sub(r' ', r'-', snap_vdi_name_label)
+    log ('check for prev-vdi-snapshot: %s' % snap_vdi_name_label)
+    phase_begin = begin_phase('snapshot_removal')
+    for old_snap_vdi in session.xenapi.VDI.get_by_name_label(snap_vdi_name_label):
+        try:
+            if old_snap_vdi == resume_snap_vdi or session.xenapi.VDI.get_snapshot_of(old_snap_vdi) != vdi_ref:
+                continue
+            old_snap_vdi_uuid = session.xenapi.VDI.get_uuid(old_snap_vdi)
+            log ('cleanup old-snap-vdi-uuid: %s' % old_snap_vdi_uuid)
+            # vdi-destroy old vdi-snapshot
+            session.xenapi.VDI.destroy(old_snap_vdi)
+        except XenAPI.Failure, e:
+            log('WARNING VDI.destroy %s - %s' % (old_snap_vdi, e))
+            disk_status = 'warning'
+            # non-fatal - finish processing for this disk
+    report_phase('snapshot_removal', phase_begin)
+
+    # vdi_export_cbt: find the backup (and its cbt snapshot) to export the changes against
+    cbt_base = None
+    if config['vdi_export_cbt'] == 'true':
+        cbt_base = cbt_get_base(tmp_vm_backup_dir, tmp_full_backup_dir, device, vdi_ref)
+
+    if resume_snap_vdi is not None:
+        # the export continues from the same vdi-snapshot
+        snap_vdi = resume_snap_vdi
+        snap_vdi_uuid = session.xenapi.VDI.get_uuid(snap_vdi)
+        log('2.resume: vdi-snapshot %s of the failed export' % snap_vdi_uuid)
+    else:
+        # take a vdi-snapshot of this vm
+        log('2.xapi: VDI.snapshot uuid=%s' % vdi_uuid)
+        phase_begin = begin_phase('snapshot')
+        try:
+            snap_vdi = session.xenapi.VDI.snapshot(vdi_ref, {})
+            snap_vdi_uuid = session.xenapi.VDI.get_uuid(snap_vdi)
+        except XenAPI.Failure, e:
+            log('ERROR VDI.snapshot %s - %s' % (vdi_uuid, e))
+            return ('error', 'VDI-SNAPSHOT-FAIL', 0, 0)
+        report_phase('snapshot', phase_begin)
+        log ('snap-uuid: %s' % snap_vdi_uuid)
 
-        vm_object = verify_vm_name(vm_name)
-        if 'ERROR' in vm_object:
-            log('verify_vm_name: %s' % vm_object)
-            if config_specified:
-                status_log_vm_export_end(server_name, 'ERROR verify_vm_name %s' % vm_name)
-            error_cnt += 1
-            # next vm
-            continue
+        # change vdi-snapshot to unique name-label for easy id and cleanup
+        log('3.xapi: VDI.set_name_label uuid=%s name-label="%s"' % (snap_vdi_uuid, snap_vdi_name_label))
+        phase_begin = begin_phase('param_set')
+        try:
+            session.xenapi.VDI.set_name_label(snap_vdi, snap_vdi_name_label)
+        except XenAPI.Failure, e:
+            log('ERROR VDI.set_name_label %s - %s' % (snap_vdi_uuid, e))
+            return ('error', 'VDI-PARAM-SET-FAIL', 0, 0)
+        report_phase('param_set', phase_begin)
+        if is_export_resumable():
+            # a failed export keeps this vdi-snapshot for the next run
+            write_disk_cfg(device_dir, 'resume.cfg', {'state': 'exporting', 'snapshot_uuid': snap_vdi_uuid, 'time': int(time.time())})
+
+    # actual-backup: vdi-export vdi-snapshot
+    full_path_backup_file = os.path.join(device_dir, vm_name + '.%s' % config['vdi_export_format'])
+    if config['compress_codec'] != 'none':
+        full_path_backup_file += COMPRESS_SUFFIX[config['compress_codec']]
+    if config['backup_store'] == 'chunks':
+        full_path_backup_file += '.manifest'
+    phase_begin = begin_phase('export')
+    if cbt_base is not None:
+        # only the changed blocks are written, see CbtDeltaWriter
+        try:
+            bitmap = base64.b64decode(session.xenapi.VDI.list_changed_blocks(cbt_base['snapshot'], snap_vdi))
+        except XenAPI.Failure, e:
+            log('ERROR VDI.list_changed_blocks %s - %s' % (snap_vdi_uuid, e))
+            return ('error', 'VDI-LIST-CHANGED-BLOCKS-FAIL', 0, 0)
+        full_path_backup_file += '.delta'
+        try:
+            nbd_info = session.xenapi.VDI.get_nbd_info(snap_vdi)
+        except XenAPI.Failure, e:
+            log('WARNING VDI.get_nbd_info %s - %s' % (snap_vdi_uuid, e))
+            nbd_info = []
+        if len(nbd_info) > 0:
+            log('4.nbd: %s:%s vdi=%s - changed blocks against %s' % (nbd_info[0]['address'], nbd_info[0]['port'], snap_vdi_uuid, cbt_base['dir']))
+            export_ok = nbd_export_delta(nbd_info[0], bitmap, full_path_backup_file)
+        else:
+            # note - without a network with purpose nbd the whole vdi is read, see CbtDeltaWriter
+            log('4.http: /export_raw_vdi vdi=%s format=raw - cbt delta against %s, no nbd network' % (snap_vdi_uuid, cbt_base['dir']))
+            export_ok = http_export('/export_raw_vdi', {'vdi': snap_vdi_uuid, 'format': 'raw'}, full_path_backup_file,
+                CbtDeltaWriter(full_path_backup_file, bitmap))
+        if export_ok:
+            open(full_path_backup_file[:-len('.delta')] + '.bitmap', 'wb').write(bitmap)
+    elif config['export_method'] == 'http':
+        log('4.http: /export_raw_vdi vdi=%s format=%s' % (snap_vdi_uuid, config['vdi_export_format']))
+        sparse = (config['vdi_export_format'] == 'raw' and config['vdi_export_sparse'] == 'true')
+        resume = None
+        if is_export_resumable():
+            resume = get_export_resume(full_path_backup_file, sparse, resume_snap_vdi is not None)
+        export_ok = http_export('/export_raw_vdi', {'vdi': snap_vdi_uuid, 'format': config['vdi_export_format']}, full_path_backup_file,
+            sparse=sparse, resume=resume)
+    else:
+        cmd = '%s/xe vdi-export format=%s uuid=%s' % (xe_path, config['vdi_export_format'], snap_vdi_uuid)
+        if config['checksum'] != 'none' or is_throttled():
+            # to stdout, see xe_export
+            cmd = '%s filename=' % cmd
+            log('4.cmd: %s' % cmd)
+            export_ok = xe_export(cmd, open_export_file(full_path_backup_file))
+        else:
+            cmd = '%s filename="%s"' % (cmd, full_path_backup_file) 
+            log('4.cmd: %s' % cmd)
+            export_ok = (run_log_out_wait_rc(cmd) == 0)
+    if export_ok:
+        log('vdi-export success')
+        report_phase('export', phase_begin, get_backup_file_size(full_path_backup_file))
+    else:
+        log('ERROR vdi-export %s' % snap_vdi_uuid)
+        return ('error', 'VDI-EXPORT-FAIL', 0, 0)
+    if is_export_resumable():
+        # a resumed backup dir does not export this disk again
+        if os.path.exists(full_path_backup_file + '.checkpoint'):
+            os.remove(full_path_backup_file + '.checkpoint')
+        write_disk_cfg(device_dir, 'resume.cfg', {'state': 'done', 'file': os.path.basename(full_path_backup_file),
+            'time': read_disk_cfg(device_dir, 'resume.cfg')['time']})
+
+    phase_begin = begin_phase('snapshot_removal')
+    if config['vdi_export_cbt'] == 'true':
+        # keep the vdi-snapshot as the cbt base of the next backup
+        if not cbt_keep_snapshot(device_dir, vdi_ref, snap_vdi, 'CBT_%s_%s' % (vm_name, vdi_name_label), cbt_base):
+            disk_status = 'warning'
+    else:
+        # cleanup: vdi-destroy vdi-snapshot
+        log('5.xapi: VDI.destroy uuid=%s' % snap_vdi_uuid)
+        try:
+            session.xenapi.VDI.destroy(snap_vdi)
+        except XenAPI.Failure, e:
+            log('WARNING VDI.destroy %s - %s' % (snap_vdi_uuid, e))
+            disk_status = 'warning'
+            # non-fatal - finsh processing for this disk
+    report_phase('snapshot_removal', phase_begin)
+
+    return (disk_status, '', get_backup_file_size(full_path_backup_file), get_backup_file_allocated(full_path_backup_file))
+
+def backup_vm_export(server_name, vm_parm):
+    # vm-export one vm and return this_status: 'success', 'warning' or 'error'
+    log('*** vm-export begin %s' % vm_parm)
+    beginTime = datetime.datetime.now()
+    this_status = 'success'
+
+    # get values from vdi-export=
+    vm_name = get_vm_name(vm_parm)
+    vm_max_backups = get_vm_max_backups(vm_parm)
+    log('vm-export - vm_name: %s max_backups: %s' % (vm_name, vm_max_backups))
 
-        vm_backup_dir = os.path.join(config['backup_dir'], vm_name) 
-        # cleanup any old unsuccessful backups and create new full_backup_dir
-        full_backup_dir = process_backup_dir(vm_backup_dir)
+    if config_specified:
+        status_log_vm_export_begin(server_name, '%s' % vm_name)
 
-        # gather_vm_meta produces status: empty or warning-message 
-        #   and globals: vm_uuid, xvda_uuid, xvda_uuid
-        vm_meta_status = gather_vm_meta(vm_object, full_backup_dir)
-        if vm_meta_status != '':
-            log('WARNING gather_vm_meta: %s' % vm_meta_status)
-            this_status = 'warning'
-            # non-fatal - finsh processing for this vm
-        # vm-export only uses vm_uuid
-        if vm_uuid == '':
-            log('ERROR gather_vm_meta has no vm-uuid')
-            if config_specified:
-                status_log_vm_export_end(server_name, 'ERROR vm-uuid not found %s' % vm_name)
-            error_cnt += 1
-            # next vm
-            continue
+    phase_begin = begin_phase('lookup')
+    vm_object = verify_vm_name(vm_name)
+    if 'ERROR' in vm_object:
+        log('verify_vm_name: %s' % vm_object)
+        if config_specified:
+            status_log_vm_export_end(server_name, 'ERROR verify_vm_name %s' % vm_name)
+        return 'error'
+    report_phase('lookup', phase_begin)
+
+    vm_backup_dir = os.path.join(config['backup_dir'], vm_name) 
+    # cleanup any old unsuccessful backups and create new full_backup_dir
+    phase_begin = begin_phase('cleanup')
+    full_backup_dir = process_backup_dir(vm_backup_dir)
+    report_phase('cleanup', phase_begin)
+
+    # gather_vm_meta produces status: empty or warning-message 
+    #   and vm_meta: vm_uuid, disks
+    phase_begin = begin_phase('metadata')
+    (vm_meta_status, vm_meta) = gather_vm_meta(vm_object, full_backup_dir)
+    if vm_meta_status != '':
+        log('WARNING gather_vm_meta: %s' % vm_meta_status)
+        this_status = 'warning'
+        # non-fatal - finsh processing for this vm
+    # vm-export only uses vm_uuid
+    vm_uuid = vm_meta['vm_uuid']
+    if vm_uuid == '':
+        log('ERROR gather_vm_meta has no vm-uuid')
+        if config_specified:
+            status_log_vm_export_end(server_name, 'ERROR vm-uuid not found %s' % vm_name)
+        return 'error'
+    report_phase('metadata', phase_begin)
+
+    # ----------------------------------------
+    # --- begin vm-export command sequence ---
+    # note - snapshot, param-set and uninstall go through the xapi session,
+    #   only the export itself runs the xe command
+    log ('*** vm-export begin xe command sequence')
+    session = get_session()
+    # is vm currently running?
+    if session.xenapi.VM.get_power_state(vm_object) == 'Running':
+        log ('vm is running')
+    else:
+        log ('vm is NOT running')
 
-        # ----------------------------------------
-        # --- begin vm-export command sequence ---
-        log ('*** vm-export begin xe command sequence')
-        # is vm currently running?
-        cmd = '%s/xe vm-list name-label="%s" params=power-state | /bin/grep running' % (xe_path, vm_name)
-        if run_log_out_wait_rc(cmd) == 0:
-            log ('vm is running')
-        else:
-            log ('vm is NOT running')
-
-        # check for old vm-snapshot for this vm
-        snap_name = 'RESTORE_%s' % vm_name
-        log ('check for prev-vm-snapshot: %s' % snap_name)
-        cmd = "%s/xe vm-list name-label='%s' params=uuid | /bin/awk -F': ' '{print $2}' | /bin/grep '-'" % (xe_path, snap_name)
-        old_snap_vm_uuid = run_get_lastline(cmd)
-        if old_snap_vm_uuid != '':
+    # check for old vm-snapshot for this vm
+    snap_name = 'RESTORE_%s' % vm_name
+    log ('check for prev-vm-snapshot: %s' % snap_name)
+    phase_begin = begin_phase('snapshot_removal')
+    for old_snap_vm in session.xenapi.VM.get_by_name_label(snap_name):
+        try:
+            old_snap_vm_uuid = session.xenapi.VM.get_uuid(old_snap_vm)
             log ('cleanup old-snap-vm-uuid: %s' % old_snap_vm_uuid)
             # vm-uninstall old vm-snapshot
-            cmd = '%s/xe vm-uninstall uuid=%s force=true' % (xe_path, old_snap_vm_uuid)
-            log('cmd: %s' % cmd)
-            if run_log_out_wait_rc(cmd) != 0:
-                log('WARNING-ERROR %s' % cmd)
-                this_status = 'warning'
-                if config_specified:
-                    status_log_vm_export_end(server_name, 'VM-UNINSTALL-FAIL-1 %s' % vm_name)
-                # non-fatal - finsh processing for this vm
-
-        # === pre_cleanup code goes in here ===
-        #print 'vm_backup_dir: %s' % vm_backup_dir
-        #print 'vm_max_backups: %s' % vm_max_backups
-        if pre_clean:
-           pre_cleanup (vm_backup_dir, vm_max_backups)
-
-        # take a vm-snapshot of this vm
-        cmd = '%s/xe vm-snapshot vm=%s new-name-label="%s"' % (xe_path, vm_uuid, snap_name)
-        log('1.cmd: %s' % cmd)
-        snap_vm_uuid = run_get_lastline(cmd)
-        log ('snap-uuid: %s' % snap_vm_uuid)
-        if snap_vm_uuid == '':
-            log('ERROR %s' % cmd)
-            if config_specified:
-                status_log_vm_export_end(server_name, 'SNAPSHOT-FAIL %s' % vm_name)
-            error_cnt += 1
-            # next vm
-            continue
-
-        # change vm-snapshot so that it can be referenced by vm-export
-        cmd = '%s/xe template-param-set is-a-template=false ha-always-run=false uuid=%s' % (xe_path, snap_vm_uuid)
-        log('2.cmd: %s' % cmd)
-        if run_log_out_wait_rc(cmd) != 0:
-            log('ERROR %s' % cmd)
+            xapi_vm_uninstall(old_snap_vm)
+        except XenAPI.Failure, e:
+            log('WARNING-ERROR vm-uninstall %s - %s' % (old_snap_vm, e))
+            this_status = 'warning'
             if config_specified:
-                status_log_vm_export_end(server_name, 'TEMPLATE-PARAM-SET-FAIL %s' % vm_name)
-            error_cnt += 1
-            # next vm
-            continue
-    
-        # vm-export vm-snapshot
+                status_log_vm_export_end(server_name, 'VM-UNINSTALL-FAIL-1 %s' % vm_name)
+            # non-fatal - finsh processing for this vm
+    report_phase('snapshot_removal', phase_begin)
+
+    # === pre_cleanup code goes in here ===
+    #print 'vm_backup_dir: %s' % vm_backup_dir
+    #print 'vm_max_backups: %s' % vm_max_backups
+    if pre_clean:
+        phase_begin = begin_phase('cleanup')
+        pre_cleanup (vm_backup_dir, vm_max_backups)
+        report_phase('cleanup', phase_begin)
+
+    # take a vm-snapshot of this vm
+    log('1.xapi: VM.snapshot vm=%s new-name-label="%s"' % (vm_uuid, snap_name))
+    phase_begin = begin_phase('snapshot')
+    try:
+        snap_vm = session.xenapi.VM.snapshot(vm_object, snap_name)
+        snap_vm_uuid = session.xenapi.VM.get_uuid(snap_vm)
+    except XenAPI.Failure, e:
+        log('ERROR VM.snapshot %s - %s' % (vm_uuid, e))
+        if config_specified:
+            status_log_vm_export_end(server_name, 'SNAPSHOT-FAIL %s' % vm_name)
+        return 'error'
+    report_phase('snapshot', phase_begin)
+    log ('snap-uuid: %s' % snap_vm_uuid)
+
+    # change vm-snapshot so that it can be referenced by vm-export
+    log('2.xapi: VM.set_is_a_template false uuid=%s' % snap_vm_uuid)
+    phase_begin = begin_phase('param_set')
+    try:
+        xapi_template_param_set(snap_vm)
+    except XenAPI.Failure, e:
+        log('ERROR VM.set_is_a_template %s - %s' % (snap_vm_uuid, e))
+        if config_specified:
+            status_log_vm_export_end(server_name, 'TEMPLATE-PARAM-SET-FAIL %s' % vm_name)
+        return 'error'
+    report_phase('param_set', phase_begin)
+
+    # vm-export vm-snapshot
+    if config['compress_codec'] != 'none':
+        # compress in VmBackup rather than in xapi
+        full_path_backup_file = os.path.join(full_backup_dir, vm_name + '.xva' + COMPRESS_SUFFIX[config['compress_codec']])
+    elif compress:
+        full_path_backup_file = os.path.join(full_backup_dir, vm_name + '.xva.gz')
+    else:
+        full_path_backup_file = os.path.join(full_backup_dir, vm_name + '.xva')
+    if config['backup_store'] == 'chunks':
+        full_path_backup_file += '.manifest'
+    phase_begin = begin_phase('export')
+    xva_validator = None
+    if config['xva_validate'] == 'true':
+        # the xva is checked on its way into the backup file
+        xva_validator = XvaValidator(open_export_file(full_path_backup_file))
+    if config['export_method'] == 'http':
+        query = {'uuid': snap_vm_uuid}
+        if compress and config['compress_codec'] == 'none':
+            query['use_compression'] = 'true'
+        log('3.http: /export uuid=%s compress=%s' % (snap_vm_uuid, compress))
+        export_ok = http_export('/export', query, full_path_backup_file, xva_validator)
+    else:
         cmd = '%s/xe vm-export uuid=%s' % (xe_path, snap_vm_uuid)
+        export_file = full_path_backup_file
+        if config['checksum'] != 'none' or xva_validator is not None or is_throttled():
+            # to stdout, see xe_export
+            export_file = ''
         if compress:
-            full_path_backup_file = os.path.join(full_backup_dir, vm_name + '.xva.gz')
-            cmd = '%s filename="%s" compress=true' % (cmd, full_path_backup_file)
+            cmd = '%s filename="%s" compress=true' % (cmd, export_file)
         else:
-            full_path_backup_file = os.path.join(full_backup_dir, vm_name + '.xva')
-            cmd = '%s filename="%s"' % (cmd, full_path_backup_file) 
+            cmd = '%s filename="%s"' % (cmd, export_file) 
         log('3.cmd: %s' % cmd)
-        if run_log_out_wait_rc(cmd) == 0:
-            log('vm-export success')
+        if xva_validator is not None:
+            export_ok = xe_export(cmd, xva_validator)
+        elif config['checksum'] != 'none' or is_throttled():
+            export_ok = xe_export(cmd, open_export_file(full_path_backup_file))
         else:
-            log('ERROR %s' % cmd)
-            if config_specified:
-                status_log_vm_export_end(server_name, 'VM-EXPORT-FAIL %s' % vm_name)
-            error_cnt += 1
-            # next vm
-            continue
-    
-        # vm-uninstall vm-snapshot
-        cmd = '%s/xe vm-uninstall uuid=%s force=true' % (xe_path, snap_vm_uuid)
-        log('4.cmd: %s' % cmd)
-        if run_log_out_wait_rc(cmd) != 0:
-            log('WARNING %s' % cmd)
-            this_status = 'warning'
-            # non-fatal - finsh processing for this vm
-
-        log ('*** vm-export end')
-        # --- end vm-export command sequence ---
-        # ----------------------------------------
-
-        elapseTime = datetime.datetime.now() - beginTime
-        backup_file_size = os.path.getsize(full_path_backup_file) / (1024 * 1024 * 1024)
-        final_cleanup( full_path_backup_file, backup_file_size, full_backup_dir, vm_backup_dir, vm_max_backups)
-
-        if not check_all_backups_success(vm_backup_dir):
-            log('WARNING cleanup needed - not all backup history is successful')
-            this_status = 'warning'
+            export_ok = (run_log_out_wait_rc(cmd) == 0)
+    if export_ok:
+        log('vm-export success')
+        report_phase('export', phase_begin, get_backup_file_size(full_path_backup_file))
+    else:
+        log('ERROR vm-export %s' % snap_vm_uuid)
+        if config_specified:
+            status_log_vm_export_end(server_name, 'VM-EXPORT-FAIL %s' % vm_name)
+        return 'error'
 
-        if (this_status == 'success'):
-            success_cnt += 1
-            log('VmBackup vm-export %s - ***Success*** t:%s' % (vm_name, str(elapseTime.seconds/60)))
-            if config_specified:
-                status_log_vm_export_end(server_name, 'SUCCESS %s,elapse:%s size:%sG' % (vm_name, str(elapseTime.seconds/60), backup_file_size))
+    # vm-uninstall vm-snapshot
+    log('4.xapi: vm-uninstall uuid=%s' % snap_vm_uuid)
+    phase_begin = begin_phase('snapshot_removal')
+    try:
+        xapi_vm_uninstall(snap_vm)
+    except XenAPI.Failure, e:
+        log('WARNING vm-uninstall %s - %s' % (snap_vm_uuid, e))
+        this_status = 'warning'
+        # non-fatal - finsh processing for this vm
+    report_phase('snapshot_removal', phase_begin)
 
-        elif (this_status == 'warning'):
-            warning_cnt += 1 
-            log('VmBackup vm-export %s - ***WARNING*** t:%s' % (vm_name, str(elapseTime.seconds/60)))
-            if config_specified:
-                status_log_vm_export_end(server_name, 'WARNING %s,elapse:%s size:%sG' % (vm_name, str(elapseTime.seconds/60), backup_file_size))
+    log ('*** vm-export end')
+    # --- end vm-export command sequence ---
+    # ----------------------------------------
 
-        else:
-            # this should never occur since all errors do a continue on to the next vm_name
-            error_cnt += 1
-            log('VmBackup vm-export %s - +++ERROR-INTERNAL+++ t:%s' % (vm_name, str(elapseTime.seconds/60)))
+    if xva_validator is not None:
+        # note - without the success file the backup dir is removed by the next run
+        if xva_validator.error is not None:
+            log('ERROR xva_validate %s - %s' % (full_path_backup_file, xva_validator.error))
             if config_specified:
-                status_log_vm_export_end(server_name, 'ERROR-INTERNAL %s,elapse:%s size:%sG' % (vm_name, str(elapseTime.seconds/60), backup_file_size))
+                status_log_vm_export_end(server_name, 'XVA-INVALID %s' % vm_name)
+            return 'error'
+        log('xva_validate: %s' % xva_validator.summary())
 
-    # end of for vm_parm in config['vm-export']:
-    ######################################################################
+    elapseTime = datetime.datetime.now() - beginTime
+    backup_file_size = get_backup_file_size(full_path_backup_file) / (1024 * 1024 * 1024)
+    phase_begin = begin_phase('cleanup')
+    final_cleanup( full_path_backup_file, backup_file_size, full_backup_dir, vm_backup_dir, vm_max_backups)
 
-    log('===========================')
-    df_snapshots('Space status: df -Th %s' % config['backup_dir'])
+    if not check_all_backups_success(vm_backup_dir):
+        log('WARNING cleanup needed - not all backup history is successful')
+        this_status = 'warning'
+    report_phase('cleanup', phase_begin)
 
-    # gather a final VmBackup.py status
-    summary = 'S:%s W:%s E:%s' % (success_cnt, warning_cnt, error_cnt)
-    status_log = config['status_log']
-    if (error_cnt > 0):
+    if (this_status == 'success'):
+        log('VmBackup vm-export %s - ***Success*** t:%s' % (vm_name, str(elapseTime.seconds/60)))
         if config_specified:
-            status_log_end(server_name, 'ERROR,%s' % summary)
-            # MAIL_ENABLE: optional email may be enabled by uncommenting out the next two lines
-            #send_email(MAIL_TO_ADDR, 'ERROR ' + os.uname()[1] + ' VmBackup.py', status_log)
-            #open('%s' % status_log, 'w').close() # trunc status log after email
-        log('VmBackup ended - **ERRORS DETECTED** - %s' % summary)
-    elif (warning_cnt > 0):
+            status_log_vm_export_end(server_name, 'SUCCESS %s,elapse:%s size:%sG' % (vm_name, str(elapseTime.seconds/60), backup_file_size))
+
+    elif (this_status == 'warning'):
+        log('VmBackup vm-export %s - ***WARNING*** t:%s' % (vm_name, str(elapseTime.seconds/60)))
         if config_specified:
-            status_log_end(server_name, 'WARNING,%s' % summary)
-            # MAIL_ENABLE: optional email may be enabled by uncommenting out the next two lines
-            #send_email(MAIL_TO_ADDR,'WARNING ' + os.uname()[1] + ' VmBackup.py', status_log)
-            #open('%s' % status_log, 'w').close() # trunc status log after email
-        log('VmBackup ended - **WARNING(s)** - %s' % summary)
+            status_log_vm_export_end(server_name, 'WARNING %s,elapse:%s size:%sG' % (vm_name, str(elapseTime.seconds/60), backup_file_size))
+
     else:
+        # this should never occur since all errors return before this point
+        this_status = 'error'
+        log('VmBackup vm-export %s - +++ERROR-INTERNAL+++ t:%s' % (vm_name, str(elapseTime.seconds/60)))
         if config_specified:
-            status_log_end(server_name, 'SUCCESS,%s' % summary)
-            # MAIL_ENABLE: optional email may be enabled by uncommenting out the next two lines
-            #send_email(MAIL_TO_ADDR, 'Success ' + os.uname()[1] + ' VmBackup.py', status_log)
-            #open('%s' % status_log, 'w').close() # trunc status log after email
-        log('VmBackup ended - Success - %s' % summary)
+            status_log_vm_export_end(server_name, 'ERROR-INTERNAL %s,elapse:%s size:%sG' % (vm_name, str(elapseTime.seconds/60), backup_file_size))
+
+    return this_status
+def xapi_template_param_set(snap_vm):
+    # same as: xe template-param-set is-a-template=false ha-always-run=false
+    # note - ha_always_run only exists in older xapi releases
+    session = get_session()
+    session.xenapi.VM.set_is_a_template(snap_vm, False)
+    if session.xenapi.VM.get_record(snap_vm).get('ha_always_run', False):
+        session.xenapi.VM.set_ha_always_run(snap_vm, False)
+
+def xapi_vm_uninstall(snap_vm):
+    # same as: xe vm-uninstall force=true - destroy the vm-snapshot and its disks
+    # note - only VDIs not used by any other VM are destroyed
+    session = get_session()
+    vdis = []
+    for vbd in session.xenapi.VM.get_VBDs(snap_vm):
+        vdi = session.xenapi.VBD.get_VDI(vbd)
+        if vdi == 'OpaqueRef:NULL' or session.xenapi.VBD.get_type(vbd).lower() != 'disk':
+            continue
+        other_vbds = [x for x in session.xenapi.VDI.get_VBDs(vdi) if session.xenapi.VBD.get_VM(x) != snap_vm]
+        if len(other_vbds) == 0:
+            vdis.append(vdi)
+    session.xenapi.VM.destroy(snap_vm)
+    for vdi in vdis:
+        session.xenapi.VDI.destroy(vdi)
+
+def isTimeOfDay(s):
+    # HH:MM, 24:00 is the end of the day
+    m = re.match('^(\d\d?):(\d\d)$', s)
+    return m is not None and int(m.group(2)) < 60 and \
+        (int(m.group(1)) < 24 or (int(m.group(1)) == 24 and int(m.group(2)) == 0))
 
-    # done with main()
-    ######################################################################
 def isInt(s):
     try:
         int(s)
@@ -569,8 +1758,8 @@ def get_vm_name(vm_parm):
         return tmp_vm_name
 
 def verify_vm_name(tmp_vm_name):
-    vm = session.xenapi.VM.get_by_name_label(tmp_vm_name)
-    vmref = [x for x in session.xenapi.VM.get_by_name_label(tmp_vm_name) if not session.xenapi.VM.get_is_a_snapshot(x)]
+    vm = xapi_cache.get_by_name_label('VM', tmp_vm_name)
+    vmref = [x for x in vm if not xapi_cache.get_record('VM', x)['is_a_snapshot']]
     if (len(vmref) > 1):
        log ("ERROR: duplicate VM name found: %s | %s" % (tmp_vm_name, vmref))
        return 'ERROR more than one vm with the name %s' % tmp_vm_name
@@ -579,15 +1768,15 @@ def verify_vm_name(tmp_vm_name):
     return vm[0]
 
 def gather_vm_meta(vm_object, tmp_full_backup_dir):
-    global vm_uuid
-    global xvda_uuid
-    global xvda_name_label
+    # returns (tmp_error, vm_meta) where vm_meta has: vm_uuid and
+    #   disks - list of {'device', 'vdi_uuid', 'name_label'} of each disk vbd
+    # note - no globals here since max_parallel workers run this concurrently
+    # note - all records come from xapi_cache, not a get_record per device
     vm_uuid = ''
-    xvda_uuid = ''
-    xvda_name_label = ''
+    disks = []
     tmp_error = '';
 
-    vm_record = session.xenapi.VM.get_record(vm_object)
+    vm_record = xapi_cache.get_record('VM', vm_object)
     vm_uuid = vm_record['uuid']
 
     log ('Exporting VM metadata XML info')
@@ -631,7 +1820,7 @@ def gather_vm_meta(vm_object, tmp_full_backup_dir):
     vbd_cnt = 0
     for vbd in vm_record['VBDs']:
         log('vbd: %s' % vbd)
-        vbd_record = session.xenapi.VBD.get_record(vbd)  
+        vbd_record = xapi_cache.get_record('VBD', vbd)
         # For each vbd, find out if its a disk
         if vbd_record['type'].lower() != 'disk':
             continue
@@ -643,14 +1832,16 @@ def gather_vm_meta(vm_object, tmp_full_backup_dir):
             tmp_error += 'empty vbd_record[device] on vbd: %s ' % vbd
             # if device is not available then use counter as a alternate reference
             vbd_cnt += 1
-            vbd_record_device = vbd_cnt
+            vbd_record_device = str(vbd_cnt)
 
-        vdi_record = session.xenapi.VDI.get_record(vbd_record['VDI'])
+        vdi_record = xapi_cache.get_record('VDI', vbd_record['VDI'])
         log('disk: %s - begin' % vdi_record['name_label'])
 
         # now write out the vbd info.
         device_path = '%s/DISK-%s' % (tmp_full_backup_dir,  vbd_record_device)
-        os.mkdir(device_path)
+        if not os.path.exists(device_path):
+            # note - exists in a resumed backup
+            os.mkdir(device_path)
         vbd_out = open('%s/vbd.cfg' % device_path, 'w')
         vbd_out.write('userdevice=%s\n' % vbd_record['userdevice'])
         vbd_out.write('bootable=%s\n' % vbd_record['bootable'])
@@ -675,25 +1866,23 @@ def gather_vm_meta(vm_object, tmp_full_backup_dir):
         vdi_out.write('read_only=%s\n' % vdi_record['read_only'])
         # get orig uuid for special metadata disaster recovery
         vdi_out.write('orig_uuid=%s\n' % vdi_record['uuid'])
-        sr_uuid = session.xenapi.SR.get_record(vdi_record['SR'])['uuid']
+        sr_uuid = xapi_cache.get_record('SR', vdi_record['SR'])['uuid']
         vdi_out.write('orig_sr_uuid=%s\n' % sr_uuid)
         # other_config and qos stuff is not backed up
         vdi_out.close()
-        if vbd_record_device == 'xvda':
-            xvda_uuid = vdi_record['uuid']
-            xvda_name_label = vdi_record['name_label']
+        disks.append({'device': vbd_record_device, 'vdi_uuid': vdi_record['uuid'], 'name_label': vdi_record['name_label']})
 
     # Write metadata files for vifs.  These are put in VIFs directory
     log ('Writing VIF info')
     for vif in vm_record['VIFs']:
-        vif_record = session.xenapi.VIF.get_record(vif)
+        vif_record = xapi_cache.get_record('VIF', vif)
         log ('Writing VIF: %s' % vif_record['device'])
         device_path = '%s/VIFs' % tmp_full_backup_dir
         if (not os.path.exists(device_path)):
             os.mkdir(device_path)
         vif_out = open('%s/vif-%s.cfg' % (device_path, vif_record['device']), 'w') 
         vif_out.write('device=%s\n' % vif_record['device'])
-        network_name = session.xenapi.network.get_record(vif_record['network'])['name_label']
+        network_name = xapi_cache.get_record('network', vif_record['network'])['name_label']
         vif_out.write('network_name_label=%s\n' % network_name)
         vif_out.write('MTU=%s\n' % vif_record['MTU'])
         vif_out.write('MAC=%s\n' % vif_record['MAC'])
@@ -701,12 +1890,16 @@ def gather_vm_meta(vm_object, tmp_full_backup_dir):
         vif_out.write('orig_uuid=%s\n' % vif_record['uuid'])
         vif_out.close()
 
-    return tmp_error
+    vm_meta = {'vm_uuid': vm_uuid, 'disks': disks}
+    return (tmp_error, vm_meta)
 
 def final_cleanup( tmp_full_path_backup_file, tmp_backup_file_size, tmp_full_backup_dir, tmp_vm_backup_dir, tmp_vm_max_backups):
     # mark this a successful backup, note: this will 'touch' a file named 'success'
     # if backup size is greater than 60G, then nfs server side compression occurs
-    if tmp_backup_file_size > 60:
+    # note - not if already compressed by compress_codec
+    # note - not for vdi_export_cbt disks, the next delta backups and the
+    #   synthetic full merge need the raw image as it is
+    if tmp_backup_file_size > 60 and config['compress_codec'] == 'none' and not is_cbt_backup_dir(tmp_full_backup_dir):
         log('*** LARGE FILE > 60G: %s : %sG' % (tmp_full_path_backup_file, tmp_backup_file_size))
         # forced compression via background gzip (requires nfs server side script)
         open('%s/success_compress' % tmp_full_backup_dir, 'w').close()
@@ -720,7 +1913,7 @@ def final_cleanup( tmp_full_path_backup_file, tmp_backup_file_size, tmp_full_bac
     while (dir_to_remove):
         log ('Deleting oldest backup %s/%s ' % (tmp_vm_backup_dir, dir_to_remove))
         # remove dir - if throw exception then stop processing
-        shutil.rmtree(tmp_vm_backup_dir + '/' + dir_to_remove)
+        remove_backup_dir(tmp_vm_backup_dir + '/' + dir_to_remove)
         dir_to_remove = get_dir_to_remove(tmp_vm_backup_dir, tmp_vm_max_backups)
 
 ####  need to just feed in directory and find oldest named subdirectory
@@ -740,9 +1933,20 @@ def pre_cleanup(tmp_vm_backup_dir, tmp_vm_max_backups):
      while (dir_to_remove):
         log ('Deleting oldest backup %s/%s ' % (tmp_vm_backup_dir, dir_to_remove))
         # remove dir - if throw exception then stop processing
-        shutil.rmtree(tmp_vm_backup_dir + '/' + dir_to_remove)
+        remove_backup_dir(tmp_vm_backup_dir + '/' + dir_to_remove)
         dir_to_remove = get_dir_to_remove(tmp_vm_backup_dir, tmp_vm_max_backups)
 
+def remove_backup_dir(tmp_backup_dir):
+    # note - with vdi_export_cbt a full backup is first merged into the next delta backup
+    # note - with backup_store=chunks the chunks of the removed backup are
+    #   released by chunkstore_gc at the end of the run
+    global chunkstore_gc_needed
+    if config['backup_store'] == 'chunks':
+        chunkstore_gc_needed = True
+    if config['vdi_export_cbt'] == 'true':
+        cbt_merge_forward(tmp_backup_dir)
+    shutil.rmtree(tmp_backup_dir)
+
 # cleanup old unsuccessful backup and create new full_backup_dir
 def process_backup_dir(tmp_vm_backup_dir):
 
@@ -752,12 +1956,16 @@ def process_backup_dir(tmp_vm_backup_dir):
 
     # if last backup was not successful, then delete it
     log ('Check for last **unsuccessful** backup: %s' % tmp_vm_backup_dir)
+    dir_to_resume = get_last_backup_dir_to_resume(tmp_vm_backup_dir)
+    if (dir_to_resume):
+        log ('Resume last **unsuccessful** backup %s/%s ' % (tmp_vm_backup_dir, dir_to_resume))
+        return os.path.join(tmp_vm_backup_dir, dir_to_resume)
     dir_not_success = get_last_backup_dir_that_failed(tmp_vm_backup_dir)
     if (dir_not_success):
         #if (not os.path.exists(tmp_vm_backup_dir + '/' + dir_not_success + '/fail')):
         log ('Delete last **unsuccessful** backup %s/%s ' % (tmp_vm_backup_dir, dir_not_success))
         # remove last unseccessful backup  - if throw exception then stop processing
-        shutil.rmtree(tmp_vm_backup_dir + '/' + dir_not_success)
+        remove_backup_dir(tmp_vm_backup_dir + '/' + dir_not_success)
 
     # create new backup dir
     return create_full_backup_dir(tmp_vm_backup_dir)
@@ -822,6 +2030,19 @@ def get_last_backup_dir_that_failed(path):
     else:
         return False
 
+def get_last_backup_dir_to_resume(path):
+    # resume_window: the last backup dir if it failed and may be resumed
+    # note - unlike get_last_backup_dir_that_failed also the only backup dir
+    dirs = os.listdir(path)
+    if len(dirs) == 0:
+        return False
+    dirs.sort()
+    # note - a backup dir of an older version has no resume.cfg, so it is never resumed
+    if is_backup_dir_success(os.path.join(path, dirs[-1])) or \
+        not is_backup_dir_resumable(os.path.join(path, dirs[-1])):
+        return False
+    return dirs[-1]
+
 def check_all_backups_success(path):
     # expect at least one backup dir, and all should be successful
     dirs = os.listdir(path)
@@ -836,6 +2057,440 @@ def check_all_backups_success(path):
             return False
     return True
 
+def is_backup_dir_success(tmp_backup_dir):
+    # is tmp_backup_dir a finished backup, see check_all_backups_success
+    for name in ['success', 'success_restore', 'success_compress', 'success_compressing']:
+        if os.path.exists(os.path.join(tmp_backup_dir, name)):
+            return True
+    return False
+
+class VerifyWriter:
+    # verify=: file-like writer that only hashes what it is given,
+    # at the rate of the shared TokenBucket
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.hash = hashlib.sha256()
+
+    def write(self, data):
+        self.bucket.consume(len(data))
+        self.hash.update(data)
+
+def verify_checksum(checksum_path, bucket):
+    # re-hash the backup file of a checksum sidecar
+    # returns 'OK', 'FAILED' or 'MISSING'
+    # note - a backup file gzipped on the nfs server (success_compress) is
+    #   read through gunzip, a chunk manifest through its chunk store
+    (digest, name) = open(checksum_path, 'r').readline().split(None, 1)
+    backup_file = os.path.join(os.path.dirname(checksum_path), name.rstrip('\n'))
+    out = VerifyWriter(bucket)
+    try:
+        if os.path.exists(backup_file):
+            src = open(backup_file, 'rb')
+        elif os.path.exists(backup_file + '.gz'):
+            src = gzip.open(backup_file + '.gz', 'rb')
+        elif os.path.exists(backup_file + '.manifest'):
+            chunkstore_cat(backup_file + '.manifest', out)
+            src = None
+        else:
+            return 'MISSING'
+        if src is not None:
+            try:
+                data = src.read(VERIFY_READ_SIZE)
+                while data:
+                    out.write(data)
+                    data = src.read(VERIFY_READ_SIZE)
+            finally:
+                src.close()
+    except IOError, e:
+        log('ERROR verify %s - %s' % (backup_file, e))
+        return 'FAILED'
+    if out.hash.hexdigest() != digest:
+        return 'FAILED'
+    return 'OK'
+
+def verify_backups(tmp_path, tmp_parallel, tmp_mbps):
+    # verify=: re-hash the backup files that have a checksum sidecar in the
+    # successful backup dirs below tmp_path (backup_dir, a vm dir or a backup dir),
+    # tmp_parallel at a time, reading at most tmp_mbps MB/s together (0 - unlimited)
+    # returns the number of backup files not OK
+    checksum_paths = []
+    for (dir_path, dir_names, file_names) in os.walk(tmp_path):
+        # note - not the chunk store or the shard leases
+        dir_names[:] = sorted([x for x in dir_names if not x.startswith('.')])
+        backup_dir = dir_path
+        if os.path.basename(dir_path).startswith('DISK-'):
+            backup_dir = os.path.dirname(dir_path)
+        for name in sorted(file_names):
+            if not name.endswith(CHECKSUM_SUFFIX):
+                continue
+            if is_backup_dir_success(backup_dir):
+                checksum_paths.append(os.path.join(dir_path, name))
+            else:
+                log('verify: skip %s - backup not successful' % os.path.join(dir_path, name))
+    log('verify: %s backup files below %s, parallel=%s mbps=%s' % (len(checksum_paths), tmp_path, tmp_parallel, tmp_mbps))
+    bucket = TokenBucket(lambda: tmp_mbps * 1024 * 1024)
+    results = collections.Counter()
+    pending = collections.deque(checksum_paths)
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            lock.acquire()
+            try:
+                if not pending:
+                    return
+                checksum_path = pending.popleft()
+            finally:
+                lock.release()
+            result = verify_checksum(checksum_path, bucket)
+            log('verify: %s %s' % (result, checksum_path[:-len(CHECKSUM_SUFFIX)]))
+            lock.acquire()
+            results[result] += 1
+            lock.release()
+
+    threads = [threading.Thread(target=worker) for ix in range(tmp_parallel)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    log('verify: OK:%s FAILED:%s MISSING:%s' % (results['OK'], results['FAILED'], results['MISSING']))
+    return results['FAILED'] + results['MISSING']
+
+def get_restore_jobs(tmp_path, tmp_vm_regex):
+    # restore=: list of (vm_name, backup dir) - the latest successful backup of
+    # each vm below tmp_path (backup_dir, a vm dir or one backup dir) whose vm
+    # name matches tmp_vm_regex (None - all)
+    tmp_path = os.path.abspath(tmp_path)
+    if is_backup_dir_success(tmp_path):
+        return [(os.path.basename(os.path.dirname(tmp_path)), tmp_path)]
+    if [x for x in os.listdir(tmp_path) if x.startswith('backup-')]:
+        vm_dirs = [tmp_path]
+    else:
+        # note - the METADATA_<host> pool_db_backup dirs have no backup dirs
+        vm_dirs = [os.path.join(tmp_path, x) for x in sorted(os.listdir(tmp_path))
+            if not x.startswith('.') and os.path.isdir(os.path.join(tmp_path, x))]
+    jobs = []
+    for vm_dir in vm_dirs:
+        vm_name = os.path.basename(vm_dir)
+        if tmp_vm_regex is not None and not re.match('^(%s)$' % tmp_vm_regex, vm_name):
+            continue
+        dirs = [x for x in sorted(os.listdir(vm_dir)) if is_backup_dir_success(os.path.join(vm_dir, x))]
+        if dirs:
+            jobs.append((vm_name, os.path.join(vm_dir, dirs[-1])))
+    return jobs
+
+def get_imported_vm(result):
+    # the vm (not a snapshot) of the task result of an /import or /import_metadata, None if none
+    session = get_session()
+    for ref in re.findall(r'OpaqueRef:[0-9a-zA-Z-]+', result or ''):
+        if not session.xenapi.VM.get_is_a_snapshot(ref):
+            return ref
+    return None
+
+def restore_vm(vm_name, tmp_backup_dir, sr_ref):
+    # restore=: import the backup in tmp_backup_dir as a new vm
+    # returns 'success', 'warning' or 'error'
+    log('*** restore begin %s from %s' % (vm_name, tmp_backup_dir))
+    beginTime = datetime.datetime.now()
+    try:
+        xva_files = [x for x in sorted(os.listdir(tmp_backup_dir)) if re.search(r'\.xva(\.gz|\.zst|\.lz4)?(\.manifest)?$', x)]
+        if xva_files:
+            this_status = restore_vm_export(os.path.join(tmp_backup_dir, xva_files[0]), sr_ref)
+        else:
+            this_status = restore_vdi_export(tmp_backup_dir, sr_ref)
+    except Exception, e:
+        # e.g. a malformed vdi.cfg - one failed vm must not take down the other workers
+        log('***ERROR EXCEPTION restore %s - %s' % (vm_name, e))
+        for line in traceback.format_exc().splitlines():
+            log(line, False)
+        this_status = 'error'
+    elapseTime = datetime.datetime.now() - beginTime
+    log('VmBackup restore %s - ***%s*** t:%s' % (vm_name, this_status.upper(), str(elapseTime.seconds/60)))
+    return this_status
+
+def restore_vm_export(tmp_full_path_backup_file, sr_ref):
+    # restore a vm-export backup: the xva brings its disks and VIFs along,
+    # VIFs whose network is not the one of VIFs/vif-<device>.cfg are moved
+    session = get_session()
+    log('http: /import %s' % tmp_full_path_backup_file)
+    (src, length) = open_backup_reader(tmp_full_path_backup_file)
+    try:
+        result = http_import('/import', {'sr_id': sr_ref}, src, length)
+    finally:
+        src.close()
+    vm_ref = get_imported_vm(result)
+    if vm_ref is None:
+        log('ERROR /import %s - no vm imported' % tmp_full_path_backup_file)
+        return 'error'
+    log('vm: %s %s' % (session.xenapi.VM.get_name_label(vm_ref), session.xenapi.VM.get_uuid(vm_ref)))
+    if not restore_vifs(vm_ref, os.path.dirname(tmp_full_path_backup_file)):
+        return 'warning'
+    return 'success'
+
+def restore_vdi_export(tmp_backup_dir, sr_ref):
+    # restore a vdi-export backup: each DISK-<device> backup file is imported
+    # into a new VDI, then the vm is created from vm-metadata.xml with its
+    # VBDs mapped to the new VDIs, and the disks of the DISK-<device>/vbd.cfg
+    # files and the VIFs of the VIFs/vif-<device>.cfg files are (re)attached
+    session = get_session()
+    this_status = 'success'
+    disks = []
+    try:
+        for disk_dir in sorted(os.listdir(tmp_backup_dir)):
+            disk_path = os.path.join(tmp_backup_dir, disk_dir)
+            if not disk_dir.startswith('DISK-'):
+                continue
+            vdi_cfg = read_disk_cfg(disk_path, 'vdi.cfg')
+            vbd_cfg = read_disk_cfg(disk_path, 'vbd.cfg')
+            backup_file = get_disk_backup_file(tmp_backup_dir, disk_dir)
+            if vdi_cfg is None or vbd_cfg is None or backup_file is None:
+                # note - not exported with vdi-export=vm-name:disks=...
+                log('%s: no backup file - not restored' % disk_dir)
+                continue
+            disk = restore_vdi(backup_file, vdi_cfg, sr_ref)
+            if disk is None:
+                restore_destroy_vdis(disks)
+                return 'error'
+            disk['vbd_cfg'] = vbd_cfg
+            disks.append(disk)
+    except Exception:
+        # the disks imported so far would be left orphaned on the sr
+        restore_destroy_vdis(disks)
+        raise
+
+    restored = ', '.join(['%s %s' % (x['vbd_cfg']['userdevice'], x['vdi_uuid']) for x in disks])
+    meta_path = os.path.join(tmp_backup_dir, 'vm-metadata.xml')
+    if not os.path.exists(meta_path) or os.path.getsize(meta_path) == 0:
+        log('ERROR %s not found - removing the restored disks: %s' % (meta_path, restored))
+        restore_destroy_vdis(disks)
+        return 'error'
+    # a metadata only xva of the vm-metadata.xml, see gather_vm_meta
+    # note - xmllint -format indentation is removed again
+    ova_xml = re.sub(r'>\s+<', '><', open(meta_path, 'r').read())
+    info = tarfile.TarInfo('ova.xml')
+    info.size = len(ova_xml)
+    info.mtime = int(time.time())
+    xva = info.tobuf(tarfile.USTAR_FORMAT) + ova_xml + '\0' * ((512 - len(ova_xml) % 512) % 512) + '\0' * 1024
+    query = {'force': 'true'}
+    for disk in disks:
+        query['vdi:%s' % disk['orig_uuid']] = disk['vdi_uuid']
+    log('http: /import_metadata %s' % meta_path)
+    try:
+        vm_ref = get_imported_vm(http_import('/import_metadata', query, StringIO.StringIO(xva), len(xva)))
+    except Exception:
+        restore_destroy_vdis(disks)
+        raise
+    if vm_ref is None:
+        log('ERROR /import_metadata %s - no vm imported, removing the restored disks: %s' % (meta_path, restored))
+        restore_destroy_vdis(disks)
+        return 'error'
+    log('vm: %s %s' % (session.xenapi.VM.get_name_label(vm_ref), session.xenapi.VM.get_uuid(vm_ref)))
+    restore_vbds(vm_ref, disks)
+    if not restore_vifs(vm_ref, tmp_backup_dir):
+        this_status = 'warning'
+    return this_status
+
+def get_disk_backup_file(tmp_backup_dir, disk_dir):
+    # the vdi-export backup file of a DISK-<device> directory, None if none
+    # note - a backup of an older version only has DISK-xvda exported, into
+    #   <backup dir>/<vm-name>.raw|vhd (gzipped if success_compress)
+    pattern = r'\.(raw|vhd)(\.gz|\.zst|\.lz4)?(\.manifest)?(\.delta)?$'
+    backup_files = [x for x in os.listdir(os.path.join(tmp_backup_dir, disk_dir)) if re.search(pattern, x)]
+    if len(backup_files) == 1:
+        return os.path.join(tmp_backup_dir, disk_dir, backup_files[0])
+    if disk_dir == 'DISK-xvda' and len(backup_files) == 0:
+        backup_files = [x for x in os.listdir(tmp_backup_dir) if re.search(r'\.(raw|vhd)(\.gz)?$', x)]
+        if len(backup_files) == 1:
+            return os.path.join(tmp_backup_dir, backup_files[0])
+    return None
+
+def restore_vdi(tmp_full_path_backup_file, vdi_cfg, sr_ref):
+    # import a DISK-<device> backup file into a new VDI of sr_ref like vdi.cfg
+    # returns {'vdi', 'vdi_uuid', 'orig_uuid'}, None if the import failed
+    # note - a vdi_export_cbt delta is first made a full raw image beside it, see cbt_restore
+    session = get_session()
+    vdi_format = re.search(r'\.(raw|vhd)', tmp_full_path_backup_file).group(1)
+    vdi = session.xenapi.VDI.create({'name_label': vdi_cfg['name_label'].decode('utf-8'),
+        'name_description': vdi_cfg['name_description'].decode('utf-8'), 'SR': sr_ref,
+        'virtual_size': vdi_cfg['virtual_size'], 'type': vdi_cfg['type'], 'sharable': vdi_cfg['sharable'] == 'True',
+        'read_only': False, 'other_config': {}, 'xenstore_data': {}, 'sm_config': {}, 'tags': []})
+    vdi_uuid = session.xenapi.VDI.get_uuid(vdi)
+    log('VDI.create %s virtual_size=%s uuid=%s' % (vdi_cfg['name_label'], vdi_cfg['virtual_size'], vdi_uuid))
+    disk = {'vdi': vdi, 'vdi_uuid': vdi_uuid, 'orig_uuid': vdi_cfg['orig_uuid']}
+    restore_file = None
+    try:
+        if tmp_full_path_backup_file.endswith('.delta'):
+            restore_file = tmp_full_path_backup_file[:-len('.delta')] + '.restore'
+            cbt_restore(os.path.dirname(tmp_full_path_backup_file), restore_file)
+            tmp_full_path_backup_file = restore_file
+        log('http: /import_raw_vdi %s format=%s' % (tmp_full_path_backup_file, vdi_format))
+        (src, length) = open_backup_reader(tmp_full_path_backup_file)
+        try:
+            result = http_import('/import_raw_vdi', {'vdi': vdi_uuid, 'format': vdi_format}, src, length)
+        finally:
+            src.close()
+    except Exception:
+        restore_destroy_vdis([disk])
+        raise
+    finally:
+        if restore_file is not None and os.path.exists(restore_file):
+            os.remove(restore_file)
+    if result is None:
+        log('ERROR /import_raw_vdi %s' % tmp_full_path_backup_file)
+        restore_destroy_vdis([disk])
+        return None
+    return disk
+
+def restore_destroy_vdis(disks):
+    # remove the VDIs of a failed restore from the sr
+    session = get_session()
+    for disk in disks:
+        log('VDI.destroy %s - restore failed' % disk['vdi_uuid'])
+        try:
+            session.xenapi.VDI.destroy(disk['vdi'])
+        except XenAPI.Failure, e:
+            log('WARNING VDI.destroy %s - %s' % (disk['vdi_uuid'], e))
+
+def restore_vbds(vm_ref, disks):
+    # attach the restored disks to vm_ref at their vbd.cfg userdevice, unless
+    # /import_metadata already did. A VBD at that userdevice with another VDI
+    # (e.g. the original disk, if it still exists) is removed first.
+    session = get_session()
+    attached = []
+    userdevices = [x['vbd_cfg']['userdevice'] for x in disks]
+    for vbd in session.xenapi.VM.get_VBDs(vm_ref):
+        vbd_record = session.xenapi.VBD.get_record(vbd)
+        if vbd_record['type'].lower() != 'disk':
+            continue
+        if vbd_record['VDI'] in [x['vdi'] for x in disks]:
+            attached.append(vbd_record['VDI'])
+        elif vbd_record['userdevice'] in userdevices:
+            log('VBD.destroy userdevice=%s - not the restored disk' % vbd_record['userdevice'])
+            session.xenapi.VBD.destroy(vbd)
+    for disk in disks:
+        if disk['vdi'] in attached:
+            continue
+        vbd_cfg = disk['vbd_cfg']
+        log('VBD.create userdevice=%s vdi=%s' % (vbd_cfg['userdevice'], disk['vdi_uuid']))
+        session.xenapi.VBD.create({'VM': vm_ref, 'VDI': disk['vdi'], 'userdevice': vbd_cfg['userdevice'],
+            'bootable': vbd_cfg['bootable'] == 'True', 'mode': vbd_cfg['mode'], 'type': vbd_cfg['type'],
+            'unpluggable': vbd_cfg['unpluggable'] == 'True', 'empty': False, 'other_config': {},
+            'qos_algorithm_type': '', 'qos_algorithm_params': {}})
+
+def restore_vifs(vm_ref, tmp_backup_dir):
+    # attach a VIF like each VIFs/vif-<device>.cfg to the network of that
+    # name_label, keeping its MAC and MTU, unless the vm has it already
+    # returns False if a network was not found
+    # note - other_config is not restored
+    session = get_session()
+    vifs_dir = os.path.join(tmp_backup_dir, 'VIFs')
+    if not os.path.isdir(vifs_dir):
+        return True
+    vm_vifs = {}
+    for vif in session.xenapi.VM.get_VIFs(vm_ref):
+        vm_vifs[session.xenapi.VIF.get_device(vif)] = vif
+    vifs_ok = True
+    for name in sorted(os.listdir(vifs_dir)):
+        vif_cfg = read_disk_cfg(vifs_dir, name)
+        networks = session.xenapi.network.get_by_name_label(vif_cfg['network_name_label'])
+        if not networks:
+            log('WARNING VIF %s - network not found: %s' % (vif_cfg['device'], vif_cfg['network_name_label']))
+            vifs_ok = False
+            continue
+        vif = vm_vifs.get(vif_cfg['device'])
+        if vif is not None and session.xenapi.VIF.get_network(vif) in networks:
+            continue
+        if vif is not None:
+            log('VIF.destroy device=%s - not on network %s' % (vif_cfg['device'], vif_cfg['network_name_label']))
+            session.xenapi.VIF.destroy(vif)
+        log('VIF.create device=%s network=%s MAC=%s' % (vif_cfg['device'], vif_cfg['network_name_label'], vif_cfg['MAC']))
+        session.xenapi.VIF.create({'device': vif_cfg['device'], 'network': networks[0], 'VM': vm_ref,
+            'MAC': vif_cfg['MAC'], 'MTU': vif_cfg['MTU'], 'other_config': {},
+            'qos_algorithm_type': '', 'qos_algorithm_params': {}})
+    return vifs_ok
+
+def restore_main(tmp_path, tmp_vm_regex, tmp_sr, tmp_max_parallel, tmp_preview):
+    # restore=: restore the latest backup of each vm below tmp_path into sr tmp_sr
+    # (name-label or uuid, None - the pool default SR) on tmp_max_parallel worker
+    # threads, with throttle_mbps shared by all imports
+    # returns the number of vms that failed
+    session = get_session()
+    jobs = get_restore_jobs(tmp_path, tmp_vm_regex)
+    log('restore: %s vms below %s' % (len(jobs), tmp_path))
+    for (vm_name, backup_dir) in jobs:
+        log('  %s: %s' % (vm_name, backup_dir))
+    if tmp_sr is None:
+        sr_refs = [session.xenapi.pool.get_default_SR(session.xenapi.pool.get_all()[0])]
+        sr_refs = [x for x in sr_refs if x != 'OpaqueRef:NULL']
+        tmp_sr = 'pool default sr'
+    else:
+        sr_refs = [ref for (ref, record) in session.xenapi.SR.get_all_records().items() if record['uuid'] == tmp_sr]
+        if not sr_refs:
+            sr_refs = session.xenapi.SR.get_by_name_label(tmp_sr)
+    if len(sr_refs) != 1:
+        log('ERROR restore - sr %s: %s found, use sr=<sr-uuid>' % (tmp_sr, len(sr_refs)))
+        return len(jobs)
+    sr_ref = sr_refs[0]
+    log('restore: sr %s max_parallel=%s throttle_mbps=%s' % (session.xenapi.SR.get_name_label(sr_ref), tmp_max_parallel, config['throttle_mbps']))
+    if tmp_preview:
+        return 0
+
+    start_throttle()
+    beginTime = datetime.datetime.now()
+    pending = collections.deque(jobs)
+    results = collections.Counter()
+    lock = threading.Lock()
+
+    def worker():
+        try:
+            if tmp_max_parallel > 1:
+                thread_data.session = None
+                try:
+                    thread_data.session = xapi_login()
+                except Exception, e:
+                    # note - its restores are left to the other workers
+                    log('ERROR xapi login for %s - %s' % (threading.currentThread().getName(), e))
+                    return
+            while True:
+                lock.acquire()
+                try:
+                    if not pending:
+                        return
+                    (vm_name, backup_dir) = pending.popleft()
+                finally:
+                    lock.release()
+                if tmp_max_parallel > 1:
+                    thread_data.vm_name = vm_name
+                try:
+                    this_status = restore_vm(vm_name, backup_dir, sr_ref)
+                finally:
+                    thread_data.vm_name = None
+                lock.acquire()
+                results[this_status] += 1
+                lock.release()
+        finally:
+            if tmp_max_parallel > 1 and thread_data.session is not None:
+                xapi_logout(thread_data.session)
+                thread_data.session = None
+
+    workers = []
+    for ix in range(min(tmp_max_parallel, len(jobs))):
+        t = threading.Thread(target=worker, name='restore-%s' % (ix + 1))
+        t.setDaemon(True)
+        workers.append(t)
+        t.start()
+    for t in workers:
+        # join with timeout so that ctrl-c is still delivered to the main thread
+        while t.isAlive():
+            t.join(5)
+    for (vm_name, backup_dir) in pending:
+        log('ERROR restore %s - not restored, no worker could log in' % backup_dir)
+        results['error'] += 1
+    elapseTime = datetime.datetime.now() - beginTime
+    log('restore ended - S:%s W:%s E:%s t:%s' % (results['success'], results['warning'], results['error'], str(elapseTime.seconds/60)))
+    return results['error'] + len(jobs) - sum(results.values())
+
 def backup_pool_metadata(svr_name):
 
     # xe-backup-metadata can only run on master
@@ -854,6 +2509,1410 @@ def backup_pool_metadata(svr_name):
 
     return True
 
+def http_export(url_path, query, tmp_full_path_backup_file, out=None, sparse=False, resume=None):
+    # export_method=http: stream a xapi export handler (/export or
+    # /export_raw_vdi) straight into tmp_full_path_backup_file,
+    # or into the out writer if given
+    # sparse - raw data, see open_export_file
+    # resume - resume_window, see get_export_resume
+    # returns True if all data was written and the xapi task succeeded
+    # note - if the data lives on another pool member xapi redirects, which urllib2 follows
+    session = get_session()
+    try:
+        task = session.xenapi.task.create('VmBackup %s' % url_path, os.path.basename(tmp_full_path_backup_file))
+    except XenAPI.Failure, e:
+        log('ERROR task.create - %s' % e)
+        return False
+    try:
+        params = dict(query)
+        params['task_id'] = task
+        log('http GET %s%s?%s' % (session.xapi_url.rstrip('/'), url_path, urllib.urlencode(params)))
+        # note - session_id is not logged
+        params['session_id'] = session._session
+        url = '%s%s?%s' % (session.xapi_url.rstrip('/'), url_path, urllib.urlencode(params))
+        request = urllib2.Request(url)
+        if resume is not None and resume['offset'] > 0:
+            # only needs to send the data after the checkpoint, if xapi supports it
+            request.add_header('Range', 'bytes=%s-' % resume['offset'])
+        try:
+            src = urllib2.urlopen(request)
+            try:
+                content_length = src.info().getheader('Content-Length')
+                if out is None and resume is not None:
+                    if resume['offset'] == 0:
+                        out = checksum_writer(resume['open_rest'](0, 0), tmp_full_path_backup_file)
+                    elif src.getcode() == 206:
+                        log('resume: range request - continue at %sM' % (resume['offset'] / (1024 * 1024)))
+                        out = resume['open_rest'](resume['offset'], len(resume['segments']))
+                        # note - the data before the checkpoint does not go through a HashWriter
+                        if config['checksum'] != 'none':
+                            log('WARNING checksum - no checksum of a range resumed export')
+                            if os.path.exists(get_checksum_path(tmp_full_path_backup_file)):
+                                os.remove(get_checksum_path(tmp_full_path_backup_file))
+                    else:
+                        # note - the whole export goes through the ResumeWriter
+                        out = checksum_writer(ResumeWriter(resume['segments'], resume['open_rest']), tmp_full_path_backup_file)
+                if out is None:
+                    out = open_export_file(tmp_full_path_backup_file, sparse)
+                total = stream_to_file(src, out, int(config['export_chunk_size']) * 1024)
+            finally:
+                src.close()
+        except (urllib2.URLError, socket.error, IOError), e:
+            log('ERROR http export %s - %s' % (url_path, e))
+            return False
+        if content_length is not None and int(content_length) != total:
+            log('ERROR http export %s - short read %s of %s bytes' % (url_path, total, content_length))
+            return False
+        return wait_task_success(task)
+    finally:
+        try:
+            session.xenapi.task.destroy(task)
+        except XenAPI.Failure, e:
+            log('WARNING task.destroy - %s' % e)
+
+def http_import(url_path, query, src, length=None):
+    # restore: stream src into a xapi import handler (/import, /import_metadata
+    # or /import_raw_vdi) with an http PUT, throttled like the exports
+    # length - bytes of src, if not known the request ends when the connection
+    #   is shut down for writing, like xe vm-import filename=/dev/stdin
+    # returns the result of the xapi task, None if the import failed
+    session = get_session()
+    try:
+        task = session.xenapi.task.create('VmBackup %s' % url_path, '')
+    except XenAPI.Failure, e:
+        log('ERROR task.create - %s' % e)
+        return None
+    try:
+        params = dict(query)
+        params['task_id'] = task
+        log('http PUT %s%s?%s' % (session.xapi_url.rstrip('/'), url_path, urllib.urlencode(params)))
+        # note - session_id is not logged
+        params['session_id'] = session._session
+        url = urlparse.urlparse(session.xapi_url)
+        if url.scheme == 'https':
+            conn = httplib.HTTPSConnection(url.netloc)
+        else:
+            conn = httplib.HTTPConnection(url.netloc)
+        total = 0
+        begin = time.time()
+        last_progress = begin
+        try:
+            conn.putrequest('PUT', '%s?%s' % (url_path, urllib.urlencode(params)))
+            if length is not None:
+                conn.putheader('Content-Length', str(length))
+            conn.endheaders()
+            data = src.read(int(config['export_chunk_size']) * 1024)
+            while data:
+                throttle(len(data))
+                conn.send(data)
+                total += len(data)
+                now = time.time()
+                if now - last_progress >= EXPORT_PROGRESS_SECS:
+                    log('import progress: %sM %sMB/s' % (total / (1024 * 1024), mb_per_sec(total, now - begin)))
+                    last_progress = now
+                data = src.read(int(config['export_chunk_size']) * 1024)
+            if length is None:
+                conn.sock.shutdown(socket.SHUT_WR)
+            response = conn.getresponse()
+            response.read()
+        except (httplib.HTTPException, socket.error, IOError), e:
+            log('ERROR http import %s - %s' % (url_path, e))
+            return None
+        finally:
+            conn.close()
+        if response.status != 200:
+            log('ERROR http import %s - %s %s' % (url_path, response.status, response.reason))
+            return None
+        log('import done: %sM %sMB/s' % (total / (1024 * 1024), mb_per_sec(total, time.time() - begin)))
+        if not wait_task_success(task):
+            return None
+        return session.xenapi.task.get_result(task)
+    finally:
+        try:
+            session.xenapi.task.destroy(task)
+        except XenAPI.Failure, e:
+            log('WARNING task.destroy - %s' % e)
+
+def open_export_file(tmp_full_path_backup_file, sparse=False):
+    # writer for the export data: the backup file, through the
+    # compress_codec pipeline if configured
+    # or with backup_store=chunks the chunk store and its manifest file
+    # sparse - raw disk data, a plain backup file skips its zero blocks
+    # note - with checksum the bytes of the backup file are hashed, after
+    #   compression, for a manifest the original export
+    if config['backup_store'] == 'chunks':
+        return checksum_writer(ChunkStoreWriter(tmp_full_path_backup_file, os.path.join(config['backup_dir'], CHUNKSTORE_DIR)),
+            tmp_full_path_backup_file)
+    out = checksum_writer(open(tmp_full_path_backup_file, 'wb'), tmp_full_path_backup_file)
+    if config['compress_codec'] != 'none':
+        out = CompressWriter(out, config['compress_codec'], int(config['compress_level']))
+    elif sparse:
+        out = SparseWriter(out)
+    return out
+
+class SparseWriter:
+    # file-like writer for raw disk data: all-zero SPARSE_BLOCK_SIZE blocks
+    # are seeked over instead of written, so the backup file is sparse and
+    # only the allocated blocks of a thin disk go over nfs
+    # note - the file is truncated to its full size on close, since it may end in a hole
+
+    def __init__(self, out):
+        self.out = out
+        self.pending = ''
+        self.allocated = 0
+
+    def write(self, data):
+        if self.pending:
+            data = self.pending + data
+        end = len(data) - len(data) % SPARSE_BLOCK_SIZE
+        for pos in range(0, end, SPARSE_BLOCK_SIZE):
+            block = data[pos:pos + SPARSE_BLOCK_SIZE]
+            if block == SPARSE_ZERO_BLOCK:
+                self.out.seek(SPARSE_BLOCK_SIZE, 1)
+            else:
+                self.out.write(block)
+                self.allocated += SPARSE_BLOCK_SIZE
+        self.pending = data[end:]
+
+    def close(self):
+        if self.pending.count('\0') == len(self.pending):
+            self.out.seek(len(self.pending), 1)
+        else:
+            self.out.write(self.pending)
+            self.allocated += len(self.pending)
+        self.pending = ''
+        self.out.truncate()
+        self.out.close()
+
+class HashWriter:
+    # checksum=sha256: file-like writer that hashes the data on its way to
+    # out, so the checksum costs no second read of the backup file. A seek
+    # over a hole of the SparseWriter is hashed as zeros. On close the digest
+    # is written to the checksum sidecar of backup_file, see get_checksum_path
+
+    def __init__(self, out, backup_file):
+        self.out = out
+        self.backup_file = backup_file
+        self.hash = hashlib.sha256()
+
+    def write(self, data):
+        self.hash.update(data)
+        self.out.write(data)
+
+    def seek(self, offset, whence):
+        # note - only relative and forward, see SparseWriter
+        left = offset
+        while left > 0:
+            self.hash.update(SPARSE_ZERO_BLOCK[:min(left, SPARSE_BLOCK_SIZE)])
+            left -= SPARSE_BLOCK_SIZE
+        self.out.seek(offset, whence)
+
+    def truncate(self):
+        self.out.truncate()
+
+    def close(self):
+        self.out.close()
+        checksum_path = get_checksum_path(self.backup_file)
+        # sha256sum format, so that 'sha256sum -c' also checks a plain backup file
+        open(checksum_path, 'w').write('%s  %s\n' % (self.hash.hexdigest(), os.path.basename(checksum_path)[:-len(CHECKSUM_SUFFIX)]))
+        log('checksum: sha256 %s' % self.hash.hexdigest())
+
+def checksum_writer(out, tmp_full_path_backup_file):
+    # out, through a HashWriter with checksum=sha256
+    if config['checksum'] == 'sha256':
+        return HashWriter(out, tmp_full_path_backup_file)
+    return out
+
+def get_checksum_path(tmp_full_path_backup_file):
+    # checksum sidecar of a backup file, for a chunk manifest that of the original export
+    if tmp_full_path_backup_file.endswith('.manifest'):
+        tmp_full_path_backup_file = tmp_full_path_backup_file[:-len('.manifest')]
+    return tmp_full_path_backup_file + CHECKSUM_SUFFIX
+
+class XvaValidator:
+    # xva_validate: file-like writer that passes the export stream of a
+    # vm-export on to out (if not None) and checks on the way that it is a
+    # complete xva: a tar whose first member is ova.xml, whose Ref:<vdi>/<chunk>
+    # members belong to a VDI of ova.xml, come in order, lie within its
+    # virtual_size and match the sha1 of their .checksum member, and that ends
+    # with the two tar end blocks. A gzip stream (compress=true) is checked
+    # uncompressed. No data is kept but ova.xml and the current tar header.
+    # error - None for a valid xva, once closed
+    # note - chunks with a .xxhash member (newer xapi) are counted unverified
+
+    def __init__(self, out):
+        self.out = out
+        self.error = None
+        self.gunzip = None
+        self.started = False
+        self.header = ''
+        self.member = None
+        self.left = 0
+        self.skip = 0
+        self.end_blocks = 0
+        self.ova_xml = None
+        self.vdis = {}
+        self.last_chunk = {}
+        self.chunk = None
+        self.chunk_hash = None
+        self.member_buf = []
+        self.chunks = 0
+        self.unverified = 0
+
+    def write(self, data):
+        if self.out is not None:
+            self.out.write(data)
+        if not self.started and data:
+            self.started = True
+            if data.startswith('\x1f\x8b'):
+                self.gunzip = zlib.decompressobj(31)
+        if self.gunzip is not None:
+            data = self.decompress(data)
+        self.feed(data)
+
+    def decompress(self, data):
+        # note - the stream may be several gzip members, see compress_block
+        result = self.gunzip.decompress(data)
+        while self.gunzip.unused_data:
+            rest = self.gunzip.unused_data
+            self.gunzip = zlib.decompressobj(31)
+            result += self.gunzip.decompress(rest)
+        return result
+
+    def feed(self, data):
+        pos = 0
+        while pos < len(data) and self.error is None and self.end_blocks < 2:
+            if self.left > 0:
+                take = min(self.left, len(data) - pos)
+                self.member_data(data[pos:pos + take])
+                pos += take
+                self.left -= take
+                if self.left == 0:
+                    self.member_end()
+            elif self.skip > 0:
+                take = min(self.skip, len(data) - pos)
+                pos += take
+                self.skip -= take
+            else:
+                take = 512 - len(self.header)
+                self.header += data[pos:pos + take]
+                pos += take
+                if len(self.header) == 512:
+                    self.parse_header(self.header)
+                    self.header = ''
+
+    def parse_header(self, header):
+        if header == '\0' * 512:
+            self.end_blocks += 1
+            return
+        if self.end_blocks > 0:
+            self.error = 'tar member after the end block'
+            return
+        try:
+            stored = int(header[148:156].strip('\0 ') or '0', 8)
+            size = int(header[124:136].strip('\0 ') or '0', 8)
+        except ValueError:
+            self.error = 'tar header not valid after %s' % self.member
+            return
+        if stored != sum([ord(c) for c in header[:148]]) + 8 * 32 + sum([ord(c) for c in header[156:]]):
+            self.error = 'tar header checksum wrong after %s' % self.member
+            return
+        name = header[:100].split('\0')[0]
+        if header[257:262] == 'ustar' and header[345] != '\0':
+            name = header[345:500].split('\0')[0] + '/' + name
+        if header[156] not in ['0', '\0']:
+            self.error = 'tar member %s is not a file' % name
+            return
+        self.member = name
+        self.left = size
+        self.skip = (512 - size % 512) % 512
+        self.member_begin(name, size)
+        if size == 0 and self.error is None:
+            self.member_end()
+
+    def member_begin(self, name, size):
+        if self.ova_xml is None and name != 'ova.xml':
+            self.error = 'first member %s, not ova.xml' % name
+            return
+        if name == 'ova.xml':
+            self.ova_xml = []
+            return
+        if self.chunk is not None:
+            if name in [self.chunk + '.checksum', self.chunk + '.xxhash']:
+                self.member_buf = []
+            else:
+                self.error = 'chunk %s has no checksum' % self.chunk
+            return
+        match = re.match(r'^(Ref:[^/]+)/(\d{8})$', name)
+        if match is None:
+            self.error = 'unexpected member %s' % name
+            return
+        (vdi, chunk) = (match.group(1), int(match.group(2)))
+        if vdi not in self.vdis:
+            self.error = 'chunk %s of a VDI not in ova.xml' % name
+        elif chunk <= self.last_chunk.get(vdi, -1):
+            self.error = 'chunk %s out of order' % name
+        elif chunk * XVA_CHUNK_SIZE + size > self.vdis[vdi]:
+            self.error = 'chunk %s beyond the virtual_size %s' % (name, self.vdis[vdi])
+        self.last_chunk[vdi] = chunk
+        self.chunk = name
+        self.chunk_hash = hashlib.sha1()
+
+    def member_data(self, data):
+        if self.member == 'ova.xml' or self.member.endswith('.checksum') or self.member.endswith('.xxhash'):
+            self.member_buf.append(data)
+        else:
+            self.chunk_hash.update(data)
+
+    def member_end(self):
+        if self.member == 'ova.xml':
+            self.ova_xml = ''.join(self.member_buf)
+            self.member_buf = []
+            self.parse_ova_xml()
+        elif self.member.endswith('.checksum'):
+            if ''.join(self.member_buf).strip() != self.chunk_hash.hexdigest():
+                self.error = 'chunk %s sha1 does not match its checksum' % self.chunk
+            self.chunks += 1
+            self.chunk = None
+        elif self.member.endswith('.xxhash'):
+            self.chunks += 1
+            self.unverified += 1
+            self.chunk = None
+
+    def parse_ova_xml(self):
+        # ova.xml is an xml-rpc value: objects is the list of the exported
+        # xapi records, the chunks of a VDI are stored below its id
+        try:
+            body = re.sub(r'^\s*<\?xml[^>]*\?>', '', self.ova_xml)
+            (ova,) = xmlrpclib.loads('<methodResponse><params><param>%s</param></params></methodResponse>' % body)[0]
+            for obj in ova.get('objects', []):
+                if obj['class'] == 'VDI':
+                    self.vdis[obj['id']] = int(obj['snapshot']['virtual_size'])
+        except Exception, e:
+            self.error = 'ova.xml not valid - %s' % e
+
+    def close(self):
+        if self.out is not None:
+            self.out.close()
+        if self.error is None and (self.ova_xml is None or self.chunk is not None or self.end_blocks < 2):
+            self.error = 'truncated after %s' % self.member
+
+    def summary(self):
+        return 'valid xva, %s VDIs, %s chunks (%s unverified)' % (len(self.vdis), self.chunks, self.unverified)
+
+def validate_xva_file(tmp_xva_file):
+    # validate-xva=: check an xva file (memory-mapped) or - stdin with XvaValidator
+    # returns the XvaValidator, closed
+    validator = XvaValidator(None)
+    if tmp_xva_file == '-':
+        data = sys.stdin.read(VERIFY_READ_SIZE)
+        while data:
+            validator.write(data)
+            data = sys.stdin.read(VERIFY_READ_SIZE)
+    elif os.path.getsize(tmp_xva_file) > 0:
+        src = open(tmp_xva_file, 'rb')
+        try:
+            data = mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for pos in range(0, len(data), VERIFY_READ_SIZE):
+                    validator.write(data[pos:pos + VERIFY_READ_SIZE])
+            finally:
+                data.close()
+        finally:
+            src.close()
+    validator.close()
+    return validator
+
+class TokenBucket:
+    # rate governor for the export data path: consume(n) returns once n bytes
+    # fit into get_rate() bytes/s (0 - unlimited), with up to one second of burst
+    # note - a caller over the budget takes the debt and sleeps it off outside
+    #   the lock, so concurrent exports share the rate
+
+    def __init__(self, get_rate):
+        self.get_rate = get_rate
+        self.lock = threading.Lock()
+        self.tokens = 0.0
+        self.last = time.time()
+
+    def consume(self, nbytes):
+        self.lock.acquire()
+        try:
+            rate = self.get_rate()
+            now = time.time()
+            if rate <= 0:
+                self.tokens = 0.0
+                self.last = now
+                return
+            self.tokens = min(rate, self.tokens + (now - self.last) * rate) - nbytes
+            self.last = now
+            wait = -self.tokens / rate
+        finally:
+            self.lock.release()
+        if wait > 0:
+            time.sleep(wait)
+
+def get_throttle_rate():
+    # bytes/s cap of all exports now: the first throttle_window=HH:MM-HH:MM:MBps
+    # that covers the time of day, else throttle_mbps
+    local = time.localtime()
+    minutes = local.tm_hour * 60 + local.tm_min
+    for throttle_window in config['throttle_window']:
+        (window, mbps) = throttle_window.rsplit(':', 1)
+        (window_start, window_end) = window.split('-')
+        if is_time_in_window(minutes, window_start, window_end):
+            return float(mbps) * 1024 * 1024
+    return float(config['throttle_mbps']) * 1024 * 1024
+
+def is_throttled():
+    # is a throttle_mbps, throttle_mbps_job or throttle_window cap set
+    # note - an export_method=xe export then streams through xe_export
+    return float(config['throttle_mbps']) > 0 or float(config['throttle_mbps_job']) > 0 \
+        or len(config['throttle_window']) > 0
+
+def start_throttle():
+    global global_throttle
+    if float(config['throttle_mbps']) > 0 or len(config['throttle_window']) > 0:
+        global_throttle = TokenBucket(get_throttle_rate)
+
+def throttle(nbytes):
+    # wait until nbytes more export data are within throttle_mbps/throttle_window
+    # and the throttle_mbps_job of this vm backup
+    if global_throttle is not None:
+        global_throttle.consume(nbytes)
+    job_throttle = getattr(thread_data, 'job_throttle', None)
+    if job_throttle is not None:
+        job_throttle.consume(nbytes)
+
+class ResumeWriter:
+    # resume_window: file-like writer for the export stream of a resumed
+    # export. The data up to the checkpoint is already in the backup, so it is
+    # only compared with the checkpointed (sha256, length) segments. From the
+    # first segment that differs, or after the last one, the data goes to the
+    # writer that open_rest(offset, verified segments) returns.
+    # note - the segment being compared is kept in memory, at most RESUME_SEGMENT_SIZE
+
+    def __init__(self, segments, open_rest):
+        self.segments = segments
+        self.open_rest = open_rest
+        self.out = None
+        self.verified = 0
+        self.offset = 0
+        self.seg_hash = hashlib.sha256()
+        self.seg_data = []
+        self.seg_len = 0
+
+    def write(self, data):
+        while data and self.out is None:
+            if self.verified == len(self.segments):
+                self.open_out()
+                break
+            (digest, length) = self.segments[self.verified]
+            take = min(length - self.seg_len, len(data))
+            self.seg_hash.update(data[:take])
+            self.seg_data.append(data[:take])
+            self.seg_len += take
+            data = data[take:]
+            if self.seg_len == length:
+                if self.seg_hash.hexdigest() != digest:
+                    log('resume: checkpoint differs at %sM' % (self.offset / (1024 * 1024)))
+                    self.open_out()
+                    break
+                self.offset += length
+                self.verified += 1
+                self.seg_hash = hashlib.sha256()
+                self.seg_data = []
+                self.seg_len = 0
+        if data:
+            self.out.write(data)
+
+    def open_out(self):
+        log('resume: %s of %s checkpoints verified - continue at %sM' \
+            % (self.verified, len(self.segments), self.offset / (1024 * 1024)))
+        self.out = self.open_rest(self.offset, self.verified)
+        for data in self.seg_data:
+            self.out.write(data)
+        self.seg_data = []
+
+    def close(self):
+        if self.out is None:
+            self.open_out()
+        self.out.close()
+
+class CheckpointWriter:
+    # resume_window: file-like writer for a raw backup file that appends
+    # '<sha256> <length>' of every RESUME_SEGMENT_SIZE segment to the checkpoint
+    # file, once the segment is synced to backup_file, see ResumeWriter
+    # note - out is backup_file or the SparseWriter on it
+
+    def __init__(self, out, backup_file, checkpoint_path):
+        self.out = out
+        self.backup_file = backup_file
+        self.checkpoint = open(checkpoint_path, 'a')
+        self.seg_hash = hashlib.sha256()
+        self.seg_len = 0
+
+    def write(self, data):
+        while data:
+            take = min(RESUME_SEGMENT_SIZE - self.seg_len, len(data))
+            self.out.write(data[:take])
+            self.seg_hash.update(data[:take])
+            self.seg_len += take
+            data = data[take:]
+            if self.seg_len == RESUME_SEGMENT_SIZE:
+                self.backup_file.flush()
+                os.fsync(self.backup_file.fileno())
+                self.checkpoint.write('%s %s\n' % (self.seg_hash.hexdigest(), self.seg_len))
+                self.checkpoint.flush()
+                self.seg_hash = hashlib.sha256()
+                self.seg_len = 0
+
+    def close(self):
+        try:
+            self.out.close()
+        finally:
+            self.checkpoint.close()
+
+def is_export_resumable():
+    # resume_window applies to the raw vdi-exports over http
+    return int(config['resume_window']) > 0 and config['export_method'] == 'http' \
+        and config['vdi_export_format'] == 'raw' and config['compress_codec'] == 'none' \
+        and config['vdi_export_cbt'] == 'false'
+
+def is_backup_dir_resumable(tmp_backup_dir):
+    # is the failed tmp_backup_dir a resume_window vdi-export that may be continued
+    if not is_export_resumable():
+        return False
+    for disk_dir in os.listdir(tmp_backup_dir):
+        if not disk_dir.startswith('DISK-'):
+            continue
+        resume_cfg = read_disk_cfg(os.path.join(tmp_backup_dir, disk_dir), 'resume.cfg')
+        if resume_cfg is not None and time.time() - int(resume_cfg['time']) < int(config['resume_window']) * 3600:
+            return True
+    return False
+
+def resume_get_snapshot(resume_cfg, vdi_ref):
+    # the vdi-snapshot a failed export of vdi_ref was reading, None if it is gone
+    session = get_session()
+    try:
+        snap_vdi = session.xenapi.VDI.get_by_uuid(resume_cfg['snapshot_uuid'])
+        if session.xenapi.VDI.get_snapshot_of(snap_vdi) == vdi_ref:
+            return snap_vdi
+    except XenAPI.Failure, e:
+        pass
+    log('resume: vdi-snapshot %s not found - start over' % resume_cfg['snapshot_uuid'])
+    return None
+
+def resume_cleanup(tmp_backup_dir):
+    # all disks exported, the resume.cfg files are no longer needed
+    for disk_dir in os.listdir(tmp_backup_dir):
+        resume_cfg_path = os.path.join(tmp_backup_dir, disk_dir, 'resume.cfg')
+        if disk_dir.startswith('DISK-') and os.path.exists(resume_cfg_path):
+            os.remove(resume_cfg_path)
+
+def read_checkpoint(checkpoint_path):
+    # (sha256, length) segments of a raw checkpoint file or a manifest .tmp,
+    # up to a line the failed export could not finish
+    segments = []
+    if not os.path.exists(checkpoint_path):
+        return segments
+    for line in open(checkpoint_path, 'r'):
+        if line.startswith('#'):
+            continue
+        fields = line.split()
+        if not line.endswith('\n') or len(fields) != 2:
+            break
+        segments.append((fields[0], int(fields[1])))
+    return segments
+
+def get_export_resume(tmp_full_path_backup_file, sparse, resuming):
+    # resume_window: the http_export resume of a raw vdi-export
+    #   {'segments': checkpoint of the failed export if resuming,
+    #    'offset': bytes covered by segments,
+    #    'open_rest': function(offset, verified segments) - writer for the data from offset}
+    if config['backup_store'] == 'chunks':
+        chunkstore = os.path.join(config['backup_dir'], CHUNKSTORE_DIR)
+        segments = []
+        # note - ChunkStoreWriter.close also renames the manifest of a failed export
+        checkpoint_path = tmp_full_path_backup_file + '.tmp'
+        if not os.path.exists(checkpoint_path):
+            checkpoint_path = tmp_full_path_backup_file
+        if resuming:
+            # note - a chunkstore_gc may have removed the chunks of the failed export
+            for (digest, length) in read_checkpoint(checkpoint_path):
+                chunk_path = chunkstore_path(chunkstore, digest)
+                if not os.path.exists(chunk_path):
+                    break
+                os.utime(chunk_path, None)
+                segments.append((digest, length))
+
+        def open_rest(offset, verified):
+            return ChunkStoreWriter(tmp_full_path_backup_file, chunkstore, segments[:verified])
+    else:
+        checkpoint_path = tmp_full_path_backup_file + '.checkpoint'
+        segments = []
+        if resuming and os.path.exists(tmp_full_path_backup_file):
+            segments = read_checkpoint(checkpoint_path)
+
+        def open_rest(offset, verified):
+            checkpoint = open(checkpoint_path, 'w')
+            for (digest, length) in segments[:verified]:
+                checkpoint.write('%s %s\n' % (digest, length))
+            checkpoint.close()
+            if offset > 0:
+                backup_file = open(tmp_full_path_backup_file, 'r+b')
+                # note - also extends a file that ends in a hole
+                backup_file.seek(offset)
+                backup_file.truncate()
+            else:
+                backup_file = open(tmp_full_path_backup_file, 'wb')
+            out = backup_file
+            if sparse:
+                out = SparseWriter(backup_file)
+            return CheckpointWriter(out, backup_file, checkpoint_path)
+    offset = 0
+    for (digest, length) in segments:
+        offset += length
+    return {'segments': segments, 'offset': offset, 'open_rest': open_rest}
+
+def stream_to_file(src, out, tmp_chunk_size):
+    # copy src to the out writer in tmp_chunk_size reads, logging progress
+    # returns bytes read from src
+    total = 0
+    begin = time.time()
+    last_progress = begin
+    try:
+        data = src.read(tmp_chunk_size)
+        while data:
+            throttle(len(data))
+            count_export_bytes(len(data))
+            out.write(data)
+            total += len(data)
+            now = time.time()
+            if now - last_progress >= EXPORT_PROGRESS_SECS:
+                log('export progress: %sM %sMB/s' % (total / (1024 * 1024), mb_per_sec(total, now - begin)))
+                last_progress = now
+            data = src.read(tmp_chunk_size)
+    finally:
+        out.close()
+    log('export done: %sM %sMB/s' % (total / (1024 * 1024), mb_per_sec(total, time.time() - begin)))
+    return total
+
+def start_compress_pool():
+    global compress_pool
+    global compress_pool_size
+    procs = int(config['compress_procs'])
+    if procs == 0:
+        procs = multiprocessing.cpu_count()
+    log('*** compress_codec=%s compress_level=%s - starting %s compress processes' \
+        % (config['compress_codec'], config['compress_level'], procs))
+    compress_pool = multiprocessing.Pool(procs)
+    compress_pool_size = procs
+
+def stop_compress_pool():
+    global compress_pool
+    if compress_pool is not None:
+        compress_pool.close()
+        compress_pool.join()
+        compress_pool = None
+
+def compress_block(codec, level, data):
+    # runs in a compress_pool process - each block becomes a complete
+    # gzip member / zstd frame / lz4 frame, so the concatenated blocks
+    # are a valid stream for gunzip, zstd -d and lz4 -d
+    if codec == 'gzip':
+        c = zlib.compressobj(level, zlib.DEFLATED, 31)
+        return c.compress(data) + c.flush()
+    elif codec == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    else:
+        return lz4.frame.compress(data, compression_level=level)
+
+class CompressWriter:
+    # file-like writer that cuts the data into COMPRESS_BLOCK_SIZE blocks,
+    # compresses them on the compress_pool and writes the results in order.
+    # At most two blocks per pool process are in flight, which bounds memory.
+
+    def __init__(self, out, codec, level):
+        self.out = out
+        self.codec = codec
+        self.level = level
+        self.buf = []
+        self.buf_len = 0
+        self.pending = collections.deque()
+        self.max_pending = 2 * compress_pool_size
+        self.bytes_out = 0
+
+    def write(self, data):
+        self.buf.append(data)
+        self.buf_len += len(data)
+        if self.buf_len >= COMPRESS_BLOCK_SIZE:
+            block = ''.join(self.buf)
+            self.buf = []
+            self.buf_len = 0
+            for ix in range(0, len(block) - COMPRESS_BLOCK_SIZE + 1, COMPRESS_BLOCK_SIZE):
+                self.submit(block[ix:ix + COMPRESS_BLOCK_SIZE])
+            rest = len(block) % COMPRESS_BLOCK_SIZE
+            if rest:
+                self.buf.append(block[-rest:])
+                self.buf_len = rest
+
+    def submit(self, block):
+        self.pending.append(compress_pool.apply_async(compress_block, (self.codec, self.level, block)))
+        while len(self.pending) > self.max_pending:
+            self.write_next()
+
+    def write_next(self):
+        data = self.pending.popleft().get()
+        self.out.write(data)
+        self.bytes_out += len(data)
+
+    def close(self):
+        try:
+            if self.buf_len:
+                self.submit(''.join(self.buf))
+                self.buf = []
+                self.buf_len = 0
+            while self.pending:
+                self.write_next()
+        finally:
+            self.out.close()
+
+class ChunkStoreWriter:
+    # backup_store=chunks: file-like writer that splits the export stream
+    # into content defined chunks (see CHUNK_MASK), stores each chunk once
+    # as chunkstore/<2 hex>/<sha256> and writes the list of chunks as the
+    # manifest file: one '<sha256> <length>' line per chunk.
+    # note - a chunk that already exists is only touched, which keeps it
+    #   safe from a chunkstore_gc running at the same time
+    # note - the manifest .tmp is flushed after each chunk, it is the
+    #   checkpoint of a resume_window export. resume_chunks are the
+    #   (sha256, length) of the chunks verified by ResumeWriter.
+
+    def __init__(self, manifest_path, chunkstore, resume_chunks=[]):
+        self.manifest_path = manifest_path
+        self.chunkstore = chunkstore
+        self.manifest = open(manifest_path + '.tmp', 'w')
+        self.manifest.write('# VmBackup chunk manifest v1\n')
+        self.pending = []
+        self.pending_len = 0
+        self.scan_pos = CHUNK_MIN_SIZE
+        self.chunks = 0
+        self.new_chunks = 0
+        self.total_bytes = 0
+        self.new_bytes = 0
+        for (digest, length) in resume_chunks:
+            self.manifest.write('%s %s\n' % (digest, length))
+            self.chunks += 1
+            self.total_bytes += length
+
+    def write(self, data):
+        # note - the writes are only joined once a chunk can be cut, appending
+        #   each one to a string would copy the pending data over and over
+        self.pending.append(data)
+        self.pending_len += len(data)
+        if self.pending_len >= CHUNK_MAX_SIZE:
+            self.cut_chunks()
+
+    def cut_chunks(self):
+        # store the chunks of the pending writes, the rest stays pending
+        buf = ''.join(self.pending)
+        start = 0
+        while True:
+            cut = self.find_cut(buf, start)
+            if cut == 0:
+                break
+            self.store_chunk(buf[start:cut])
+            start = cut
+            self.scan_pos = CHUNK_MIN_SIZE
+        self.pending = [buf[start:]]
+        self.pending_len = len(buf) - start
+
+    def find_cut(self, buf, start):
+        # end of the chunk in buf from start, 0 if more data is needed
+        end = min(len(buf), start + CHUNK_MAX_SIZE)
+        pos = start + self.scan_pos
+        crc32 = zlib.crc32
+        while pos <= end:
+            if crc32(buf[pos - 64:pos]) & CHUNK_MASK == 0:
+                return pos
+            pos += 512
+        if len(buf) - start >= CHUNK_MAX_SIZE:
+            return start + CHUNK_MAX_SIZE
+        self.scan_pos = pos - start
+        return 0
+
+    def store_chunk(self, chunk):
+        digest = hashlib.sha256(chunk).hexdigest()
+        chunk_path = chunkstore_path(self.chunkstore, digest)
+        if os.path.exists(chunk_path):
+            os.utime(chunk_path, None)
+        else:
+            chunk_dir = os.path.dirname(chunk_path)
+            if not os.path.exists(chunk_dir):
+                try:
+                    os.makedirs(chunk_dir)
+                except OSError:
+                    # created by another worker in the mean time
+                    pass
+            # write under a private name, the rename makes it visible in one step
+            tmp_path = '%s.%s.%s.tmp' % (chunk_path, os.getpid(), threading.currentThread().getName())
+            out = open(tmp_path, 'wb')
+            out.write(chunk)
+            out.close()
+            os.rename(tmp_path, chunk_path)
+            self.new_chunks += 1
+            self.new_bytes += len(chunk)
+        self.manifest.write('%s %s\n' % (digest, len(chunk)))
+        self.manifest.flush()
+        self.chunks += 1
+        self.total_bytes += len(chunk)
+
+    def close(self):
+        try:
+            self.cut_chunks()
+            if self.pending_len:
+                self.store_chunk(self.pending[0])
+                self.pending = []
+                self.pending_len = 0
+        finally:
+            self.manifest.close()
+        os.rename(self.manifest_path + '.tmp', self.manifest_path)
+        log('chunkstore: %s chunks %sM - new %s chunks %sM' \
+            % (self.chunks, self.total_bytes / (1024 * 1024), self.new_chunks, self.new_bytes / (1024 * 1024)))
+
+def cbt_is_changed(bitmap, block):
+    # is block marked in the VDI.list_changed_blocks bitmap (most significant bit first)
+    # note - blocks beyond the bitmap are taken as changed
+    if (block >> 3) >= len(bitmap):
+        return True
+    return (ord(bitmap[block >> 3]) >> (7 - (block & 7))) & 1 == 1
+
+def cbt_changed_extents(bitmap, size):
+    # [(offset, length)] of the runs of changed blocks of a vdi of size bytes,
+    # each at most CBT_NBD_READ_SIZE
+    extents = []
+    blocks = (size + CBT_BLOCK_SIZE - 1) / CBT_BLOCK_SIZE
+    block = 0
+    while block < blocks:
+        if not cbt_is_changed(bitmap, block):
+            block += 1
+            continue
+        end = block + 1
+        while end < blocks and cbt_is_changed(bitmap, end) and (end - block) * CBT_BLOCK_SIZE < CBT_NBD_READ_SIZE:
+            end += 1
+        offset = block * CBT_BLOCK_SIZE
+        extents.append((offset, min(end * CBT_BLOCK_SIZE, size) - offset))
+        block = end
+    return extents
+
+class NbdReader:
+    # vdi_export_cbt: file-like reader of the changed blocks of a vdi, back to
+    # back like CbtDeltaWriter writes them, read from the xapi NBD server of a
+    # VDI.get_nbd_info record (fixed newstyle handshake, NBD_OPT_STARTTLS if
+    # it has a cert, NBD_OPT_EXPORT_NAME, then one NBD_CMD_READ per extent)
+
+    def __init__(self, nbd_info, bitmap):
+        self.sock = socket.create_connection((nbd_info['address'], int(nbd_info['port'])), 60)
+        try:
+            self.handshake(nbd_info)
+        except Exception:
+            self.sock.close()
+            raise
+        self.extents = collections.deque(cbt_changed_extents(bitmap, self.size))
+        self.handle = 0
+        self.data = ''
+        self.offset = 0
+        self.bytes_in = 0
+
+    def recv(self, size):
+        data = []
+        while size > 0:
+            part = self.sock.recv(min(size, 1024 * 1024))
+            if not part:
+                raise IOError('nbd connection closed')
+            data.append(part)
+            size -= len(part)
+        return ''.join(data)
+
+    def send_option(self, option, data):
+        self.sock.sendall('IHAVEOPT' + struct.pack('>II', option, len(data)) + data)
+
+    def handshake(self, nbd_info):
+        if self.recv(16) != 'NBDMAGICIHAVEOPT':
+            raise IOError('nbd server does not support the newstyle handshake')
+        (server_flags,) = struct.unpack('>H', self.recv(2))
+        # NBD_FLAG_C_FIXED_NEWSTYLE, NBD_FLAG_C_NO_ZEROES if the server has it
+        no_zeroes = server_flags & 2
+        self.sock.sendall(struct.pack('>I', 1 | no_zeroes))
+        if nbd_info.get('cert'):
+            self.send_option(5, '')
+            (magic, option, reply, length) = struct.unpack('>QIII', self.recv(20))
+            self.recv(length)
+            if reply != 1:
+                raise IOError('nbd server refused STARTTLS - reply 0x%x' % reply)
+            # note - cadata takes a str as DER, unicode as PEM
+            context = ssl.create_default_context(cadata=unicode(nbd_info['cert']))
+            self.sock = context.wrap_socket(self.sock, server_hostname=nbd_info.get('subject') or nbd_info['address'])
+        self.send_option(1, nbd_info['exportname'])
+        (self.size, flags) = struct.unpack('>QH', self.recv(10))
+        if not no_zeroes:
+            self.recv(124)
+
+    def read(self, size):
+        while len(self.data) - self.offset == 0 and self.extents:
+            (offset, length) = self.extents.popleft()
+            self.handle += 1
+            self.sock.sendall(struct.pack('>IHHQQI', 0x25609513, 0, 0, self.handle, offset, length))
+            (magic, error, handle) = struct.unpack('>IIQ', self.recv(16))
+            if magic != 0x67446698 or handle != self.handle:
+                raise IOError('nbd reply out of sync')
+            if error != 0:
+                raise IOError('nbd read at %s - error %s' % (offset, error))
+            self.data = self.recv(length)
+            self.offset = 0
+            self.bytes_in += length
+        data = self.data[self.offset:self.offset + size]
+        self.offset += len(data)
+        return data
+
+    def close(self):
+        try:
+            # NBD_CMD_DISC
+            self.sock.sendall(struct.pack('>IHHQQI', 0x25609513, 0, 2, self.handle + 1, 0, 0))
+        except socket.error:
+            pass
+        self.sock.close()
+
+def nbd_export_delta(nbd_info, bitmap, tmp_full_path_backup_file):
+    # vdi_export_cbt: write the changed blocks of the vdi of nbd_info into the
+    # delta file, True if all of them were read
+    try:
+        src = NbdReader(nbd_info, bitmap)
+        try:
+            stream_to_file(src, open(tmp_full_path_backup_file, 'wb'), int(config['export_chunk_size']) * 1024)
+        finally:
+            src.close()
+    except (socket.error, IOError), e:
+        log('ERROR nbd export - %s' % e)
+        return False
+    log('cbt delta: %sM of %sM changed' % (src.bytes_in / (1024 * 1024), src.size / (1024 * 1024)))
+    return True
+
+class CbtDeltaWriter:
+    # vdi_export_cbt: file-like writer that gets the complete raw vdi stream
+    # and keeps only the CBT_BLOCK_SIZE blocks marked in the
+    # VDI.list_changed_blocks bitmap (most significant bit first), back to back
+    # note - only without an nbd network, see NbdReader: /export_raw_vdi can
+    #   only export the whole vdi, so this delta saves backup storage but not
+    #   export bandwidth or time - all blocks are still read
+
+    def __init__(self, delta_path, bitmap):
+        self.out = open(delta_path, 'wb')
+        self.bitmap = bitmap
+        self.offset = 0
+        self.bytes_out = 0
+
+    def changed(self, block):
+        return cbt_is_changed(self.bitmap, block)
+
+    def write(self, data):
+        pos = 0
+        while pos < len(data):
+            block = (self.offset + pos) / CBT_BLOCK_SIZE
+            changed = self.changed(block)
+            # extend over the following blocks in the same state
+            end = (block + 1) * CBT_BLOCK_SIZE - self.offset
+            while end < len(data) and self.changed(block + 1) == changed:
+                block += 1
+                end += CBT_BLOCK_SIZE
+            end = min(end, len(data))
+            if changed:
+                self.out.write(data[pos:end])
+                self.bytes_out += end - pos
+            pos = end
+        self.offset += len(data)
+
+    def close(self):
+        self.out.close()
+        log('cbt delta: %sM of %sM changed' % (self.bytes_out / (1024 * 1024), self.offset / (1024 * 1024)))
+
+def cbt_apply_delta(raw_path, delta_path, bitmap):
+    # write the changed blocks of a CbtDeltaWriter delta file into the raw image
+    raw = open(raw_path, 'r+b')
+    (delta, delta_size) = open_backup_reader(delta_path)
+    try:
+        for byte_ix in range(len(bitmap)):
+            byte = ord(bitmap[byte_ix])
+            if byte == 0:
+                continue
+            for bit in range(8):
+                if (byte >> (7 - bit)) & 1:
+                    data = delta.read(CBT_BLOCK_SIZE)
+                    if len(data) == 0:
+                        # blocks beyond the end of the vdi
+                        return
+                    raw.seek((byte_ix * 8 + bit) * CBT_BLOCK_SIZE)
+                    raw.write(data)
+    finally:
+        delta.close()
+        raw.close()
+
+def is_cbt_backup_dir(tmp_full_backup_dir):
+    # has the backup dir a vdi_export_cbt disk
+    for disk_dir in os.listdir(tmp_full_backup_dir):
+        if disk_dir.startswith('DISK-') and cbt_read_cfg(os.path.join(tmp_full_backup_dir, disk_dir)) is not None:
+            return True
+    return False
+
+def cbt_find_file(tmp_disk_dir, suffix):
+    # name of the <vm-name><suffix> file of a vdi_export_cbt disk dir, None if none
+    # note - a backup of an older version marked success_compress may have
+    #   been gzipped on the nfs server since, see final_cleanup
+    for name in sorted(os.listdir(tmp_disk_dir)):
+        if name.endswith(suffix) or name.endswith(suffix + COMPRESS_SUFFIX['gzip']):
+            return name
+    return None
+
+def cbt_read_cfg(tmp_disk_dir):
+    # cbt.cfg of the DISK-<device> directory of a vdi_export_cbt backup
+    # as a dict, None if not a cbt backup
+    return read_disk_cfg(tmp_disk_dir, 'cbt.cfg')
+
+def cbt_write_cfg(tmp_disk_dir, cbt_cfg):
+    write_disk_cfg(tmp_disk_dir, 'cbt.cfg', cbt_cfg)
+
+def read_disk_cfg(tmp_disk_dir, cfg_name):
+    # key=value file cfg_name of a DISK-<device> directory as a dict, None if not present
+    cfg_path = os.path.join(tmp_disk_dir, cfg_name)
+    if not os.path.exists(cfg_path):
+        return None
+    disk_cfg = {}
+    for line in open(cfg_path, 'r'):
+        (key, value) = line.rstrip('\n').split('=', 1)
+        disk_cfg[key] = value
+    return disk_cfg
+
+def write_disk_cfg(tmp_disk_dir, cfg_name, disk_cfg):
+    cfg_out = open(os.path.join(tmp_disk_dir, cfg_name + '.tmp'), 'w')
+    for key in sorted(disk_cfg.keys()):
+        cfg_out.write('%s=%s\n' % (key, disk_cfg[key]))
+    cfg_out.close()
+    os.rename(os.path.join(tmp_disk_dir, cfg_name + '.tmp'), os.path.join(tmp_disk_dir, cfg_name))
+
+def cbt_get_base(tmp_vm_backup_dir, tmp_full_backup_dir, device, vdi_ref):
+    # vdi_export_cbt: the last successful backup of this disk and its kept cbt snapshot
+    #   {'dir': backup dir name, 'snapshot': vdi ref}
+    # or None if this backup has to be a full backup
+    session = get_session()
+    if not session.xenapi.VDI.get_cbt_enabled(vdi_ref):
+        log('cbt: VDI.enable_cbt - full backup')
+        session.xenapi.VDI.enable_cbt(vdi_ref)
+        return None
+    dirs = os.listdir(tmp_vm_backup_dir)
+    dirs.sort()
+    chain_len = 0
+    base = None
+    for dir in reversed(dirs):
+        if os.path.join(tmp_vm_backup_dir, dir) == tmp_full_backup_dir:
+            continue
+        # note - success_compress of an older version, see cbt_find_file
+        if not os.path.exists(os.path.join(tmp_vm_backup_dir, dir, 'success')) \
+            and not os.path.exists(os.path.join(tmp_vm_backup_dir, dir, 'success_compress')):
+            continue
+        cbt_cfg = cbt_read_cfg(os.path.join(tmp_vm_backup_dir, dir, 'DISK-%s' % device))
+        if cbt_cfg is None:
+            break
+        if base is None:
+            base = {'dir': dir, 'snapshot_uuid': cbt_cfg['snapshot_uuid']}
+        chain_len += 1
+        if cbt_cfg['type'] == 'full':
+            break
+        if cbt_cfg['base'] not in dirs:
+            # broken chain
+            base = None
+            break
+    if base is None:
+        log('cbt: no previous cbt backup - full backup')
+        return None
+    if chain_len >= int(config['cbt_full_every']):
+        log('cbt: %s backups since the last full (cbt_full_every=%s) - full backup' % (chain_len, config['cbt_full_every']))
+        return None
+    try:
+        base['snapshot'] = session.xenapi.VDI.get_by_uuid(base['snapshot_uuid'])
+    except XenAPI.Failure, e:
+        log('cbt: snapshot %s of %s not found - full backup' % (base['snapshot_uuid'], base['dir']))
+        return None
+    log('cbt: delta backup against %s' % base['dir'])
+    return base
+
+def cbt_keep_snapshot(tmp_disk_dir, vdi_ref, snap_vdi, cbt_name_label, cbt_base):
+    # vdi_export_cbt: write cbt.cfg, keep the vdi-snapshot as metadata only
+    # (VDI.data_destroy) for the next backup and destroy the previous ones
+    # returns False on a (non-fatal) warning
+    session = get_session()
+    tmp_status = True
+    snap_vdi_uuid = session.xenapi.VDI.get_uuid(snap_vdi)
+    cbt_cfg = {'snapshot_uuid': snap_vdi_uuid, 'virtual_size': session.xenapi.VDI.get_virtual_size(snap_vdi)}
+    if cbt_base is None:
+        cbt_cfg['type'] = 'full'
+    else:
+        cbt_cfg['type'] = 'delta'
+        cbt_cfg['base'] = cbt_base['dir']
+    cbt_write_cfg(tmp_disk_dir, cbt_cfg)
+    log('5.xapi: VDI.data_destroy uuid=%s name-label="%s"' % (snap_vdi_uuid, cbt_name_label))
+    try:
+        session.xenapi.VDI.set_name_label(snap_vdi, re.sub(r' ', r'-', cbt_name_label))
+        session.xenapi.VDI.data_destroy(snap_vdi)
+    except XenAPI.Failure, e:
+        log('WARNING VDI.data_destroy %s - %s' % (snap_vdi_uuid, e))
+        tmp_status = False
+    # the previous cbt snapshot(s) of this vdi are no longer needed
+    for prev_vdi in session.xenapi.VDI.get_by_name_label(re.sub(r' ', r'-', cbt_name_label)):
+        if prev_vdi == snap_vdi or session.xenapi.VDI.get_snapshot_of(prev_vdi) != vdi_ref:
+            continue
+        prev_vdi_uuid = session.xenapi.VDI.get_uuid(prev_vdi)
+        log('cbt: VDI.destroy previous snapshot %s' % prev_vdi_uuid)
+        try:
+            session.xenapi.VDI.destroy(prev_vdi)
+        except XenAPI.Failure, e:
+            log('WARNING VDI.destroy %s - %s' % (prev_vdi_uuid, e))
+            tmp_status = False
+    return tmp_status
+
+def cbt_merge_forward(tmp_backup_dir):
+    # before a vdi_export_cbt backup is removed, turn each of its full disks
+    # whose next backup is a delta against it into a synthetic full, so
+    # the chain stays restorable
+    (tmp_vm_backup_dir, dir) = os.path.split(tmp_backup_dir.rstrip('/'))
+    dirs = os.listdir(tmp_vm_backup_dir)
+    dirs.sort()
+    if dirs.index(dir) + 1 >= len(dirs):
+        return
+    next_dir = os.path.join(tmp_vm_backup_dir, dirs[dirs.index(dir) + 1])
+    for disk_dir in os.listdir(tmp_backup_dir):
+        if not disk_dir.startswith('DISK-'):
+            continue
+        cbt_cfg = cbt_read_cfg(os.path.join(tmp_backup_dir, disk_dir))
+        if cbt_cfg is None or cbt_cfg['type'] != 'full':
+            continue
+        next_disk_dir = os.path.join(next_dir, disk_dir)
+        next_cfg = cbt_read_cfg(next_disk_dir)
+        if next_cfg is None or next_cfg['type'] != 'delta' or next_cfg['base'] != dir:
+            continue
+        raw_file = cbt_find_file(os.path.join(tmp_backup_dir, disk_dir), '.raw')
+        delta_file = cbt_find_file(next_disk_dir, '.raw.delta')
+        if raw_file is None or delta_file is None:
+            log('WARNING cbt merge - %s has no raw/delta pair' % next_disk_dir)
+            continue
+        log('cbt: synthetic full - merge %s/%s into %s' % (tmp_backup_dir, disk_dir, next_disk_dir))
+        raw_path = os.path.join(next_disk_dir, delta_file[:delta_file.index('.raw.delta')] + '.raw')
+        if raw_file.endswith('.raw'):
+            os.rename(os.path.join(tmp_backup_dir, disk_dir, raw_file), raw_path + '.merge')
+        else:
+            # gunzip, through SparseWriter so the image keeps its holes
+            (src, src_size) = open_backup_reader(os.path.join(tmp_backup_dir, disk_dir, raw_file))
+            try:
+                stream_to_file(src, SparseWriter(open(raw_path + '.merge', 'wb')), DEFAULT_EXPORT_CHUNK_SIZE * 1024)
+            finally:
+                src.close()
+        bitmap_path = raw_path + '.bitmap'
+        cbt_apply_delta(raw_path + '.merge', os.path.join(next_disk_dir, delta_file), open(bitmap_path, 'rb').read())
+        os.rename(raw_path + '.merge', raw_path)
+        os.remove(os.path.join(next_disk_dir, delta_file))
+        os.remove(bitmap_path)
+        next_cfg['type'] = 'full'
+        del next_cfg['base']
+        cbt_write_cfg(next_disk_dir, next_cfg)
+
+def cbt_restore(tmp_disk_dir, raw_path):
+    # write the full raw image of a DISK-<device> directory of a vdi_export_cbt
+    # backup: its full backup with all deltas up to this backup applied
+    tmp_disk_dir = tmp_disk_dir.rstrip('/')
+    (tmp_backup_dir, disk_dir) = os.path.split(tmp_disk_dir)
+    (tmp_vm_backup_dir, dir) = os.path.split(tmp_backup_dir)
+    chain = []
+    while True:
+        cbt_cfg = cbt_read_cfg(os.path.join(tmp_vm_backup_dir, dir, disk_dir))
+        if cbt_cfg is None:
+            raise IOError('%s/%s is not a vdi_export_cbt backup' % (dir, disk_dir))
+        chain.insert(0, os.path.join(tmp_vm_backup_dir, dir, disk_dir))
+        if cbt_cfg['type'] == 'full':
+            break
+        dir = cbt_cfg['base']
+    full_file = cbt_find_file(chain[0], '.raw')
+    if full_file is None:
+        raise IOError('%s has no full raw image' % chain[0])
+    log('cbt-restore: full %s/%s' % (chain[0], full_file))
+    # copy through SparseWriter, so the restored image keeps its holes
+    (src, src_size) = open_backup_reader(os.path.join(chain[0], full_file))
+    try:
+        stream_to_file(src, SparseWriter(open(raw_path, 'wb')), DEFAULT_EXPORT_CHUNK_SIZE * 1024)
+    finally:
+        src.close()
+    for delta_dir in chain[1:]:
+        delta_file = cbt_find_file(delta_dir, '.raw.delta')
+        if delta_file is None:
+            raise IOError('%s has no delta' % delta_dir)
+        log('cbt-restore: apply %s/%s' % (delta_dir, delta_file))
+        bitmap = open(os.path.join(delta_dir, delta_file[:delta_file.index('.raw.delta')] + '.raw.bitmap'), 'rb').read()
+        cbt_apply_delta(raw_path, os.path.join(delta_dir, delta_file), bitmap)
+
+def chunkstore_path(chunkstore, digest):
+    return os.path.join(chunkstore, digest[:2], digest)
+
+def read_manifest(manifest_path):
+    # list of (sha256, length) of a backup_store=chunks manifest
+    chunks = []
+    for line in open(manifest_path, 'r'):
+        if line.startswith('#'):
+            continue
+        (digest, length) = line.split()
+        chunks.append((digest, int(length)))
+    return chunks
+
+def get_backup_file_size(tmp_full_path_backup_file):
+    # bytes of the backup, for a chunk manifest the size of the original export
+    if tmp_full_path_backup_file.endswith('.manifest'):
+        total = 0
+        for (digest, length) in read_manifest(tmp_full_path_backup_file):
+            total += length
+        return total
+    return os.path.getsize(tmp_full_path_backup_file)
+
+def get_backup_file_allocated(tmp_full_path_backup_file):
+    # bytes the backup actually takes on the backup_dir filesystem,
+    # less than get_backup_file_size for a sparse file
+    # note - a chunk manifest is taken at its full size, its chunks may be shared
+    if tmp_full_path_backup_file.endswith('.manifest'):
+        return get_backup_file_size(tmp_full_path_backup_file)
+    return os.stat(tmp_full_path_backup_file).st_blocks * 512
+
+def chunkstore_cat(manifest_path, out):
+    # write the original export of a manifest to out, verifying each chunk
+    src = ManifestReader(manifest_path)
+    data = src.read(CHUNK_MAX_SIZE)
+    while data:
+        out.write(data)
+        data = src.read(CHUNK_MAX_SIZE)
+
+class ManifestReader:
+    # file-like reader of the original export of a backup_store=chunks
+    # manifest, each chunk is verified as it is read
+    # note - the chunk store is at backup_dir/CHUNKSTORE_DIR, i.e. the first
+    #   CHUNKSTORE_DIR above backup_dir/<vm-name>/<backup-date>/<vm-name>.xva.manifest
+    #   (or .../<backup-date>/DISK-<device>/<vm-name>.raw.manifest)
+
+    def __init__(self, manifest_path):
+        chunkstore_parent = os.path.dirname(os.path.abspath(manifest_path))
+        while not os.path.isdir(os.path.join(chunkstore_parent, CHUNKSTORE_DIR)) and chunkstore_parent != '/':
+            chunkstore_parent = os.path.dirname(chunkstore_parent)
+        self.chunkstore = os.path.join(chunkstore_parent, CHUNKSTORE_DIR)
+        self.chunks = collections.deque(read_manifest(manifest_path))
+        # note - read from offset, slicing off each read would copy the rest of the chunk
+        self.data = ''
+        self.offset = 0
+
+    def read(self, size):
+        while len(self.data) - self.offset < size and self.chunks:
+            (digest, length) = self.chunks.popleft()
+            chunk = open(chunkstore_path(self.chunkstore, digest), 'rb').read()
+            if len(chunk) != length or hashlib.sha256(chunk).hexdigest() != digest:
+                raise IOError('chunk %s is corrupt' % digest)
+            self.data = self.data[self.offset:] + chunk
+            self.offset = 0
+        data = self.data[self.offset:self.offset + size]
+        self.offset += len(data)
+        return data
+
+    def close(self):
+        self.chunks.clear()
+
+def open_backup_reader(tmp_full_path_backup_file):
+    # restore: (file-like reader, bytes or None if not known) of the original
+    # export of a backup file - uncompressed by its compress_codec suffix,
+    # a chunk manifest through the chunk store
+    if tmp_full_path_backup_file.endswith('.manifest'):
+        return (ManifestReader(tmp_full_path_backup_file), get_backup_file_size(tmp_full_path_backup_file))
+    if tmp_full_path_backup_file.endswith(COMPRESS_SUFFIX['gzip']):
+        return (gzip.open(tmp_full_path_backup_file, 'rb'), None)
+    if tmp_full_path_backup_file.endswith(COMPRESS_SUFFIX['zstd']):
+        if zstandard is None:
+            raise IOError('%s needs the python zstandard module' % tmp_full_path_backup_file)
+        # note - one zstd frame per compress block, see compress_block
+        return (zstandard.ZstdDecompressor().stream_reader(open(tmp_full_path_backup_file, 'rb'), read_across_frames=True), None)
+    if tmp_full_path_backup_file.endswith(COMPRESS_SUFFIX['lz4']):
+        if lz4 is None:
+            raise IOError('%s needs the python lz4 module' % tmp_full_path_backup_file)
+        return (lz4.frame.open(tmp_full_path_backup_file, 'rb'), None)
+    return (open(tmp_full_path_backup_file, 'rb'), os.path.getsize(tmp_full_path_backup_file))
+
+def chunkstore_gc():
+    # remove chunks no longer referenced by any manifest below backup_dir
+    # note - the reference count of each chunk is rebuilt from the manifests.
+    #   Chunks written or touched during this run are always kept, since a
+    #   running export may not have written its manifest yet.
+    chunkstore = os.path.join(config['backup_dir'], CHUNKSTORE_DIR)
+    if not os.path.exists(chunkstore):
+        return
+    if shard_leases is not None and shard_leases.others_active():
+        # the chunks of a peer's running export are not referenced by a manifest yet
+        log('*** chunkstore garbage collection skipped - other shard_by_host workers are running')
+        return
+    log('*** chunkstore garbage collection: %s' % chunkstore)
+    refcnt = {}
+    manifests = 0
+    for vm_dir in os.listdir(config['backup_dir']):
+        vm_path = os.path.join(config['backup_dir'], vm_dir)
+        if vm_dir in [CHUNKSTORE_DIR, SHARD_LEASE_DIR] or not os.path.isdir(vm_path):
+            continue
+        for backup_dir in os.listdir(vm_path):
+            backup_path = os.path.join(vm_path, backup_dir)
+            if not os.path.isdir(backup_path):
+                continue
+            for (dir_path, sub_dirs, names) in os.walk(backup_path):
+                for name in names:
+                    if name.endswith('.manifest'):
+                        manifests += 1
+                        for (digest, length) in read_manifest(os.path.join(dir_path, name)):
+                            refcnt[digest] = refcnt.get(digest, 0) + 1
+    removed = 0
+    removed_bytes = 0
+    kept = 0
+    for sub_dir in os.listdir(chunkstore):
+        sub_path = os.path.join(chunkstore, sub_dir)
+        for digest in os.listdir(sub_path):
+            if refcnt.get(digest, 0) > 0:
+                kept += 1
+                continue
+            chunk_path = os.path.join(sub_path, digest)
+            stat = os.stat(chunk_path)
+            if stat.st_mtime >= run_begin_time:
+                kept += 1
+                continue
+            os.remove(chunk_path)
+            removed += 1
+            removed_bytes += stat.st_size
+    log('chunkstore gc: %s manifests, %s chunks kept, %s chunks removed %sM' \
+        % (manifests, kept, removed, removed_bytes / (1024 * 1024)))
+
+def mb_per_sec(tmp_bytes, tmp_secs):
+    if tmp_secs <= 0:
+        return 0
+    return int(tmp_bytes / tmp_secs / (1024 * 1024))
+
+def wait_task_success(task):
+    # wait for the xapi task of an export to finish, True if it succeeded
+    session = get_session()
+    status = session.xenapi.task.get_status(task)
+    while status == 'pending':
+        time.sleep(1)
+        status = session.xenapi.task.get_status(task)
+    if status != 'success':
+        log('ERROR xapi task %s - %s' % (status, session.xenapi.task.get_error_info(task)))
+        return False
+    return True
+
 # some run notes with xe return code and output examples
 #  xe vm-lisX -> error .returncode=1 w/ error msg
 #  xe vm-list name-label=BAD-vm-name -> success .returncode=0 with no output
@@ -867,6 +3926,27 @@ def run_log_out_wait_rc(cmd, log_w_timestamp=True):
         line = child.stdout.readline()
     return child.wait()
 
+def xe_export(cmd, out):
+    # checksum/xva_validate/throttle with export_method=xe: the xe vm-export/vdi-export
+    # cmd writes to stdout (filename=) and is streamed into the out writer like
+    # an http export, so the checksum, the xva check and the throttle are done on the way
+    # returns True if all data was written and xe succeeded
+    errors = tempfile.TemporaryFile()
+    child = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=errors, shell=True)
+    stream_ok = True
+    try:
+        stream_to_file(child.stdout, out, int(config['export_chunk_size']) * 1024)
+    except IOError, e:
+        log('ERROR xe export - %s' % e)
+        child.kill()
+        stream_ok = False
+    rc = child.wait()
+    errors.seek(0)
+    for line in errors:
+        log(line.rstrip("\n"))
+    errors.close()
+    return stream_ok and rc == 0
+
 def run_get_lastline(cmd):
     # exec cmd - expect 1 line output from cmd
     # return last line
@@ -977,6 +4057,151 @@ def is_config_valid():
         print 'ERROR: config backup_dir does not exist -> %s' % config['backup_dir']
         return False
 
+    if not isInt(config['max_parallel']):
+        print 'ERROR: config max_parallel non-numeric -> %s' % config['max_parallel']
+        return False
+
+    if int(config['max_parallel']) < 1:
+        print 'ERROR: config max_parallel out of range -> %s' % config['max_parallel']
+        return False
+
+    for key in ['max_per_sr', 'max_per_host']:
+        if not isInt(config[key]):
+            print 'ERROR: config %s non-numeric -> %s' % (key, config[key])
+            return False
+        if int(config[key]) < 0:
+            print 'ERROR: config %s out of range -> %s' % (key, config[key])
+            return False
+
+    if config['run_report'] != 'none' and not set(config['run_report'].split(',')) <= set(['json', 'csv']):
+        print 'ERROR: config run_report invalid -> %s' % config['run_report']
+        return False
+
+    try:
+        if config['metrics_port'] != '0' and not 0 < get_metrics_address()[1] < 65536:
+            raise ValueError
+    except ValueError:
+        print 'ERROR: config metrics_port invalid -> %s' % config['metrics_port']
+        return False
+
+    if config['adaptive_parallel'] not in ['true', 'false']:
+        print 'ERROR: config adaptive_parallel invalid -> %s' % config['adaptive_parallel']
+        return False
+    if config['adaptive_parallel'] == 'true' and config['export_method'] != 'http':
+        # the xe export streams inside xe, where its throughput can not be measured
+        print 'ERROR: config adaptive_parallel=true requires export_method=http'
+        return False
+
+    if config['order'] not in ['config', 'size', 'history']:
+        print 'ERROR: config order invalid -> %s' % config['order']
+        return False
+
+    if config['export_method'] not in ['xe', 'http']:
+        print 'ERROR: config export_method invalid -> %s' % config['export_method']
+        return False
+
+    if not isInt(config['export_chunk_size']) or int(config['export_chunk_size']) < 1:
+        print 'ERROR: config export_chunk_size invalid -> %s' % config['export_chunk_size']
+        return False
+
+    if config['compress_codec'] not in ['none', 'gzip', 'zstd', 'lz4']:
+        print 'ERROR: config compress_codec invalid -> %s' % config['compress_codec']
+        return False
+
+    if config['backup_store'] not in ['file', 'chunks']:
+        print 'ERROR: config backup_store invalid -> %s' % config['backup_store']
+        return False
+
+    if config['backup_store'] == 'chunks':
+        if config['export_method'] != 'http':
+            print 'ERROR: config backup_store=chunks requires export_method=http'
+            return False
+        if config['compress_codec'] != 'none':
+            print 'ERROR: config backup_store=chunks can not be combined with compress_codec'
+            return False
+
+    if config['shard_by_host'] not in ['true', 'false']:
+        print 'ERROR: config shard_by_host invalid -> %s' % config['shard_by_host']
+        return False
+
+    if daemon:
+        if not isTimeOfDay(config['start_time']) or not isTimeOfDay(config['stop_time']):
+            print 'ERROR: config start_time/stop_time invalid -> %s/%s' % (config['start_time'], config['stop_time'])
+            return False
+        try:
+            float(config['rpo'])
+            for vm_rpo in config['vm-rpo']:
+                float(vm_rpo.rsplit(':', 1)[1])
+        except (ValueError, IndexError):
+            print 'ERROR: config rpo/vm-rpo hours invalid'
+            return False
+        for blackout in config['blackout']:
+            if blackout.count('-') != 1 or not isTimeOfDay(blackout.split('-')[0]) or not isTimeOfDay(blackout.split('-')[1]):
+                print 'ERROR: config blackout invalid -> %s' % blackout
+                return False
+
+    if config['xapi_events'] not in ['true', 'false']:
+        print 'ERROR: config xapi_events invalid -> %s' % config['xapi_events']
+        return False
+
+    if config['vdi_export_sparse'] not in ['true', 'false']:
+        print 'ERROR: config vdi_export_sparse invalid -> %s' % config['vdi_export_sparse']
+        return False
+
+    if config['checksum'] not in ['none', 'sha256']:
+        print 'ERROR: config checksum invalid -> %s' % config['checksum']
+        return False
+
+    if config['xva_validate'] not in ['true', 'false']:
+        print 'ERROR: config xva_validate invalid -> %s' % config['xva_validate']
+        return False
+
+    if config['vdi_export_cbt'] not in ['true', 'false']:
+        print 'ERROR: config vdi_export_cbt invalid -> %s' % config['vdi_export_cbt']
+        return False
+
+    try:
+        if float(config['throttle_mbps']) < 0 or float(config['throttle_mbps_job']) < 0:
+            raise ValueError
+        for throttle_window in config['throttle_window']:
+            (window, mbps) = throttle_window.rsplit(':', 1)
+            if float(mbps) < 0 or window.count('-') != 1 or \
+                not isTimeOfDay(window.split('-')[0]) or not isTimeOfDay(window.split('-')[1]):
+                raise ValueError
+    except ValueError:
+        print 'ERROR: config throttle_mbps/throttle_mbps_job/throttle_window invalid'
+        return False
+
+    if not isInt(config['resume_window']) or int(config['resume_window']) < 0:
+        print 'ERROR: config resume_window invalid -> %s' % config['resume_window']
+        return False
+
+    if config['vdi_export_cbt'] == 'true':
+        if config['export_method'] != 'http' or config['vdi_export_format'] != 'raw' \
+            or config['backup_store'] != 'file' or config['compress_codec'] != 'none':
+            print 'ERROR: config vdi_export_cbt=true requires export_method=http, vdi_export_format=raw, backup_store=file and no compress_codec'
+            return False
+        if not isInt(config['cbt_full_every']) or int(config['cbt_full_every']) < 1:
+            print 'ERROR: config cbt_full_every invalid -> %s' % config['cbt_full_every']
+            return False
+
+    if config['compress_codec'] != 'none':
+        if config['export_method'] != 'http':
+            print 'ERROR: config compress_codec=%s requires export_method=http' % config['compress_codec']
+            return False
+        if config['compress_codec'] == 'zstd' and zstandard is None:
+            print 'ERROR: config compress_codec=zstd requires the python zstandard module'
+            return False
+        if config['compress_codec'] == 'lz4' and lz4 is None:
+            print 'ERROR: config compress_codec=lz4 requires the python lz4 module'
+            return False
+        if not isInt(config['compress_level']):
+            print 'ERROR: config compress_level non-numeric -> %s' % config['compress_level']
+            return False
+        if not isInt(config['compress_procs']) or int(config['compress_procs']) < 0:
+            print 'ERROR: config compress_procs invalid -> %s' % config['compress_procs']
+            return False
+
     tmp_return = True
     for vm_parm in config['vdi-export']:
         if not is_vm_backups_valid(vm_parm):
@@ -990,113 +4215,244 @@ def is_config_valid():
 
     return tmp_return
 
-def config_load(path):
-    return_value = True
+def config_lines(path):
+    # (key, value) of each config file line that is not a comment
+    tmp_lines = []
     config_file = open(path, 'r')
     for line in config_file:
         if (not line.startswith('#') and len(line.strip()) > 0):
-            (key,value) = line.strip().split('=')
-            key = key.strip()
-            value = value.strip()
-
-            # check for valid keys
-            if not key in expected_keys:
-                if ignore_extra_keys:
-                    log('ignoring config key: %s' % key)
-                else:
-                    print '***ERROR unexpected config key: %s' % key
-                    return_value = False
-            
-            if key == 'exclude':
-                save_to_config_exclude( key, value)
-            elif key in ['vm-export','vdi-export']:
-                save_to_config_export( key, value)
+            (key,value) = line.strip().split('=', 1)
+            tmp_lines.append((key.strip(), value.strip()))
+    config_file.close()
+    return tmp_lines
+
+def config_load(path):
+    return_value = True
+    selector_lines = []
+    for (key, value) in config_lines(path):
+        # check for valid keys
+        if not key in expected_keys:
+            if ignore_extra_keys:
+                log('ignoring config key: %s' % key)
             else:
-                # all other key's
-                save_to_config_values( key, value)
+                print '***ERROR unexpected config key: %s' % key
+                return_value = False
+        
+        if key in ['exclude', 'vm-export', 'vdi-export']:
+            # matched against all_vms together, see save_to_config_selectors
+            selector_lines.append((key, value))
+        else:
+            # all other key's
+            save_to_config_values( key, value)
 
+    save_to_config_selectors(selector_lines)
     return return_value
 
-def save_to_config_exclude( key, vm_name):
-    # save key/value in config[]
-    # expected-key: exclude
-    # expected-value: vmname (with or w/o regex)
+def save_to_config_selectors(lines):
+    # save the exclude/vm-export/vdi-export lines in config[]
+    # lines - (key, value) in config file order
+    #   exclude: vmname (with or w/o regex)
+    #   vm-export or vdi-export: vmname (with or w/o regex) or vmname:#
+    #     and for vdi-export optional :disks=device,device
+    # a line only selects the vms not excluded by an earlier exclude line, and
+    # vm-export skips the vms of an earlier vdi-export line
+    # note - the selectors are parsed first and then matched in one pass over
+    #   all_vms, a plain vm name is a hash lookup instead of a scan
     global warning_match
     global error_regex
-    found_match = False
-    # Fail fast if exclude param given but empty to prevent from exluding all VMs
-    if vm_name == "":
-        return
-    if not isNormalVmName(vm_name) and not isRegExValid( vm_name):
-        log("***ERROR - invalid regex: %s=%s" % (key, vm_name))
-        error_regex = True
-        return
-    #for vm in all_vms:
-    #    if ((isNormalVmName(vm_name) and vm_name == vm) or
-    #        (not isNormalVmName(vm_name) and re.match(vm_name, vm))):
-    #        found_match = True
-    #        config[key].append(vm)
+    selectors = []
+    for (key, value) in lines:
+        selector = parse_config_selector(key, value)
+        if selector is not None:
+            selectors.append(selector)
+    plain_selectors = {} # vm name -> indexes of its plain vm name selectors
+    scan_selectors = {} # regex or attribute selector -> indexes
+    for (i, selector) in enumerate(selectors):
+        if not isAttributeSelector(selector['vm']) and get_selector_pattern(selector['vm']) is None:
+            plain_selectors.setdefault(selector['vm'], []).append(i)
+        else:
+            scan_selectors.setdefault(selector['vm'], []).append(i)
+    # each distinct selector is matched once per vm
+    scan_matchers = []
+    for (vm_selector, indexes) in scan_selectors.items():
+        if isAttributeSelector(vm_selector):
+            matcher = functools.partial(vm_matches, vm_selector)
+        else:
+            matcher = get_selector_pattern(vm_selector).match
+        scan_matchers.append((matcher, indexes))
     for vm in all_vms:
-
-        if ((isNormalVmName(vm_name) and vm_name == vm) or
-            (not isNormalVmName(vm_name) and re.match(vm_name, vm))):
-            found_match = True
-            config[key].append(vm)
-
-    if not found_match:
-        log("***WARNING - vm not found: %s=%s" % (key, vm_name))
-        warning_match = True
-    else:
-        for vm in config[key]:
-            try:
-               all_vms.remove(vm)
-            except:
-               pass
-               #print "VM not found -- ignore"
-
-def save_to_config_export( key, value):
-    # save key/value in config[]
-    # expected-key: vm-export or vdi-export
-    # expected-value: vmname (with or w/o regex) or vmname:#
-    global warning_match
+        hits = list(plain_selectors.get(vm, []))
+        for (matcher, indexes) in scan_matchers:
+            if matcher(vm):
+                hits.extend(indexes)
+        vdi_exported = False
+        for i in sorted(hits):
+            selector = selectors[i]
+            selector['found'] = True
+            if selector['key'] == 'exclude':
+                selector['vms'].append(vm)
+                break
+            if selector['key'] == 'vm-export' and vdi_exported:
+                # vdi-export already has the vm, do not add it to vm-export
+                continue
+            if selector['key'] == 'vdi-export':
+                vdi_exported = True
+            selector['vms'].append(vm)
+
+    pool_vms = set(all_vms)
+    excluded = set()
+    for selector in selectors:
+        key = selector['key']
+        if key == 'exclude':
+            config[key].extend(selector['vms'])
+            excluded.update(selector['vms'])
+        elif excluded == pool_vms:
+            # Fail fast if all VMs excluded or if no VMs exist in the pool
+            continue
+        else:
+            for vm in selector['vms']:
+                if selector['backups'] == '':
+                    config[key].append(vm)
+                else:
+                    config[key].append("%s:%s" % (vm, selector['backups']))
+                if selector['disks'] is not None:
+                    vdi_export_disks[vm] = selector['disks']
+        if not selector['found']:
+            log("***WARNING - vm not found: %s=%s" % (key, selector['value']))
+            warning_match = True
+    if excluded:
+        set_all_vms([vm for vm in all_vms if vm not in excluded])
+
+def parse_config_selector(key, value):
+    # one exclude/vm-export/vdi-export line for save_to_config_selectors,
+    # None if it selects nothing
     global error_regex
-    found_match = False
-
-    # Fail fast if all VMs excluded or if no VMs exist in the pool
-    if all_vms == []:
-        return
-
+    # Fail fast if exclude param given but empty to prevent from exluding all VMs
     # Fail fast if vdi-export given but empty to prevent from matching all VMs first-come-first-served style
     # NOTE: This checks for the vdi-export key only so leaving vm-export empty will still default to all VMs
-    if key == "vdi-export" and value == "":
-        return
-
-    # Evaluate key/value pairs if we get this far
-    values = value.split(':')
-    vm_name_part = values[0]
+    if key in ['exclude', 'vdi-export'] and value == "":
+        return None
+    vm_name_part = value
     vm_backups_part = ''
-    if len(values) > 1:
-        vm_backups_part = values[1]
-    if not isNormalVmName(vm_name_part) and not isRegExValid( vm_name_part ):
+    disks_part = None
+    if key != 'exclude':
+        values = value.split(':')
+        if key == 'vdi-export' and values[-1].startswith('disks='):
+            # vdi-export subset of disks, kept apart so vm_parm stays vmname or vmname:#
+            disks_part = [x.strip() for x in values.pop()[len('disks='):].split(',') if x.strip() != '']
+        if len(values) > 1 and isAttributeSelector(':'.join(values[:2])):
+            # tag:gold:3 - the selector itself has a ':'
+            values[:2] = [':'.join(values[:2])]
+        vm_name_part = values[0]
+        if len(values) > 1:
+            vm_backups_part = values[1]
+    if not isSelectorValid(vm_name_part):
         log("***ERROR - invalid regex: %s=%s" % (key, value))
         error_regex = True
-        return
-    for vm in all_vms:
-        if ((isNormalVmName(vm_name_part) and vm_name_part == vm) or
-            (not isNormalVmName(vm_name_part) and re.match(vm_name_part, vm))):
-            if vm_backups_part == '':
-                new_value = vm
-            else:
-                new_value = "%s:%s" % (vm, vm_backups_part)
-            found_match = True
-            # Check if vdi-export already has the vm mentioned and, if so, do not add this vm to vm-export
-            if key == "vm-export" and vm in config['vdi-export']:
-                continue
-            else:
-                config[key].append(new_value)
-    if not found_match:
-        log("***WARNING - vm not found: %s=%s" % (key, value))
-        warning_match = True
+        return None
+    return {'key': key, 'value': value, 'vm': vm_name_part, 'backups': vm_backups_part,
+        'disks': disks_part, 'vms': [], 'found': False}
+
+def set_all_vms(vms):
+    # replace all_vms, the vms that vm-export/vdi-export lines select from
+    global all_vms
+    all_vms = vms
+
+def get_pool_vms():
+    # name_label of every vm that may be backed up, from the xapi_cache
+    return [x['name_label'] for x in xapi_cache.get_all_records('VM').values() if is_pool_vm(x)]
+
+def is_pool_vm(vm_record):
+    return not vm_record['is_a_snapshot'] and not vm_record['is_a_template'] and not vm_record['is_control_domain']
+
+def vm_matches(selector, vm_name):
+    # does vm_name match selector
+    # selector - a plain vm name, a regex, or one of VM_ATTRIBUTE_SELECTORS
+    #   tag:<tag>, sr:<sr>, pool-host:<host> or other_config:<key>=<value>
+    #   matched against the VM records of the xapi_cache
+    if isAttributeSelector(selector):
+        for vm_ref in xapi_cache.get_by_name_label('VM', vm_name):
+            vm_record = xapi_cache.get_record('VM', vm_ref)
+            if is_pool_vm(vm_record) and vm_record_matches(selector, vm_record):
+                return True
+        return False
+    return is_value_match(selector, vm_name)
+
+def vm_record_matches(selector, vm_record):
+    # attribute selector: does one of the vm's values for the attribute match
+    # (a plain value or a regex, just as a vm name)
+    (attribute, value) = selector.split(':', 1)
+    if attribute == 'tag':
+        vm_values = vm_record['tags']
+    elif attribute == 'other_config':
+        if '=' not in value:
+            # other_config:backup - key is present
+            return value in vm_record['other_config']
+        (other_config_key, value) = value.split('=', 1)
+        vm_values = [vm_record['other_config'][x] for x in [other_config_key] if x in vm_record['other_config']]
+    elif attribute == 'sr':
+        vm_values = []
+        for vbd_ref in vm_record['VBDs']:
+            vbd = xapi_cache.get_record('VBD', vbd_ref)
+            if vbd['type'] == 'Disk' and vbd['VDI'] != 'OpaqueRef:NULL':
+                vdi = xapi_cache.get_record('VDI', vbd['VDI'])
+                vm_values.append(xapi_cache.get_record('SR', vdi['SR'])['name_label'])
+    else:
+        host_ref = get_vm_host_ref(vm_record)
+        vm_values = []
+        if host_ref != 'OpaqueRef:NULL':
+            vm_values.append(xapi_cache.get_record('host', host_ref)['name_label'])
+    for vm_value in vm_values:
+        if is_value_match(value, vm_value):
+            return True
+    return False
+
+def get_vm_host_ref(vm_record):
+    # where the vm runs, else its home server (affinity), else OpaqueRef:NULL
+    host_ref = vm_record['resident_on']
+    if host_ref == 'OpaqueRef:NULL':
+        host_ref = vm_record['affinity']
+    return host_ref
+
+def is_shard_vm(vm_name):
+    # shard_by_host: is vm_name backed up by this worker - its get_vm_host_ref
+    # is shard_host, and a vm without one is backed up by the pool master's worker
+    for vm_ref in xapi_cache.get_by_name_label('VM', vm_name):
+        vm_record = xapi_cache.get_record('VM', vm_ref)
+        if not is_pool_vm(vm_record):
+            continue
+        host_ref = get_vm_host_ref(vm_record)
+        if host_ref == 'OpaqueRef:NULL':
+            host_ref = xapi_cache.get_all_records('pool').values()[0]['master']
+        return xapi_cache.get_record('host', host_ref)['name_label'] == shard_host
+    return False
+
+def is_value_match(selector, value):
+    pattern = get_selector_pattern(selector)
+    if pattern is None:
+        return selector == value
+    return pattern.match(value) is not None
+
+def get_selector_pattern(selector):
+    # compiled regex of selector, None for a plain name
+    if selector not in vm_selectors:
+        if isNormalVmName(selector):
+            vm_selectors[selector] = None
+        else:
+            vm_selectors[selector] = re.compile(selector)
+    return vm_selectors[selector]
+
+def isAttributeSelector( str ):
+    return str.count(':') >= 1 and str.split(':', 1)[0] in VM_ATTRIBUTE_SELECTORS
+
+def isSelectorValid( str ):
+    # plain vm name, valid regex or attribute selector with a plain/regex value
+    if isAttributeSelector(str):
+        (attribute, value) = str.split(':', 1)
+        if attribute == 'other_config':
+            value = value.split('=', 1)[-1]
+        str = value
+    return isNormalVmName(str) or isRegExValid(str)
 
 def isNormalVmName( str ):
     if re.match('^[\w\s\-\_]+$', str) is not None:
@@ -1172,7 +4528,7 @@ def verify_exclude_vms_exist():
 
 def verify_vm_exist(vm_name):
 
-    vm = session.xenapi.VM.get_by_name_label(vm_name)
+    vm = xapi_cache.get_by_name_label('VM', vm_name)
     if (len(vm) == 0):
         return False
     else:
@@ -1205,118 +4561,31 @@ def show_vms_not_in_backup():
 
 def cleanup_vmexport_vdiexport_dups():
     # if any vdi-export's exist in vm-export's then remove from vm-export
-    for vdi_parm in config['vdi-export']:
-        # vdi_parm has form PRD-name or PRD-name:5
-        tmp_vdi_parm = get_vm_name(vdi_parm)
-        for vm_parm in config['vm-export']:
-            tmp_vm_parm = get_vm_name(vm_parm)
-            if tmp_vm_parm == tmp_vdi_parm:
-                log('***WARNING vdi-export duplicate - removing vm-export=%s' % vm_parm)
-                config['vm-export'].remove(vm_parm)
+    # vdi_parm has form PRD-name or PRD-name:5
+    vdi_export_vms = set([get_vm_name(vdi_parm) for vdi_parm in config['vdi-export']])
+    vm_export = []
+    for vm_parm in config['vm-export']:
+        if get_vm_name(vm_parm) in vdi_export_vms:
+            log('***WARNING vdi-export duplicate - removing vm-export=%s' % vm_parm)
+        else:
+            vm_export.append(vm_parm)
+    config['vm-export'] = vm_export
     # remove duplicates
     config['vdi-export']=RemoveDup(config['vdi-export'])
     config['vm-export']=RemoveDup(config['vm-export'])
 
 def RemoveDup(duplicate):
-  # OK, this access to excludes works, good! Can use internally then.
-  #print 'exclude list: %s ' % config['exclude']
-  #print 'exclude element 0: %s' % config['exclude'][0]
-  #print 'exclude element 1: %s' % config['exclude'][1]
-  final_list=[]
+  # keep one entry per vm: a later PRD-name:N replaces an earlier entry of
+  # the same vm in its place, and excluded vms are dropped
+  excluded = set(config['exclude'])
+  final_list = collections.OrderedDict()
   for val in duplicate:
-    ##print '===== val: %s' % val
-
-    # check if version exists and if so, take account of extra versions
-    # as well as if a numbered wildcarded version already exists!
-    versioned=0
-    accounted=0
-    # version flag here for debugging and tracking purposes, only
-    if (val.find(':')!=-1):
-       # found version in new VM entry and need to expand
-       (valroot,numb) = val.split(':')
-       ##print 'found version to check: %s %s' % (val, valroot)
-       versioned=1
-    else:
-       versioned=0
-       # set root to be the same
-       valroot=val
-       ##print 'valroot set to be val if simple name: %s' % valroot
-
-    # Need to replace old with new if found
-    # Redo list and replace with new value
-    # Loop on index, starting with 0 and if root is the same,
-    # sub in new value; last index in array is len(array)-1 since len(array)
-    # is the number of elements in an array.
-    alen=len(final_list)
-    i=0
-    # # #
-    while i < alen:
-       if (final_list[i].find(':')!=-1):
-         (finroot,fnumb)= final_list[i].split(':')
-       else:
-         finroot=final_list[i]
-         ##print 'index: val, valroot, final_list, finroot: %s %s %s %s %s ' % (i, val, valroot, final_list[i], finroot)
-       if (valroot == finroot):
-          #root matches, hence replace
-          ##print '*** Replacing final_list with val, i: %s %s %s' % (final_list[i], val, i)
-          final_list[i]=val
-
-          # check again if excluded
-          ##print 'check again if excluded ........'
-          j=0
-          elen=len(config['exclude'])
-          while j < elen:
-             eroot=config['exclude'][j]
-             ##print 'valroot:%s' % valroot
-             ##print 'eroot:%s' % eroot
-             ##print 'final_list[i]:%s' % final_list[i]
-             ##print 'val:%s' % val
-             if (valroot == eroot):
-                # remove from list
-                log ('***WARNING - forcing exclude of: %s ' % final_list[i])
-                accounted=1
-                final_list.remove(final_list[i])
-                break
-             else:
-                j=j+1
-
-          # VM has been accounted for
-          accounted=1
-          ##print 'VM (val) has been accounted for, accounted: %s %s' % (val, accounted)
-          break
-       else:
-          i=i+1
-
-    # need to check plain case if not accounted for yet
-    ##print 'Not found anywhere else... accounted=%s' % accounted
-    # However, check again if excluded and if so, do not add to list
-    ##print 'check YET again if excluded !!!!!!!!'
-    j=0
-    elen=len(config['exclude'])
-    while j < elen:
-       eroot=config['exclude'][j]
-       ##print 'valroot:%s' % valroot
-       ##print 'eroot:%s' % eroot
-       ###print 'final_list[i]:%s' % final_list[i]
-       ##print 'val:%s' % val
-       if (valroot == eroot):
-          # prevent from being added back onto the list
-          log ('***WARNING - forcing exclude of: %s ' % val)
-          accounted=1
-          ##print '=== Force accounted to be on:%s' % accounted
-          break
-       else:
-          j=j+1
-
-    if (accounted == 0):
-      if val not in final_list:
-        final_list.append(val)
-        ##print ' end block -- appended val to list: %s' % val
-      else:
-        # it should now never actually get here!
-        print 'SHOULD NEVER GET HERE  ----- found duplicate: %s' % val
-
-  return final_list
+    valroot = val.split(':')[0]
+    if valroot in excluded:
+      log ('***WARNING - forcing exclude of: %s ' % val)
+      continue
+    final_list[valroot] = val
+  return final_list.values()
 
 def config_load_defaults():
     # init config param not already loaded then load with default values
@@ -1330,6 +4599,74 @@ def config_load_defaults():
         config['backup_dir'] = str(DEFAULT_BACKUP_DIR)
     if not 'status_log' in config.keys():
         config['status_log'] = str(DEFAULT_STATUS_LOG)
+    if not 'max_parallel' in config.keys():
+        config['max_parallel'] = str(DEFAULT_MAX_PARALLEL)
+    if not 'max_per_sr' in config.keys():
+        config['max_per_sr'] = str(DEFAULT_MAX_PER_SR)
+    if not 'max_per_host' in config.keys():
+        config['max_per_host'] = str(DEFAULT_MAX_PER_HOST)
+    if not 'order' in config.keys():
+        config['order'] = str(DEFAULT_ORDER)
+    if not 'export_method' in config.keys():
+        config['export_method'] = str(DEFAULT_EXPORT_METHOD)
+    if not 'export_chunk_size' in config.keys():
+        config['export_chunk_size'] = str(DEFAULT_EXPORT_CHUNK_SIZE)
+    if not 'compress_codec' in config.keys():
+        config['compress_codec'] = str(DEFAULT_COMPRESS_CODEC)
+    if not 'compress_level' in config.keys():
+        config['compress_level'] = str(COMPRESS_DEFAULT_LEVEL.get(config['compress_codec'], 0))
+    if not 'compress_procs' in config.keys():
+        config['compress_procs'] = str(DEFAULT_COMPRESS_PROCS)
+    if not 'backup_store' in config.keys():
+        config['backup_store'] = str(DEFAULT_BACKUP_STORE)
+    if not 'vdi_export_cbt' in config.keys():
+        config['vdi_export_cbt'] = str(DEFAULT_VDI_EXPORT_CBT)
+    config['vdi_export_cbt'] = config['vdi_export_cbt'].lower()
+    if not 'cbt_full_every' in config.keys():
+        config['cbt_full_every'] = str(DEFAULT_CBT_FULL_EVERY)
+    if not 'vdi_export_sparse' in config.keys():
+        config['vdi_export_sparse'] = str(DEFAULT_VDI_EXPORT_SPARSE)
+    config['vdi_export_sparse'] = config['vdi_export_sparse'].lower()
+    if not 'xapi_events' in config.keys():
+        config['xapi_events'] = str(DEFAULT_XAPI_EVENTS)
+    config['xapi_events'] = config['xapi_events'].lower()
+    if not 'throttle_mbps' in config.keys():
+        config['throttle_mbps'] = str(DEFAULT_THROTTLE_MBPS)
+    if not 'throttle_mbps_job' in config.keys():
+        config['throttle_mbps_job'] = str(DEFAULT_THROTTLE_MBPS_JOB)
+    if not 'resume_window' in config.keys():
+        config['resume_window'] = str(DEFAULT_RESUME_WINDOW)
+    if not 'checksum' in config.keys():
+        config['checksum'] = DEFAULT_CHECKSUM
+    config['checksum'] = config['checksum'].lower()
+    if not 'xva_validate' in config.keys():
+        config['xva_validate'] = DEFAULT_XVA_VALIDATE
+    config['xva_validate'] = config['xva_validate'].lower()
+    if not 'metrics_port' in config.keys():
+        config['metrics_port'] = DEFAULT_METRICS_PORT
+    if not 'metrics_textfile' in config.keys():
+        config['metrics_textfile'] = DEFAULT_METRICS_TEXTFILE
+    if not 'run_report' in config.keys():
+        config['run_report'] = DEFAULT_RUN_REPORT
+    config['run_report'] = config['run_report'].lower()
+    if not 'adaptive_parallel' in config.keys():
+        config['adaptive_parallel'] = DEFAULT_ADAPTIVE_PARALLEL
+    config['adaptive_parallel'] = config['adaptive_parallel'].lower()
+    if not 'shard_by_host' in config.keys():
+        config['shard_by_host'] = str(DEFAULT_SHARD_BY_HOST)
+    config['shard_by_host'] = config['shard_by_host'].lower()
+    if not 'rpo' in config.keys():
+        config['rpo'] = str(DEFAULT_RPO)
+    if not 'start_time' in config.keys():
+        config['start_time'] = DEFAULT_START_TIME
+    if not 'stop_time' in config.keys():
+        config['stop_time'] = DEFAULT_STOP_TIME
+    # vm-rpo, blackout and throttle_window may be given several times
+    for key in ['vm-rpo', 'blackout', 'throttle_window']:
+        if not key in config.keys():
+            config[key] = []
+        elif type(config[key]) is not list:
+            config[key] = [config[key]]
 
 def config_print():
     log('VmBackup.py running with these settings:')
@@ -1339,6 +4676,39 @@ def config_print():
     log('  max_backups       = %s' % config['max_backups'])
     log('  vdi_export_format = %s' % config['vdi_export_format'])
     log('  pool_db_backup    = %s' % config['pool_db_backup'])
+    log('  max_parallel      = %s' % config['max_parallel'])
+    log('  adaptive_parallel = %s' % config['adaptive_parallel'])
+    log('  max_per_sr        = %s' % config['max_per_sr'])
+    log('  max_per_host      = %s' % config['max_per_host'])
+    log('  order             = %s' % config['order'])
+    log('  export_method     = %s' % config['export_method'])
+    log('  export_chunk_size = %sK' % config['export_chunk_size'])
+    log('  compress_codec    = %s' % config['compress_codec'])
+    log('  backup_store      = %s' % config['backup_store'])
+    log('  vdi_export_cbt    = %s' % config['vdi_export_cbt'])
+    if config['vdi_export_cbt'] == 'true':
+        log('  cbt_full_every    = %s' % config['cbt_full_every'])
+    log('  vdi_export_sparse = %s' % config['vdi_export_sparse'])
+    log('  resume_window     = %s' % config['resume_window'])
+    log('  checksum          = %s' % config['checksum'])
+    log('  xva_validate      = %s' % config['xva_validate'])
+    log('  throttle_mbps     = %s' % config['throttle_mbps'])
+    log('  throttle_mbps_job = %s' % config['throttle_mbps_job'])
+    log('  throttle_window   = %s' % ', '.join(config['throttle_window']))
+    log('  run_report        = %s' % config['run_report'])
+    log('  metrics_port      = %s' % config['metrics_port'])
+    log('  metrics_textfile  = %s' % config['metrics_textfile'])
+    log('  xapi_events       = %s' % config['xapi_events'])
+    log('  shard_by_host     = %s' % config['shard_by_host'])
+    if daemon:
+        log('  rpo               = %s' % config['rpo'])
+        log('  vm-rpo            = %s' % ', '.join(config['vm-rpo']))
+        log('  start_time        = %s' % config['start_time'])
+        log('  stop_time         = %s' % config['stop_time'])
+        log('  blackout          = %s' % ', '.join(config['blackout']))
+    if config['compress_codec'] != 'none':
+        log('  compress_level    = %s' % config['compress_level'])
+        log('  compress_procs    = %s' % config['compress_procs'])
 
     log('  exclude (cnt)= %s' % len(config['exclude']))
     str = ''
@@ -1364,29 +4734,143 @@ def config_print():
         str = str[:-2]
     log('  vm-export: %s' % str)
 
+def new_job_report(job, size):
+    # per phase timings of one vm backup, see report_phase
+    #   size - estimated bytes to export
+    #   status of a phase - '' not run, 'success' or 'error', see end_open_phase
+    phases = collections.OrderedDict()
+    for phase in RUN_REPORT_PHASES:
+        phases[phase] = {'secs': 0.0, 'bytes': 0, 'status': ''}
+    # phase, exported, export_begin and last_progress are the live state for the metrics
+    now = time.time()
+    return {'vm_name': job['vm_name'], 'export_type': job['export_type'], 'begin': now, 'phases': phases,
+        'size': size, 'phase': '', 'exported': 0, 'export_begin': 0, 'last_progress': now}
+
+def begin_phase(phase):
+    # the running vm backup enters phase, returns the begin time for report_phase
+    now = time.time()
+    job_report = getattr(thread_data, 'job_report', None)
+    if job_report is not None:
+        # note - per thread, the disks of a vdi-export share their job_report
+        thread_data.open_phase = (phase, now)
+        report_lock.acquire()
+        try:
+            job_report['phase'] = phase
+            job_report['last_progress'] = now
+            if phase == 'export' and job_report['export_begin'] == 0:
+                job_report['export_begin'] = now
+        finally:
+            report_lock.release()
+    return now
+
+def count_export_bytes(nbytes):
+    # stream_to_file: nbytes more data of the running vm backup exported
+    if concurrency_controller is not None:
+        concurrency_controller.add_bytes(nbytes)
+    job_report = getattr(thread_data, 'job_report', None)
+    if job_report is not None:
+        report_lock.acquire()
+        try:
+            job_report['exported'] += nbytes
+            job_report['last_progress'] = time.time()
+        finally:
+            report_lock.release()
+
+def report_phase(phase, begin, nbytes=0, status='success'):
+    # add the time since begin and the nbytes written to phase of the running vm backup
+    # note - the disks of a vdi-export add up, so their phases may exceed the elapse,
+    #   and one disk with an error phase makes that phase an error
+    job_report = getattr(thread_data, 'job_report', None)
+    if job_report is None:
+        return
+    thread_data.open_phase = None
+    report_lock.acquire()
+    try:
+        job_report['phases'][phase]['secs'] += time.time() - begin
+        job_report['phases'][phase]['bytes'] += nbytes
+        if job_report['phases'][phase]['status'] != 'error':
+            job_report['phases'][phase]['status'] = status
+    finally:
+        report_lock.release()
+
+def end_open_phase():
+    # a phase begun but not reported - its step returned early or raised -
+    # goes into the report as an error with the time spent in it
+    open_phase = getattr(thread_data, 'open_phase', None)
+    if open_phase is not None:
+        report_phase(open_phase[0], open_phase[1], status='error')
+
+def log_job_report(job_report, this_status):
+    # log the phase timings of a finished vm backup and append them to the
+    # run_report files beside the status_log, one json line per vm backup
+    # and one csv row per phase, so that runs can be compared over time
+    elapse = time.time() - job_report['begin']
+    phases = []
+    for (phase, timing) in job_report['phases'].items():
+        phases.append(collections.OrderedDict([('phase', phase), ('secs', round(timing['secs'], 3)),
+            ('bytes', timing['bytes']), ('mb_per_sec', round(timing['bytes'] / (1024.0 * 1024) / timing['secs'], 1) if timing['secs'] > 0 else 0),
+            ('status', timing['status'])]))
+    log('phases: %s' % ', '.join(['%s %.1fs' % (x['phase'], x['secs']) + (' %sMB/s' % x['mb_per_sec'] if x['bytes'] > 0 else '') +
+        (' ERROR' if x['status'] == 'error' else '') for x in phases]))
+    if not config_specified or config['run_report'] == 'none':
+        return
+    report = collections.OrderedDict([('run_begin', time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(run_begin_time))),
+        ('begin', time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(job_report['begin']))),
+        ('vm_name', job_report['vm_name']), ('export_type', job_report['export_type']),
+        ('status', this_status), ('elapse_secs', round(elapse, 3)), ('phases', phases)])
+    report_base = os.path.splitext(config['status_log'])[0]
+    report_lock.acquire()
+    try:
+        if 'json' in config['run_report'].split(','):
+            open(report_base + '-report.json', 'a').write(json.dumps(report) + '\n')
+        if 'csv' in config['run_report'].split(','):
+            new_file = not os.path.exists(report_base + '-report.csv')
+            report_file = open(report_base + '-report.csv', 'ab')
+            try:
+                writer = csv.writer(report_file)
+                if new_file:
+                    writer.writerow(['run_begin', 'begin', 'vm_name', 'export_type', 'status', 'elapse_secs', 'phase', 'secs', 'bytes', 'mb_per_sec', 'phase_status'])
+                for x in phases:
+                    writer.writerow([report['run_begin'], report['begin'], report['vm_name'], report['export_type'],
+                        this_status, report['elapse_secs'], x['phase'], x['secs'], x['bytes'], x['mb_per_sec'], x['status']])
+            finally:
+                report_file.close()
+    except (IOError, OSError), e:
+        log('WARNING run_report %s - %s' % (report_base, e))
+    finally:
+        report_lock.release()
+
+def status_log_write(rec):
+    # status_log records from the max_parallel workers must not interleave
+    status_log_lock.acquire()
+    try:
+        open(config['status_log'],'a',0).write(rec)
+    finally:
+        status_log_lock.release()
+
 def status_log_begin(server):
     rec_begin = '%s,vmbackup.py,%s,begin\n' % (fmtDateTime(), server)
-    open(config['status_log'],'a',0).write(rec_begin)
+    status_log_write(rec_begin)
 
 def status_log_end(server, status):
     rec_end = '%s,vmbackup.py,%s,end,%s\n' % (fmtDateTime(), server, status)
-    open(config['status_log'],'a',0).write(rec_end)
+    status_log_write(rec_end)
 
 def status_log_vm_export_begin(server, status):
     rec_begin = '%s,vm-export,%s,begin,%s\n' % (fmtDateTime(), server, status)
-    open(config['status_log'],'a',0).write(rec_begin)
+    status_log_write(rec_begin)
 
 def status_log_vm_export_end(server, status):
     rec_end = '%s,vm-export,%s,end,%s\n' % (fmtDateTime(), server, status)
-    open(config['status_log'],'a',0).write(rec_end)
+    status_log_write(rec_end)
 
 def status_log_vdi_export_begin(server, status):
     rec_begin = '%s,vdi-export,%s,begin,%s\n' % (fmtDateTime(), server, status)
-    open(config['status_log'],'a',0).write(rec_begin)
+    status_log_write(rec_begin)
 
 def status_log_vdi_export_end(server, status):
     rec_end = '%s,vdi-export,%s,end,%s\n' % (fmtDateTime(), server, status)
-    open(config['status_log'],'a',0).write(rec_end)
+    status_log_write(rec_end)
 
 def fmtDateTime():
     date = datetime.datetime.today()
@@ -1398,19 +4882,363 @@ def log(mes, log_w_timestamp=True):
     # note - send_email uses message
     global message
 
+    # with max_parallel workers, tag each line with the vm being processed
+    vm_name = getattr(thread_data, 'vm_name', None)
+    if vm_name:
+        mes = '[%s] %s' % (vm_name, mes)
+
     date = datetime.datetime.today()
     if log_w_timestamp:
         str = '%02d-%02d-%02d-(%02d:%02d:%02d) - %s\n' \
             % (date.year, date.month, date.day, date.hour, date.minute, date.second, mes)
     else:
         str = '%s\n' % mes
-    message += str
 
-    #if verbose: (old option, now always verbose)
-    str = str.rstrip("\n")
-    print str
-    sys.stdout.flush()
-    sys.stderr.flush()
+    log_lock.acquire()
+    try:
+        message += str
+
+        #if verbose: (old option, now always verbose)
+        str = str.rstrip("\n")
+        print str
+        sys.stdout.flush()
+        sys.stderr.flush()
+    finally:
+        log_lock.release()
+
+class ShardLeases:
+    # shard_by_host: lease files below backup_dir/SHARD_LEASE_DIR, so that the
+    # VmBackup.py workers of the pool members never back up the same vm at once
+    # note - a lease is created with O_EXCL and renewed (mtime) every
+    #   SHARD_LEASE_HEARTBEAT_SECS by a heartbeat thread. A lease that was not
+    #   renewed for SHARD_LEASE_STALE_SECS is taken over by renaming it away first,
+    #   so that only one worker wins.
+
+    def __init__(self, lease_dir, owner):
+        self.lease_dir = lease_dir
+        self.owner = owner
+        self.lock = threading.Lock()
+        self.held = {}
+        self.heartbeat = None
+        self.running = False
+        if not os.path.isdir(lease_dir):
+            try:
+                os.makedirs(lease_dir)
+            except OSError, e:
+                # another worker may have just created it
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def path(self, vm_name):
+        return os.path.join(self.lease_dir, vm_name + '.lease')
+
+    def acquire(self, vm_name):
+        # None if vm_name is now leased by this worker, else the holder of the lease
+        path = self.path(vm_name)
+        holder = 'unknown'
+        for attempt in range(3):
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+                try:
+                    holder = open(path, 'r').read().strip()
+                    age = time.time() - os.path.getmtime(path)
+                except (IOError, OSError):
+                    # released meanwhile
+                    continue
+                if age < SHARD_LEASE_STALE_SECS or not self.take_over(path, holder):
+                    return holder
+                log('WARNING stale lease of %s taken over from %s' % (vm_name, holder))
+                continue
+            os.write(fd, '%s\n' % self.owner)
+            os.close(fd)
+            self.lock.acquire()
+            try:
+                self.held[vm_name] = path
+            finally:
+                self.lock.release()
+            return None
+        return holder
+
+    def take_over(self, path, holder):
+        # remove the stale lease of holder, False if another worker was faster
+        stale_path = '%s.%s.stale' % (path, os.getpid())
+        try:
+            os.rename(path, stale_path)
+        except OSError:
+            return False
+        if open(stale_path, 'r').read().strip() != holder or \
+            time.time() - os.path.getmtime(stale_path) < SHARD_LEASE_STALE_SECS:
+            # renamed the new lease of the faster worker - put it back
+            try:
+                os.link(stale_path, path)
+            except OSError:
+                pass
+            os.remove(stale_path)
+            return False
+        os.remove(stale_path)
+        return True
+
+    def release(self, vm_name):
+        self.lock.acquire()
+        try:
+            path = self.held.pop(vm_name, None)
+        finally:
+            self.lock.release()
+        if path is not None and os.path.exists(path):
+            os.remove(path)
+
+    def others_active(self):
+        # is a lease of another worker (not stale) present
+        for name in os.listdir(self.lease_dir):
+            path = os.path.join(self.lease_dir, name)
+            if path in self.held.values():
+                continue
+            try:
+                if time.time() - os.path.getmtime(path) < SHARD_LEASE_STALE_SECS:
+                    return True
+            except OSError:
+                pass
+        return False
+
+    def start_heartbeat(self):
+        self.running = True
+        self.heartbeat = threading.Thread(target=self.renew, name='lease-heartbeat')
+        self.heartbeat.setDaemon(True)
+        self.heartbeat.start()
+
+    def stop_heartbeat(self):
+        if self.heartbeat is None:
+            return
+        self.running = False
+        self.heartbeat.join(SHARD_LEASE_HEARTBEAT_SECS + 5)
+        self.heartbeat = None
+
+    def renew(self):
+        last_renew = time.time()
+        while self.running:
+            time.sleep(1)
+            if time.time() - last_renew < SHARD_LEASE_HEARTBEAT_SECS:
+                continue
+            last_renew = time.time()
+            self.lock.acquire()
+            try:
+                paths = self.held.values()
+            finally:
+                self.lock.release()
+            for path in paths:
+                try:
+                    os.utime(path, None)
+                except OSError, e:
+                    log('WARNING lease renew %s - %s' % (path, e))
+
+def start_shard_leases(server_name):
+    global shard_leases
+    shard_leases = ShardLeases(os.path.join(config['backup_dir'], SHARD_LEASE_DIR),
+        '%s:%s:%s' % (shard_host, server_name, os.getpid()))
+    shard_leases.start_heartbeat()
+
+def stop_shard_leases():
+    global shard_leases
+    if shard_leases is not None:
+        shard_leases.stop_heartbeat()
+        shard_leases = None
+
+class XapiCache:
+    # per-run cache of the xapi records of XAPI_CACHE_CLASSES, indexed by
+    # ref, uuid and name_label: one <class>.get_all_records call per class
+    # instead of a get_record round-trip per vm and device
+    # note - only for the vm/disk/network metadata that does not change during
+    #   a run; snapshots, power_state, cbt and tasks are always read from xapi.
+    #   Objects created after the prefetch are fetched (and added) on first use.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = {}
+        self.by_uuid = {}
+        self.by_name_label = {}
+        self.watcher = None
+        self.watching = False
+        self.events_applied = 0
+
+    def prefetch(self):
+        for cls in XAPI_CACHE_CLASSES:
+            self.index(cls)
+        log('xapi cache: %s' % ' '.join(['%s:%s' % (cls, len(self.records[cls])) for cls in XAPI_CACHE_CLASSES]))
+
+    def index(self, cls):
+        # {ref: record} of cls, loaded with get_all_records on first use
+        self.lock.acquire()
+        try:
+            if cls not in self.records:
+                self.records[cls] = {}
+                self.by_uuid[cls] = {}
+                self.by_name_label[cls] = {}
+                for (ref, record) in getattr(get_session().xenapi, cls).get_all_records().items():
+                    self.add(cls, ref, record)
+            return self.records[cls]
+        finally:
+            self.lock.release()
+
+    def add(self, cls, ref, record):
+        # note - caller holds self.lock
+        self.remove(cls, ref)
+        self.records[cls][ref] = record
+        self.by_uuid[cls][record['uuid']] = ref
+        if 'name_label' in record:
+            self.by_name_label[cls].setdefault(record['name_label'], []).append(ref)
+
+    def remove(self, cls, ref):
+        # note - caller holds self.lock
+        record = self.records[cls].pop(ref, None)
+        if record is None:
+            return
+        if self.by_uuid[cls].get(record['uuid']) == ref:
+            del self.by_uuid[cls][record['uuid']]
+        if ref in self.by_name_label[cls].get(record.get('name_label'), []):
+            self.by_name_label[cls][record['name_label']].remove(ref)
+
+    def apply_events(self, events):
+        # apply an event.from batch: add/mod replace the record, del removes it
+        # note - event classes are lower case, e.g. 'vm'
+        classes = dict([(cls.lower(), cls) for cls in XAPI_EVENT_CLASSES])
+        for cls in XAPI_EVENT_CLASSES:
+            self.index(cls)
+        self.lock.acquire()
+        try:
+            for event in events:
+                cls = classes.get(event['class'].lower())
+                if cls is None:
+                    continue
+                if event['operation'] == 'del':
+                    self.remove(cls, event['ref'])
+                elif 'snapshot' in event:
+                    self.add(cls, event['ref'], event['snapshot'])
+                self.events_applied += 1
+        finally:
+            self.lock.release()
+
+    def start_watch(self):
+        # xapi_events: apply the event.from deltas of XAPI_EVENT_CLASSES on a
+        # thread with its own xapi session, instead of re-reading records
+        self.watching = True
+        self.watcher = threading.Thread(target=self.watch, name='xapi-events')
+        self.watcher.setDaemon(True)
+        self.watcher.start()
+
+    def stop_watch(self):
+        if self.watcher is None:
+            return
+        self.watching = False
+        self.watcher.join(XAPI_EVENT_TIMEOUT + 5)
+        self.watcher = None
+        log('xapi events: %s applied' % self.events_applied)
+
+    def watch(self):
+        # note - the first event.from (empty token) returns all objects
+        #   which closes the gap to the get_all_records prefetch
+        tmp_session = None
+        token = ''
+        while self.watching:
+            try:
+                if tmp_session is None:
+                    tmp_session = xapi_login()
+                # note - 'from' is a python keyword
+                result = getattr(tmp_session.xenapi.event, 'from')(XAPI_EVENT_CLASSES, token, XAPI_EVENT_TIMEOUT)
+                token = result['token']
+                self.apply_events(result['events'])
+            except XenAPI.Failure, e:
+                if e.details[0] == 'EVENTS_LOST':
+                    log('WARNING xapi events lost - reading all records again')
+                    token = ''
+                else:
+                    log('WARNING event.from - %s' % e)
+                    time.sleep(5)
+            except Exception, e:
+                # no xapi_events must not end the backup run
+                log('WARNING event.from - %s' % e)
+                time.sleep(5)
+        if tmp_session is not None:
+            xapi_logout(tmp_session)
+
+    def get_record(self, cls, ref):
+        # note - looked up under the lock, the xapi_events watcher may remove ref meanwhile
+        records = self.index(cls)
+        self.lock.acquire()
+        try:
+            record = records.get(ref)
+        finally:
+            self.lock.release()
+        if record is None:
+            record = getattr(get_session().xenapi, cls).get_record(ref)
+            self.lock.acquire()
+            try:
+                self.add(cls, ref, record)
+            finally:
+                self.lock.release()
+        return record
+
+    def get_by_uuid(self, cls, uuid):
+        self.index(cls)
+        self.lock.acquire()
+        try:
+            ref = self.by_uuid[cls].get(uuid)
+        finally:
+            self.lock.release()
+        if ref is None:
+            ref = getattr(get_session().xenapi, cls).get_by_uuid(uuid)
+            self.get_record(cls, ref)
+        return ref
+
+    def get_by_name_label(self, cls, name_label):
+        self.index(cls)
+        self.lock.acquire()
+        try:
+            return list(self.by_name_label[cls].get(name_label, []))
+        finally:
+            self.lock.release()
+
+    def get_all_records(self, cls):
+        # copy of {ref: record}, safe to iterate while xapi_events updates the cache
+        records = self.index(cls)
+        self.lock.acquire()
+        try:
+            return dict(records)
+        finally:
+            self.lock.release()
+
+def get_session():
+    # xapi session of the current worker thread, else the main session
+    tmp_session = getattr(thread_data, 'session', None)
+    if tmp_session is not None:
+        return tmp_session
+    return session
+
+def xapi_login():
+    # acquire a xapi session by logging in
+    # note - on a pool slave the login is redirected to the pool master
+    # note - session.xapi_url is kept for the export_method=http requests
+    username = 'root'
+    tmp_session = XenAPI.Session(xapi_url)
+    tmp_session.xapi_url = xapi_url
+    try:
+        tmp_session.xenapi.login_with_password(username, password)
+    except XenAPI.Failure, e:
+        if e.details[0] == 'HOST_IS_SLAVE':
+            tmp_session = XenAPI.Session('http://' + e.details[1])
+            tmp_session.xapi_url = 'http://' + e.details[1]
+            tmp_session.xenapi.login_with_password(username, password)
+        else:
+            raise
+    return tmp_session
+
+def xapi_logout(tmp_session):
+    try:
+        tmp_session.xenapi.session.logout()
+    except Exception, e:
+        log('WARNING xapi logout - %s' % e)
 
 def run(cmd, do_log=True):
     proc = subprocess.Popen(cmd, stdout=PIPE, stderr=STDOUT, shell=True)
@@ -1450,6 +5278,9 @@ def usage_help():
     print '  [compress=True|False] - only for vm-export functions automatic compression (default: False)'
     print '  [ignore_extra_keys=True|False] - some config files may have extra params (default: False)'
     print '  [pre_clean=True|False] - delete older backup(s) before performing new backup (default: False)'
+    print '  [max_parallel=N] - number of vm backups to run at the same time, overrides config (default: 1)'
+    print '  [daemon=True|False] - keep running and back up each vm when due by its rpo (default: False)'
+    print '  [shard_host=host-name] - with shard_by_host=true, back up the vms of this pool host (default: this host)'
     print
     print 'alternate form - create-password-file:'
     print sys.argv[0], ' <password> create-password-file=filename'
@@ -1457,6 +5288,42 @@ def usage_help():
     print '  create-password-file=filename - create an obscured password file with the specified password'
     print '  note - password filename is relative to current path or absolute path.'
     print
+    print 'alternate form - cbt-restore:'
+    print sys.argv[0], ' cbt-restore=backup-dir/DISK-device raw-file'
+    print
+    print '  cbt-restore=backup-dir/DISK-device - write the full raw image of a vdi_export_cbt disk backup to raw-file'
+    print
+    print 'alternate form - chunk-cat:'
+    print sys.argv[0], ' chunk-cat=manifest-file'
+    print
+    print '  chunk-cat=manifest-file - write the export of a backup_store=chunks backup to stdout'
+    print '  example: ./VmBackup.py chunk-cat=/snapshots/BACKUPS/vm/backup-date/vm.xva.manifest | xe vm-import filename=/dev/stdin'
+    print
+    print 'alternate form - verify:'
+    print sys.argv[0], ' verify=backup_dir|vm-backup-dir|backup-dir [parallel=N] [mbps=N]'
+    print
+    print '  verify=path - re-hash the backup files with a checksum=sha256 sidecar in the successful backups below path'
+    print '  [parallel=N] - backup files re-hashed at the same time (default: 2)'
+    print '  [mbps=N] - MB/s read cap of all of them together, 0 - unlimited (default: 0)'
+    print '  note - exits 1 if any backup file is corrupt or missing'
+    print
+    print 'alternate form - restore:'
+    print sys.argv[0], ' <password|password-file> restore=backup_dir|vm-backup-dir|backup-dir [vm=vm-regex] [sr=sr] [max_parallel=N] [throttle_mbps=N] [preview]'
+    print
+    print '  restore=path - import the latest successful backup of each vm below path as a new vm, also vdi-export backups'
+    print '  [vm=vm-regex] - only the vms whose name matches (default: all)'
+    print '  [sr=sr-name-label|sr-uuid] - sr of the restored disks (default: the pool default sr)'
+    print '  [max_parallel=N] - number of vms imported at the same time (default: 4)'
+    print '  [throttle_mbps=N] - MB/s cap of all imports together, 0 - unlimited (default: 0)'
+    print '  [preview] - list the backups that would be restored'
+    print '  note - exits 1 if any vm was not restored'
+    print
+    print 'alternate form - validate-xva:'
+    print sys.argv[0], ' validate-xva=xva-file|-'
+    print
+    print '  validate-xva=xva-file - check that an xva (or xva.gz) file is complete and its chunks match their checksums, - for stdin'
+    print '  example: zstd -dc vm.xva.zst | ./VmBackup.py validate-xva=-'
+    print
 
 def usage_config_file():
     print 'Usage-config-file:'
@@ -1480,6 +5347,82 @@ def usage_config_file():
     print '  # vdi_export_format either raw or vhd (script default to raw)'
     print '  vdi_export_format=raw'
     print
+    print '  # number of vm backups to run at the same time (script default to 1)'
+    print '  max_parallel=1'
+    print
+    print '  # with max_parallel, limit concurrent exports per SR and per host (script default to 0=no limit)'
+    print '  max_per_sr=0'
+    print '  max_per_host=0'
+    print
+    print '  # export_method=http: grow and shrink the concurrent exports up to max_parallel by measured'
+    print '  # throughput, storage latency and dom0 load (script default to false)'
+    print '  adaptive_parallel=false'
+    print
+    print '  # order of vm backups: config, size or history - largest/longest first (script default to config)'
+    print '  order=config'
+    print
+    print '  # export data with xe or streamed over http by VmBackup (script default to xe)'
+    print '  export_method=xe'
+    print '  # export_method=http read/write size in KB (script default to 1024)'
+    print '  export_chunk_size=1024'
+    print
+    print '  # export_method=http compression by VmBackup: none, gzip, zstd or lz4 (script default to none)'
+    print '  compress_codec=none'
+    print '  # compress_codec level (script default per codec) and processes (script default 0=one per cpu)'
+    print '  #compress_level=6'
+    print '  compress_procs=0'
+    print
+    print '  # backup_store: file or chunks - deduplicated chunk store, requires export_method=http (script default to file)'
+    print '  backup_store=file'
+    print
+    print '  # vdi-export only changed blocks (CBT, XenServer 7.3+), read over NBD if the pool has an nbd network,'
+    print '  # requires export_method=http (script default to false)'
+    print '  vdi_export_cbt=false'
+    print '  # with vdi_export_cbt every Nth backup is a full backup (script default to 7)'
+    print '  cbt_full_every=7'
+    print
+    print '  # raw vdi-export with export_method=http writes sparse files, zero blocks are skipped (script default to true)'
+    print '  vdi_export_sparse=true'
+    print
+    print '  # hours a failed raw vdi-export over http is resumed on the next run, 0 - start over (script default to 0)'
+    print '  resume_window=0'
+    print
+    print '  # sha256 of each export computed while it is written, to <backup-file>.sha256 (script default to none)'
+    print '  checksum=none'
+    print
+    print '  # a vm-export is only successful if its xva is complete and its chunks match their checksums (script default to false)'
+    print '  xva_validate=false'
+    print
+    print '  # export_method=http MB/s cap of all exports and of each vm, 0 - unlimited (script default to 0)'
+    print '  throttle_mbps=0'
+    print '  throttle_mbps_job=0'
+    print '  # MB/s cap of all exports during a time of day, instead of throttle_mbps, may be given several times'
+    print '  throttle_window=08:00-18:00:50'
+    print
+    print '  # append per phase timings of each vm backup to <status_log>-report.json and/or .csv:'
+    print '  # none, json, csv or json,csv (script default to none)'
+    print '  run_report=none'
+    print
+    print '  # live prometheus metrics on http://[address:]port/metrics and/or in a node_exporter textfile (script default to off)'
+    print '  metrics_port=0'
+    print '  metrics_textfile='
+    print
+    print '  # keep the pool model current from xapi events during the run (script default to false)'
+    print '  xapi_events=false'
+    print
+    print '  # run VmBackup.py on every pool member, each backs up the vms resident on it (script default to false)'
+    print '  shard_by_host=false'
+    print
+    print '  # daemon=true only: hours between the backups of each vm (script default to 24)'
+    print '  rpo=24'
+    print '  # daemon=true only: rpo per vm-selector, may be given several times'
+    print '  vm-rpo=PRD-db.*:4'
+    print '  # daemon=true only: new backups only start between start_time and stop_time'
+    print '  start_time=00:00'
+    print '  stop_time=24:00'
+    print '  # daemon=true only: no new backups start in a blackout window, may be given several times'
+    print '  blackout=08:00-09:00'
+    print
     print '  #### specific VMs backup settings ####'
     print
     print '  # vm-export VM name-label of vm to backup. One per line - notice :max_backups override.'
@@ -1487,13 +5430,21 @@ def usage_config_file():
     print '  vm-export=my-second-vm'
     print '  vm-export=my-third-vm:3'
     print
-    print '  # special vdi-export - only backs up first disk. See README Documenation!'
+    print '  # special vdi-export - backs up every disk, each into DISK-<device>. See README Documenation!'
     print '  vdi-export=my-vm-name'
+    print '  # vdi-export only some disks of a vm'
+    print '  vdi-export=my-big-vm:disks=xvda,xvdb'
     print
     print '  # vm-export using VM regular expression - notice DEV.* has :max_backups overide'
     print '  vm-export=PROD.*'
     print '  vm-export=DEV.*:2'
     print
+    print '  # vm-export by VM attribute: tag, SR of a disk, pool host or other-config key=value'
+    print '  vm-export=tag:gold'
+    print '  vm-export=sr:FastSAN:3'
+    print '  vm-export=pool-host:xs03'
+    print '  vm-export=other_config:backup=daily'
+    print
     print '  # exclude specific VMs'
     print '  exclude=PROD-WinDomainController'
     print '  exclude=DEV-DestructiveTest'
@@ -1534,6 +5485,35 @@ if __name__ == '__main__':
         if 'config' in sys.argv: usage_config_file() 
         if 'example' in sys.argv: usage_examples() 
         sys.exit(1)
+    if len(sys.argv) == 3 and sys.argv[1].lower().startswith('cbt-restore='):
+        cbt_restore(sys.argv[1].split('=', 1)[1], sys.argv[2])
+        sys.exit(0)
+    if len(sys.argv) == 2 and sys.argv[1].lower().startswith('chunk-cat='):
+        chunkstore_cat(sys.argv[1].split('=', 1)[1], sys.stdout)
+        sys.exit(0)
+    if len(sys.argv) >= 2 and sys.argv[1].lower().startswith('verify='):
+        verify_parallel = DEFAULT_VERIFY_PARALLEL
+        verify_mbps = 0.0
+        for arg in sys.argv[2:]:
+            array = arg.strip().split('=')
+            if array[0].lower() == 'parallel' and isInt(array[1]) and int(array[1]) > 0:
+                verify_parallel = int(array[1])
+            elif array[0].lower() == 'mbps':
+                verify_mbps = float(array[1])
+            else:
+                print 'ERROR invalid parm: %s' % arg
+                usage()
+                sys.exit(1)
+        if verify_backups(sys.argv[1].split('=', 1)[1], verify_parallel, verify_mbps) > 0:
+            sys.exit(1)
+        sys.exit(0)
+    if len(sys.argv) == 2 and sys.argv[1].lower().startswith('validate-xva='):
+        xva_validator = validate_xva_file(sys.argv[1].split('=', 1)[1])
+        if xva_validator.error is not None:
+            print 'ERROR %s' % xva_validator.error
+            sys.exit(1)
+        print xva_validator.summary()
+        sys.exit(0)
     if len(sys.argv) < 3:
         usage()
         sys.exit(1)
@@ -1547,12 +5527,50 @@ if __name__ == '__main__':
         open(array[1], 'w').write(base64.b64encode(password))
         print 'password file saved to: %s' % array[1]
         sys.exit(0)
+    if cfg_file.lower().startswith('restore='):
+        restore_vm_regex = None
+        restore_sr = None
+        restore_max_parallel = DEFAULT_RESTORE_PARALLEL
+        restore_preview = False
+        for arg in sys.argv[3:]:
+            array = arg.strip().split('=', 1)
+            if array[0].lower() == 'vm':
+                restore_vm_regex = array[1]
+            elif array[0].lower() == 'sr':
+                restore_sr = array[1]
+            elif array[0].lower() == 'max_parallel' and isInt(array[1]) and int(array[1]) > 0:
+                restore_max_parallel = int(array[1])
+            elif array[0].lower() == 'throttle_mbps':
+                config['throttle_mbps'] = array[1]
+            elif array[0].lower() == 'preview':
+                restore_preview = True
+            else:
+                print 'ERROR invalid parm: %s' % arg
+                usage()
+                sys.exit(1)
+        config_load_defaults()
+        try:
+            session = xapi_login()
+        except XenAPI.Failure, e:
+            print e
+            print 'ERROR - XenAPI authentication error'
+            sys.exit(1)
+        try:
+            restore_errors = restore_main(cfg_file.split('=', 1)[1], restore_vm_regex, restore_sr, restore_max_parallel, restore_preview)
+        finally:
+            xapi_logout(session)
+        if restore_errors > 0:
+            sys.exit(1)
+        sys.exit(0)
 
     # load optional params
     preview = False                 # default
     compress = False                # default
     ignore_extra_keys = False       # default
     pre_clean = False             # default
+    max_parallel = None             # default - use config or DEFAULT_MAX_PARALLEL
+    daemon = False                  # default
+    shard_host_parm = None          # default - this host, with shard_by_host=true
 
     # loop through remaining optional args
     arg_range = range(3,len(sys.argv))
@@ -1566,11 +5584,29 @@ if __name__ == '__main__':
             ignore_extra_keys = (array[1].lower() == 'true')
         elif array[0].lower() == 'pre_clean':
             pre_clean = (array[1].lower() == 'true')
+        elif array[0].lower() == 'max_parallel':
+            max_parallel = array[1]
+        elif array[0].lower() == 'daemon':
+            daemon = (array[1].lower() == 'true')
+        elif array[0].lower() == 'shard_host':
+            shard_host_parm = array[1]
         else:
             print 'ERROR invalid parm: %s' % sys.argv[arg_ix]
             usage()
             sys.exit(1)
 
+    # acquire a xapi session by logging in
+    try:
+        session = xapi_login()
+        hosts = session.xenapi.host.get_all()
+    except XenAPI.Failure, e:
+        print e
+        print 'ERROR - XenAPI authentication error'
+        sys.exit(1)
+    xapi_cache = XapiCache()
+    # note - also the VM records that the vm selectors are evaluated against
+    xapi_cache.prefetch()
+
     # init vm-export/vdi-export/exclude in config list
     config['vm-export'] = []
     config['vdi-export'] = []
@@ -1578,7 +5614,7 @@ if __name__ == '__main__':
     warning_match = False
     error_regex = False
 
-    all_vms = get_all_vms()
+    set_all_vms(get_pool_vms())
 
     # process config file
     if (os.path.exists(cfg_file)):
@@ -1594,14 +5630,20 @@ if __name__ == '__main__':
         config_specified = 0
         cmd_option = 'vm-export' # default
         cmd_vm_name = cfg_file   # in this case a vm name pattern
-        if cmd_vm_name.count('=') == 1:
-            (cmd_option,cmd_vm_name) = cmd_vm_name.strip().split('=')
+        if cmd_vm_name.count('=') >= 1:
+            (cmd_option,cmd_vm_name) = cmd_vm_name.strip().split('=', 1)
         if cmd_option != 'vm-export' and cmd_option != 'vdi-export':
             print 'ERROR invalid config/vm_name: %s' % cfg_file
             usage()
             sys.exit(1)
-        save_to_config_export( cmd_option, cmd_vm_name)
+        save_to_config_selectors([(cmd_option, cmd_vm_name)])
 
+    if max_parallel is not None:
+        # command line overrides config file
+        config['max_parallel'] = max_parallel
+    if daemon and not config_specified:
+        print 'ERROR daemon=true requires a config-file'
+        sys.exit(1)
     config_load_defaults()  # set defaults that are not already loaded
     log('VmBackup config loaded from: %s' % cfg_file)
     config_print()     # show fully loaded config
@@ -1613,35 +5655,26 @@ if __name__ == '__main__':
         log('ERROR no VMs loaded')
         sys.exit(1)
 
-    # acquire a xapi session by logging in
-    try:
-        username = 'root'
-        session = XenAPI.Session('http://localhost/')
-        # print "session is: %s " % session
-
-        session.xenapi.login_with_password(username, password)
-        hosts = session.xenapi.host.get_all()
-    except XenAPI.Failure, e:
-        print e
-        if e.details[0] == 'HOST_IS_SLAVE':
-            session = XenAPI.Session('http://' + e.details[1])
-            session.xenapi.login_with_password(username, password)
-            hosts = session.xenapi.host.get_all()
-        else:
-            print 'ERROR - XenAPI authentication error'
-            sys.exit(1)
-
     if preview:
     # check for duplicate names
        log('Checking all VMs for duplicate names ...')
        for vm in all_vms:
-          vmref = [x for x in session.xenapi.VM.get_by_name_label(vm) if not session.xenapi.VM.get_is_a_snapshot(x)]
+          vmref = [x for x in xapi_cache.get_by_name_label('VM', vm) if not xapi_cache.get_record('VM', x)['is_a_snapshot']]
           if (len(vmref) > 1):
              log ("*** ERROR: duplicate VM name found: %s | %s" % (vm, vmref))
 
     if not verify_config_vms_exist():
         # error message(s) printed in verify_config_vms_exist
         sys.exit(1)
+
+    if config['shard_by_host'] == 'true':
+        # note - same host name-label as is_xe_master
+        shard_host = shard_host_parm
+        if shard_host is None:
+            shard_host = os.uname()[1]
+        if xapi_cache.get_by_name_label('host', shard_host) == []:
+            log('ERROR shard_by_host - pool host not found: %s' % shard_host)
+            sys.exit(1)
     # OPTIONAL
     #show_vms_not_in_backup()
 
@@ -1665,7 +5698,10 @@ if __name__ == '__main__':
         sys.exit(1)
 
     try:
-        main(session)
+        if daemon:
+            daemon_main(cfg_file)
+        else:
+            main(session)
 
     except Exception, e:
         print e
@@ -0,0 +1,254 @@
+#
+# XenAPI.py - in-memory stand-in for the XenAPI module, for window_benchmark.py
+#
+# make_pool() builds a synthetic pool of vms, disks, SRs and hosts that answers
+# the calls VmBackup.py makes through XenAPI.Session. Every call is counted in
+# rpc_calls. The vm/vdi snapshots are announced in <bench_dir>/exports.txt,
+# where the fake xe and the fake xapi http server (xapi_http.py) look up how
+# many bytes an export of them streams. The imports of the fake xapi http server
+# are listed in <bench_dir>/imports.txt, the result of their task is a new vm.
+# The tests (tests/) script VDI.list_changed_blocks with changed_blocks,
+# event.from with event_batches and VDI.get_nbd_info with nbd_port and nbd_cert.
+
+import os, threading, uuid, copy, collections, time, base64
+
+rpc_calls = collections.Counter()
+pool = {}
+export_url = 'http://127.0.0.1/'
+bench_dir = '.'
+# VDI.list_changed_blocks bitmap, None - all blocks changed
+changed_blocks = None
+# event.from results, each a list of events, returned one per call
+event_batches = collections.deque()
+# NBD server of VDI.get_nbd_info (see xapi_http.py), None - no network with purpose nbd
+nbd_port = None
+# its cert (pem), '' - insecure_nbd
+nbd_cert = ''
+_lock = threading.Lock()
+
+class Failure(Exception):
+    def __init__(self, details):
+        Exception.__init__(self, details)
+        self.details = details
+
+def new_uuid():
+    return str(uuid.uuid4())
+
+def make_pool(tmp_bench_dir, tmp_vms, tmp_disks, tmp_disk_bytes, tmp_hosts=2, tmp_srs=2, tmp_master_name=None):
+    # vm0..vmN, each with tmp_disks disks of tmp_disk_bytes, spread over the hosts and SRs
+    # note - the first host is the pool master, named tmp_master_name (default: this host)
+    global bench_dir
+    bench_dir = tmp_bench_dir
+    pool.clear()
+    for cls in ['VM', 'VBD', 'VDI', 'SR', 'VIF', 'network', 'host', 'pool', 'task']:
+        pool[cls] = {}
+    hosts = []
+    for ix in range(tmp_hosts):
+        ref = 'OpaqueRef:host%s' % ix
+        name = 'bench-host%s' % ix
+        if ix == 0:
+            name = tmp_master_name or os.uname()[1]
+        pool['host'][ref] = {'uuid': new_uuid(), 'name_label': name, 'address': '127.0.0.1'}
+        hosts.append(ref)
+    srs = []
+    for ix in range(tmp_srs):
+        ref = 'OpaqueRef:sr%s' % ix
+        pool['SR'][ref] = {'uuid': new_uuid(), 'name_label': 'bench-sr%s' % ix, 'VDIs': []}
+        srs.append(ref)
+    pool['pool']['OpaqueRef:pool'] = {'uuid': new_uuid(), 'name_label': 'bench', 'master': hosts[0], 'default_SR': srs[0]}
+    pool['network']['OpaqueRef:network0'] = {'uuid': new_uuid(), 'name_label': 'Pool-wide network associated with eth0'}
+    for vm_ix in range(tmp_vms):
+        vm_ref = 'OpaqueRef:vm%s' % vm_ix
+        vif_ref = 'OpaqueRef:vif%s' % vm_ix
+        pool['VIF'][vif_ref] = {'uuid': new_uuid(), 'VM': vm_ref, 'device': '0', 'network': 'OpaqueRef:network0',
+            'MTU': '1500', 'MAC': '02:00:00:%02x:%02x:%02x' % (vm_ix >> 16 & 255, vm_ix >> 8 & 255, vm_ix & 255), 'other_config': {}}
+        vbds = []
+        for disk_ix in range(tmp_disks):
+            device = 'xvd%s' % 'abcdefghijklmnop'[disk_ix]
+            vdi_ref = 'OpaqueRef:vdi%s-%s' % (vm_ix, disk_ix)
+            vbd_ref = 'OpaqueRef:vbd%s-%s' % (vm_ix, disk_ix)
+            sr_ref = srs[(vm_ix + disk_ix) % len(srs)]
+            pool['VDI'][vdi_ref] = {'uuid': new_uuid(), 'name_label': 'vm%s %s' % (vm_ix, device), 'name_description': '',
+                'virtual_size': str(tmp_disk_bytes), 'physical_utilisation': str(tmp_disk_bytes),
+                'type': 'user', 'sharable': False, 'read_only': False, 'SR': sr_ref, 'VBDs': [vbd_ref],
+                'is_a_snapshot': False, 'snapshot_of': 'OpaqueRef:NULL', 'cbt_enabled': False,
+                'tags': [], 'other_config': {}}
+            pool['SR'][sr_ref]['VDIs'].append(vdi_ref)
+            pool['VBD'][vbd_ref] = {'uuid': new_uuid(), 'VM': vm_ref, 'VDI': vdi_ref, 'device': device,
+                'userdevice': str(disk_ix), 'bootable': disk_ix == 0, 'mode': 'RW', 'type': 'Disk',
+                'unpluggable': False, 'empty': False}
+            vbds.append(vbd_ref)
+        pool['VM'][vm_ref] = {'uuid': new_uuid(), 'name_label': 'vm%s' % vm_ix, 'name_description': '',
+            'power_state': 'Running', 'resident_on': hosts[vm_ix % len(hosts)], 'affinity': 'OpaqueRef:NULL',
+            'is_a_template': False, 'is_a_snapshot': False, 'is_control_domain': False,
+            'snapshot_of': 'OpaqueRef:NULL', 'ha_always_run': False, 'VBDs': vbds, 'VIFs': [vif_ref],
+            'tags': [], 'other_config': {}}
+    open(os.path.join(bench_dir, 'exports.txt'), 'w').close()
+    open(os.path.join(bench_dir, 'imports.txt'), 'w').close()
+    return pool
+
+def announce_export(tmp_uuid, tmp_bytes):
+    open(os.path.join(bench_dir, 'exports.txt'), 'a').write('%s %s\n' % (tmp_uuid, tmp_bytes))
+
+def get_import_result(tmp_task):
+    # the task result of an import of the fake xapi http server: a new, empty
+    # vm for /import and /import_metadata (like xapi, an xmlrpc array of refs)
+    for line in open(os.path.join(bench_dir, 'imports.txt')):
+        (task, path, size, digest) = line.split()
+        if task != tmp_task:
+            continue
+        if path == '/import_raw_vdi':
+            return ''
+        ref = 'OpaqueRef:%s' % new_uuid()
+        pool['VM'][ref] = {'uuid': new_uuid(), 'name_label': 'restored-%s' % len(pool['VM']), 'name_description': '',
+            'power_state': 'Halted', 'resident_on': 'OpaqueRef:NULL', 'affinity': 'OpaqueRef:NULL',
+            'is_a_template': False, 'is_a_snapshot': False, 'is_control_domain': False,
+            'snapshot_of': 'OpaqueRef:NULL', 'ha_always_run': False, 'VBDs': [], 'VIFs': [],
+            'tags': [], 'other_config': {}}
+        return '<value><array><data><value>%s</value></data></array></value>' % ref
+    raise Failure(['HANDLE_INVALID', 'task', tmp_task])
+
+def call(cls, name, args):
+    tab = pool.get(cls)
+    if cls == 'session' and name == 'logout':
+        return ''
+    if tab is None:
+        raise Failure(['MESSAGE_METHOD_UNKNOWN', '%s.%s' % (cls, name)])
+    if name == 'get_all':
+        return tab.keys()
+    if name == 'get_all_records':
+        return copy.deepcopy(tab)
+    if name == 'get_by_name_label':
+        return [ref for (ref, record) in tab.items() if record.get('name_label') == args[0]]
+    if name == 'get_by_uuid':
+        for (ref, record) in tab.items():
+            if record['uuid'] == args[0]:
+                return ref
+        raise Failure(['UUID_INVALID', cls, args[0]])
+    if name not in ['snapshot', 'destroy', 'create'] and args[0] not in tab:
+        raise Failure(['HANDLE_INVALID', cls, args[0]])
+    if cls == 'task' and name == 'get_result':
+        return get_import_result(args[0])
+    if cls == 'VDI' and name == 'get_nbd_info':
+        if nbd_port is None:
+            return []
+        return [{'address': '127.0.0.1', 'port': nbd_port, 'cert': nbd_cert, 'subject': 'localhost',
+            'exportname': '/%s?session_id=OpaqueRef:bench' % tab[args[0]]['uuid']}]
+    if name == 'get_record':
+        return copy.deepcopy(tab[args[0]])
+    if name.startswith('get_'):
+        return copy.deepcopy(tab[args[0]][name[4:]])
+    if name.startswith('set_'):
+        tab[args[0]][name[4:]] = args[1]
+        return ''
+    if cls == 'VM' and name == 'snapshot':
+        # the snapshot gets its own VBDs and VDIs, like xapi
+        ref = 'OpaqueRef:%s' % new_uuid()
+        record = copy.deepcopy(tab[args[0]])
+        record.update({'uuid': new_uuid(), 'name_label': args[1], 'is_a_snapshot': True,
+            'is_a_template': True, 'snapshot_of': args[0], 'power_state': 'Halted', 'VBDs': [], 'VIFs': []})
+        size = 0
+        for vbd_ref in tab[args[0]]['VBDs']:
+            vdi_ref = call('VDI', 'snapshot', [pool['VBD'][vbd_ref]['VDI'], {}])
+            snap_vbd_ref = 'OpaqueRef:%s' % new_uuid()
+            pool['VBD'][snap_vbd_ref] = dict(pool['VBD'][vbd_ref], uuid=new_uuid(), VM=ref, VDI=vdi_ref)
+            pool['VDI'][vdi_ref]['VBDs'] = [snap_vbd_ref]
+            record['VBDs'].append(snap_vbd_ref)
+            size += int(pool['VDI'][vdi_ref]['virtual_size'])
+        tab[ref] = record
+        announce_export(record['uuid'], size)
+        return ref
+    if cls == 'VDI' and name == 'snapshot':
+        ref = 'OpaqueRef:%s' % new_uuid()
+        record = copy.deepcopy(tab[args[0]])
+        record.update({'uuid': new_uuid(), 'is_a_snapshot': True, 'snapshot_of': args[0], 'VBDs': []})
+        tab[ref] = record
+        announce_export(record['uuid'], record['virtual_size'])
+        return ref
+    if name == 'destroy':
+        record = tab.pop(args[0], None)
+        if cls in ['VBD', 'VIF'] and record is not None:
+            pool['VM'][record['VM']]['%ss' % cls].remove(args[0])
+        if cls == 'VBD' and record is not None:
+            pool['VDI'][record['VDI']]['VBDs'].remove(args[0])
+        return ''
+    if cls in ['VDI', 'VBD', 'VIF'] and name == 'create':
+        ref = 'OpaqueRef:%s' % new_uuid()
+        tab[ref] = dict(args[0], uuid=new_uuid())
+        if cls == 'VDI':
+            tab[ref].update({'VBDs': [], 'physical_utilisation': '0', 'is_a_snapshot': False,
+                'snapshot_of': 'OpaqueRef:NULL', 'cbt_enabled': False})
+            pool['SR'][args[0]['SR']]['VDIs'].append(ref)
+        else:
+            pool['VM'][args[0]['VM']]['%ss' % cls].append(ref)
+        if cls == 'VBD':
+            tab[ref]['device'] = ''
+            pool['VDI'][args[0]['VDI']]['VBDs'].append(ref)
+        return ref
+    if cls == 'VDI' and name == 'enable_cbt':
+        tab[args[0]]['cbt_enabled'] = True
+        return ''
+    if cls == 'VDI' and name == 'list_changed_blocks':
+        bitmap = changed_blocks
+        if bitmap is None:
+            blocks = (int(tab[args[1]]['virtual_size']) + 65535) / 65536
+            bitmap = '\xff' * ((blocks + 7) / 8)
+        return base64.b64encode(bitmap)
+    if cls == 'VDI' and name == 'data_destroy':
+        tab[args[0]]['type'] = 'cbt_metadata'
+        return ''
+    if cls == 'task' and name == 'create':
+        ref = 'OpaqueRef:%s' % new_uuid()
+        tab[ref] = {'uuid': new_uuid(), 'name_label': args[0], 'status': 'success', 'error_info': []}
+        return ref
+    raise Failure(['MESSAGE_METHOD_UNKNOWN', '%s.%s' % (cls, name)])
+
+class _Class:
+    def __init__(self, cls):
+        self.cls = cls
+
+    def __getattr__(self, name):
+        cls = self.cls
+        def method(*args):
+            if cls == 'event' and name == 'from':
+                # no pool changes during a benchmark run, unless scripted
+                rpc_calls['event.from'] += 1
+                try:
+                    events = event_batches.popleft()
+                except IndexError:
+                    time.sleep(min(float(args[2]), 1.0))
+                    events = []
+                return {'events': events, 'valid_ref_counts': {}, 'token': 'bench'}
+            _lock.acquire()
+            try:
+                rpc_calls['%s.%s' % (cls, name)] += 1
+                return call(cls, name, args)
+            finally:
+                _lock.release()
+        return method
+
+class _XenAPI:
+    def __getattr__(self, cls):
+        return _Class(cls)
+
+    def login_with_password(self, username, password, *args):
+        rpc_calls['session.login_with_password'] += 1
+
+class Session(object):
+    def __init__(self, url, *args, **kwargs):
+        self.xenapi = _XenAPI()
+        # the session_id of the http exports
+        self._session = 'OpaqueRef:bench-session'
+
+    def _get_xapi_url(self):
+        return export_url
+
+    def _set_xapi_url(self, url):
+        # VmBackup.py points export_method=http at the host it logged in to,
+        # the exports go to xapi_http.py instead
+        pass
+
+    xapi_url = property(_get_xapi_url, _set_xapi_url)
+
+    def logout(self):
+        pass
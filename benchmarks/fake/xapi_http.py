@@ -0,0 +1,224 @@
+#!/usr/bin/python
+#
+# xapi_http.py - stand-in for the xapi /export and /export_raw_vdi http handlers,
+# and the /import, /import_metadata and /import_raw_vdi ones, for window_benchmark.py
+#
+# usage: xapi_http.py port [nbd_port]
+#
+# Streams as many bytes as <bench_dir>/exports.txt lists for the snapshot,
+# /export as an xva (tar of ova.xml and 1M blocks with their sha1 checksums),
+# /export_raw_vdi as raw data, at VMBACKUP_BENCH_MBPS per export (0 - unlimited).
+# The VMBACKUP_BENCH_FAILURE_RATE share of the snapshots fails with http 500.
+# An import reads the request body at the same rate and is appended to
+# <bench_dir>/imports.txt (task, path, bytes, sha256 of the body), where
+# the fake XenAPI task.get_result finds it.
+# On nbd_port the snapshot vdis are served like the xapi NBD server
+# (fixed newstyle, NBD_OPT_STARTTLS with the cert.pem/key.pem in the
+# VMBACKUP_BENCH_NBD_CERT dir, NBD_OPT_EXPORT_NAME /<vdi uuid>?session_id=..,
+# NBD_CMD_READ) with the data of write_raw. Each read is appended to
+# <bench_dir>/nbd_reads.txt (vdi uuid, offset, length).
+# Also the export writer of the fake xe.
+
+import sys, os, time, tarfile, hashlib, urlparse, BaseHTTPServer, SocketServer, struct, ssl, threading
+
+BLOCK_SIZE = 1024 * 1024
+# not zero, so that vdi_export_sparse has nothing to skip
+BLOCK_DATA = ''.join([chr(1 + ix % 255) for ix in range(4096)]) * (BLOCK_SIZE / 4096)
+# the chunks of all disks are stored below one VDI, Ref:1
+OVA_XML = '<?xml version="1.0"?><value><struct><member><name>version</name><value><struct></struct></value></member>' \
+    '<member><name>objects</name><value><array><data><value><struct><member><name>class</name><value>VDI</value></member>' \
+    '<member><name>id</name><value>Ref:1</value></member><member><name>snapshot</name><value><struct>' \
+    '<member><name>virtual_size</name><value>%s</value></member></struct></value></member></struct></value>' \
+    '</data></array></value></member></struct></value>'
+
+def get_mbps():
+    return float(os.environ.get('VMBACKUP_BENCH_MBPS', '0'))
+
+def get_export_bytes(tmp_bench_dir, tmp_uuid):
+    # bytes an export of the snapshot tmp_uuid streams, None if unknown
+    for line in open(os.path.join(tmp_bench_dir, 'exports.txt')):
+        (export_uuid, size) = line.split()
+        if export_uuid == tmp_uuid:
+            return int(size)
+    return None
+
+def is_export_failure(tmp_uuid):
+    # the same snapshot always fails or not, so xe and http agree
+    rate = float(os.environ.get('VMBACKUP_BENCH_FAILURE_RATE', '0'))
+    return int(hashlib.md5(tmp_uuid).hexdigest()[:8], 16) < rate * 0x100000000
+
+class Pacer:
+    # sleep so that the data written so far does not exceed mbps
+
+    def __init__(self, mbps):
+        self.mbps = mbps
+        self.begin = time.time()
+        self.written = 0
+
+    def wrote(self, nbytes):
+        self.written += nbytes
+        if self.mbps > 0:
+            wait = self.written / (self.mbps * 1024 * 1024) - (time.time() - self.begin)
+            if wait > 0:
+                time.sleep(wait)
+
+def tar_member(name, size):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = 0
+    return info.tobuf(tarfile.USTAR_FORMAT)
+
+def tar_padding(size):
+    return '\0' * ((512 - size % 512) % 512)
+
+def xva_length(tmp_bytes):
+    # length of the xva write_xva streams for tmp_bytes of disk data
+    blocks = (tmp_bytes + BLOCK_SIZE - 1) / BLOCK_SIZE
+    ova_xml = OVA_XML % tmp_bytes
+    length = 512 + len(ova_xml) + len(tar_padding(len(ova_xml)))
+    length += tmp_bytes + (512 - tmp_bytes % 512) % 512 + blocks * 512
+    length += blocks * (512 + 512)
+    return length + 1024
+
+def write_xva(out, tmp_bytes, mbps):
+    pacer = Pacer(mbps)
+    ova_xml = OVA_XML % tmp_bytes
+    out.write(tar_member('ova.xml', len(ova_xml)) + ova_xml + tar_padding(len(ova_xml)))
+    offset = 0
+    block = 0
+    while offset < tmp_bytes:
+        data = BLOCK_DATA[:min(BLOCK_SIZE, tmp_bytes - offset)]
+        checksum = hashlib.sha1(data).hexdigest()
+        out.write(tar_member('Ref:1/%08d' % block, len(data)) + data + tar_padding(len(data)))
+        out.write(tar_member('Ref:1/%08d.checksum' % block, len(checksum)) + checksum + tar_padding(len(checksum)))
+        pacer.wrote(len(data))
+        offset += len(data)
+        block += 1
+    out.write('\0' * 1024)
+
+def write_raw(out, tmp_bytes, mbps):
+    pacer = Pacer(mbps)
+    offset = 0
+    while offset < tmp_bytes:
+        data = BLOCK_DATA[:min(BLOCK_SIZE, tmp_bytes - offset)]
+        out.write(data)
+        pacer.wrote(len(data))
+        offset += len(data)
+
+class ExportHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        export_uuid = query.get('uuid', query.get('vdi'))
+        size = get_export_bytes(os.environ['VMBACKUP_BENCH_DIR'], export_uuid)
+        if url.path not in ['/export', '/export_raw_vdi'] or size is None:
+            self.send_error(404)
+            return
+        if is_export_failure(export_uuid):
+            self.send_error(500, 'benchmark failure_rate')
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        if url.path == '/export':
+            self.send_header('Content-Length', str(xva_length(size)))
+            self.end_headers()
+            write_xva(self.wfile, size, get_mbps())
+        else:
+            self.send_header('Content-Length', str(size))
+            self.end_headers()
+            write_raw(self.wfile, size, get_mbps())
+
+    def do_PUT(self):
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        if url.path not in ['/import', '/import_metadata', '/import_raw_vdi'] or 'task_id' not in query:
+            self.send_error(404)
+            return
+        # without Content-Length the body ends when the client shuts down its side
+        remaining = int(self.headers.get('Content-Length', -1))
+        pacer = Pacer(get_mbps())
+        total = 0
+        digest = hashlib.sha256()
+        while remaining != 0:
+            data = self.rfile.read(BLOCK_SIZE if remaining < 0 else min(BLOCK_SIZE, remaining))
+            if not data:
+                break
+            total += len(data)
+            digest.update(data)
+            remaining -= len(data) if remaining > 0 else 0
+            pacer.wrote(len(data))
+        open(os.path.join(os.environ['VMBACKUP_BENCH_DIR'], 'imports.txt'), 'a').write('%s %s %s %s\n' % (query['task_id'], url.path, total, digest.hexdigest()))
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+class ExportServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def raw_data(offset, length):
+    # the bytes at offset of what write_raw streams
+    start = offset % BLOCK_SIZE
+    data = BLOCK_DATA[start:]
+    while len(data) < length:
+        data += BLOCK_DATA
+    return data[:length]
+
+class NbdHandler(SocketServer.BaseRequestHandler):
+
+    def recv(self, size):
+        data = ''
+        while len(data) < size:
+            part = self.sock.recv(size - len(data))
+            if not part:
+                raise IOError('nbd client closed')
+            data += part
+        return data
+
+    def handle(self):
+        self.sock = self.request
+        # NBD_FLAG_FIXED_NEWSTYLE | NBD_FLAG_NO_ZEROES
+        self.sock.sendall('NBDMAGICIHAVEOPT' + struct.pack('>H', 3))
+        (client_flags,) = struct.unpack('>I', self.recv(4))
+        while True:
+            (magic, option, length) = struct.unpack('>8sII', self.recv(16))
+            data = self.recv(length)
+            if option == 5:
+                # NBD_OPT_STARTTLS - NBD_REP_ACK
+                self.sock.sendall(struct.pack('>QIII', 0x3e889045565a9, option, 1, 0))
+                cert_dir = os.environ['VMBACKUP_BENCH_NBD_CERT']
+                self.sock = ssl.wrap_socket(self.sock, server_side=True, certfile=os.path.join(cert_dir, 'cert.pem'),
+                    keyfile=os.path.join(cert_dir, 'key.pem'))
+            elif option == 1:
+                # NBD_OPT_EXPORT_NAME - an unknown export closes the connection
+                vdi_uuid = data.split('?')[0].lstrip('/')
+                size = get_export_bytes(os.environ['VMBACKUP_BENCH_DIR'], vdi_uuid)
+                if size is None:
+                    return
+                self.sock.sendall(struct.pack('>QH', size, 1) + ('' if client_flags & 2 else '\0' * 124))
+                break
+            else:
+                # NBD_REP_ERR_UNSUP
+                self.sock.sendall(struct.pack('>QIII', 0x3e889045565a9, option, 0x80000001, 0))
+        while True:
+            (magic, flags, cmd, handle, offset, length) = struct.unpack('>IHHQQI', self.recv(28))
+            if cmd != 0:
+                # NBD_CMD_DISC
+                return
+            open(os.path.join(os.environ['VMBACKUP_BENCH_DIR'], 'nbd_reads.txt'), 'a').write('%s %s %s\n' % (vdi_uuid, offset, length))
+            self.sock.sendall(struct.pack('>IIQ', 0x67446698, 0, handle) + raw_data(offset, min(length, size - offset)))
+
+class NbdServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2:
+        nbd = threading.Thread(target=NbdServer(('127.0.0.1', int(sys.argv[2])), NbdHandler).serve_forever)
+        nbd.setDaemon(True)
+        nbd.start()
+    ExportServer(('127.0.0.1', int(sys.argv[1])), ExportHandler).serve_forever()
@@ -0,0 +1,61 @@
+#!/usr/bin/python
+#
+# selector_benchmark.py - time the vm selection of a config file on a synthetic pool
+#
+# usage: selector_benchmark.py [vms=10000] [selectors=200]
+#
+# Builds a pool of synthetic vm name-labels and a config file with plain vm
+# names, regex selectors and excludes, then times config_load() and
+# cleanup_vmexport_vdiexport_dups() of VmBackup.py against it. Runs anywhere
+# VmBackup.py can be imported (the XenAPI module must be on the path), no
+# xapi login is done.
+
+import sys, os, time, tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import VmBackup
+
+def make_pool(tmp_vms):
+    # PRD-app0001, DEV-db0002, ... spread over a few prefixes and roles
+    prefixes = ['PRD', 'DEV', 'TST', 'QA']
+    roles = ['app', 'db', 'web', 'cache', 'batch']
+    return ['%s-%s%05d' % (prefixes[i % len(prefixes)], roles[i % len(roles)], i) for i in range(tmp_vms)]
+
+def make_config(tmp_vms, tmp_selectors):
+    # 5% excludes, 20% regex selectors, the rest plain vm names
+    lines = []
+    for i in range(tmp_selectors / 20):
+        lines.append('exclude=%s' % tmp_vms[(i * 37) % len(tmp_vms)])
+    for i in range(tmp_selectors / 5):
+        key = ['vdi-export', 'vm-export'][i % 2]
+        lines.append('%s=^PRD-app0%d.*:%d' % (key, i % 10, 2 + i % 3))
+    for i in range(tmp_selectors - len(lines)):
+        key = ['vdi-export', 'vm-export'][i % 2]
+        lines.append('%s=%s' % (key, tmp_vms[(i * 101) % len(tmp_vms)]))
+    return lines
+
+def main(tmp_vm_cnt, tmp_selector_cnt):
+    vms = make_pool(tmp_vm_cnt)
+    lines = make_config(vms, tmp_selector_cnt)
+    (fd, cfg_file) = tempfile.mkstemp(suffix='.cfg')
+    os.write(fd, '\n'.join(lines) + '\n')
+    os.close(fd)
+    try:
+        VmBackup.config['vm-export'] = []
+        VmBackup.config['vdi-export'] = []
+        VmBackup.config['exclude'] = []
+        begin = time.time()
+        VmBackup.set_all_vms(list(vms))
+        VmBackup.config_load(cfg_file)
+        loaded = time.time()
+        VmBackup.cleanup_vmexport_vdiexport_dups()
+        done = time.time()
+    finally:
+        os.remove(cfg_file)
+    print 'vms=%s selectors=%s -> vdi-export=%s vm-export=%s exclude=%s' % (tmp_vm_cnt, len(lines),
+        len(VmBackup.config['vdi-export']), len(VmBackup.config['vm-export']), len(VmBackup.config['exclude']))
+    print 'config_load: %.3fs cleanup_vmexport_vdiexport_dups: %.3fs total: %.3fs' % (loaded - begin, done - loaded, done - begin)
+
+if __name__ == '__main__':
+    params = dict([arg.split('=', 1) for arg in sys.argv[1:]])
+    main(int(params.get('vms', 10000)), int(params.get('selectors', 200)))
@@ -0,0 +1,190 @@
+#!/usr/bin/python
+#
+# window_benchmark.py - run a whole VmBackup.py backup against a fake pool
+#
+# usage: window_benchmark.py [vms=20] [disks=1] [disk_mb=64] [mbps=0] [failure_rate=0]
+#                            [export=mixed] [restore=false] [keep=false] [<config key>=<value> ...]
+#
+#   vms, disks, disk_mb - size of the synthetic pool (see fake/XenAPI.py)
+#   mbps                - bandwidth of each export, 0 - unlimited
+#   failure_rate        - share of the exports that fail, e.g. 0.1
+#   export              - vdi, vm or mixed (every other vm)
+#   restore             - then restore the backups with restore= (max_parallel and
+#                         throttle_mbps of the config apply to it as well)
+#   keep                - keep the work dir with the backups and the VmBackup log
+#   other key=value     - go into the config file, e.g. max_parallel=4 export_method=xe
+#
+# The fake XenAPI module (fake/XenAPI.py) replaces the real one, xe_path points
+# at the fake xe (fake/xe) and the http exports go to fake/xapi_http.py in a
+# child process. VmBackup.main() then runs end to end, the same way as from
+# the command line. Reported are the wall time, the cpu time of VmBackup itself
+# and of the processes it started, the forks and xe commands, and the xapi
+# calls, so that changes to the orchestration can be compared without a pool.
+
+import sys, os, time, tempfile, shutil, socket, subprocess, resource, collections
+
+bench_path = os.path.dirname(os.path.abspath(__file__))
+fake_path = os.path.join(bench_path, 'fake')
+sys.path.insert(0, os.path.join(bench_path, '..'))
+# note - ahead of any real XenAPI module
+sys.path.insert(0, fake_path)
+import XenAPI
+import VmBackup
+
+BENCH_PARAMS = {'vms': '20', 'disks': '1', 'disk_mb': '64', 'mbps': '0', 'failure_rate': '0',
+    'export': 'mixed', 'restore': 'false', 'keep': 'false'}
+
+fork_cnt = collections.Counter()
+
+def count_forks():
+    # count the processes VmBackup starts: subprocess and multiprocessing fork, os.popen too
+    os_fork = os.fork
+    os_popen = os.popen
+    def fork():
+        fork_cnt['fork'] += 1
+        return os_fork()
+    def popen(*args):
+        fork_cnt['popen'] += 1
+        return os_popen(*args)
+    os.fork = fork
+    os.popen = popen
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def make_config(tmp_bench_dir, tmp_params, tmp_config):
+    lines = ['backup_dir=%s' % os.path.join(tmp_bench_dir, 'backups'),
+        'status_log=%s' % os.path.join(tmp_bench_dir, 'status.log'),
+        'max_backups=2', 'pool_db_backup=0']
+    for ix in range(int(tmp_params['vms'])):
+        if tmp_params['export'] == 'vdi' or (tmp_params['export'] == 'mixed' and ix % 2 == 0):
+            lines.append('vdi-export=vm%s' % ix)
+        else:
+            lines.append('vm-export=vm%s' % ix)
+    lines += ['%s=%s' % (key, value) for (key, value) in tmp_config]
+    cfg_file = os.path.join(tmp_bench_dir, 'bench.cfg')
+    open(cfg_file, 'w').write('\n'.join(lines) + '\n')
+    return cfg_file
+
+def load_config(cfg_file):
+    # what VmBackup.py does from the command line up to main()
+    VmBackup.config_specified = 1
+    VmBackup.config['vm-export'] = []
+    VmBackup.config['vdi-export'] = []
+    VmBackup.config['exclude'] = []
+    VmBackup.set_all_vms(VmBackup.get_pool_vms())
+    if not VmBackup.config_load(cfg_file):
+        return False
+    VmBackup.cleanup_vmexport_vdiexport_dups()
+    VmBackup.config_load_defaults()
+    return VmBackup.is_config_valid() and VmBackup.verify_config_vms_exist()
+
+def get_dir_bytes(path):
+    total = 0
+    for (dir_path, dir_names, file_names) in os.walk(path):
+        for name in file_names:
+            total += os.path.getsize(os.path.join(dir_path, name))
+    return total
+
+def main(tmp_params, tmp_config):
+    bench_dir = tempfile.mkdtemp(prefix='vmbackup-bench-')
+    os.mkdir(os.path.join(bench_dir, 'backups'))
+    log_file = os.path.join(bench_dir, 'VmBackup.log')
+    XenAPI.make_pool(bench_dir, int(tmp_params['vms']), int(tmp_params['disks']), int(tmp_params['disk_mb']) * 1024 * 1024)
+    port = free_port()
+    XenAPI.export_url = 'http://127.0.0.1:%s/' % port
+    os.environ['VMBACKUP_BENCH_DIR'] = bench_dir
+    os.environ['VMBACKUP_BENCH_MBPS'] = tmp_params['mbps']
+    os.environ['VMBACKUP_BENCH_FAILURE_RATE'] = tmp_params['failure_rate']
+    os.environ['VMBACKUP_BENCH_MASTER'] = XenAPI.pool['host']['OpaqueRef:host0']['uuid']
+    http_server = subprocess.Popen([sys.executable, os.path.join(fake_path, 'xapi_http.py'), str(port)])
+    saved_stdout = os.dup(sys.stdout.fileno())
+    try:
+        # the VmBackup output goes to the log file, the report to stdout
+        log_fd = os.open(log_file, os.O_WRONLY | os.O_CREAT, 0644)
+        os.dup2(log_fd, sys.stdout.fileno())
+        os.close(log_fd)
+        # note - the fake xe runs with this python, also where /usr/bin/python is not python 2
+        VmBackup.xe_path = '%s %s' % (sys.executable, fake_path)
+        VmBackup.password = 'bench'
+        VmBackup.preview = False
+        VmBackup.compress = False
+        VmBackup.ignore_extra_keys = False
+        VmBackup.pre_clean = False
+        VmBackup.daemon = False
+        VmBackup.warning_match = False
+        VmBackup.error_regex = False
+        session = VmBackup.xapi_login()
+        VmBackup.session = session
+        VmBackup.xapi_cache = VmBackup.XapiCache()
+        VmBackup.xapi_cache.prefetch()
+        cfg_file = make_config(bench_dir, tmp_params, tmp_config)
+        if not load_config(cfg_file):
+            raise Exception('config not valid, see %s' % log_file)
+        rpc_setup = sum(XenAPI.rpc_calls.values())
+        XenAPI.rpc_calls.clear()
+        count_forks()
+        usage_self = resource.getrusage(resource.RUSAGE_SELF)
+        usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        begin = time.time()
+        try:
+            VmBackup.main(session)
+        except SystemExit:
+            pass
+        elapse = time.time() - begin
+        usage_self_end = resource.getrusage(resource.RUSAGE_SELF)
+        usage_children_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+        if tmp_params['restore'] == 'true':
+            restore_begin = time.time()
+            restore_errors = VmBackup.restore_main(os.path.join(bench_dir, 'backups'), None, None,
+                int(VmBackup.config['max_parallel']), False)
+            restore_elapse = time.time() - restore_begin
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved_stdout, sys.stdout.fileno())
+        http_server.terminate()
+        http_server.wait()
+    sys.stdout = os.fdopen(saved_stdout, 'w', 0)
+
+    cpu_self = (usage_self_end.ru_utime - usage_self.ru_utime) + (usage_self_end.ru_stime - usage_self.ru_stime)
+    cpu_children = (usage_children_end.ru_utime - usage_children.ru_utime) + (usage_children_end.ru_stime - usage_children.ru_stime)
+    backup_bytes = get_dir_bytes(os.path.join(bench_dir, 'backups'))
+    xe_cnt = collections.Counter()
+    if os.path.exists(os.path.join(bench_dir, 'xe.log')):
+        for line in open(os.path.join(bench_dir, 'xe.log')):
+            xe_cnt[line.split()[0]] += 1
+    print 'vms=%s disks=%s disk_mb=%s mbps=%s failure_rate=%s export=%s %s' % (tmp_params['vms'], tmp_params['disks'],
+        tmp_params['disk_mb'], tmp_params['mbps'], tmp_params['failure_rate'], tmp_params['export'],
+        ' '.join(['%s=%s' % x for x in tmp_config]))
+    print 'status: success=%s warning=%s error=%s' % (VmBackup.status_cnt['success'], VmBackup.status_cnt['warning'], VmBackup.status_cnt['error'])
+    print 'wall: %.2fs backups: %sM %.1fMB/s' % (elapse, backup_bytes / (1024 * 1024), backup_bytes / (1024.0 * 1024) / max(elapse, 0.001))
+    print 'cpu: VmBackup %.2fs (%.1f%% of wall) started processes %.2fs' % (cpu_self, 100 * cpu_self / max(elapse, 0.001), cpu_children)
+    print 'forks: %s (fork %s popen %s) xe: %s' % (sum(fork_cnt.values()), fork_cnt['fork'], fork_cnt['popen'],
+        ' '.join(['%s=%s' % x for x in sorted(xe_cnt.items())]))
+    print 'xapi calls: %s (%s before main) per vm: %.1f' % (sum(XenAPI.rpc_calls.values()), rpc_setup,
+        sum(XenAPI.rpc_calls.values()) / float(max(int(tmp_params['vms']), 1)))
+    for (method, cnt) in XenAPI.rpc_calls.most_common(10):
+        print '  %6s %s' % (cnt, method)
+    if tmp_params['restore'] == 'true':
+        import_bytes = sum([int(line.split()[2]) for line in open(os.path.join(bench_dir, 'imports.txt'))])
+        print 'restore: errors=%s wall: %.2fs imports: %sM %.1fMB/s' % (restore_errors, restore_elapse,
+            import_bytes / (1024 * 1024), import_bytes / (1024.0 * 1024) / max(restore_elapse, 0.001))
+    if tmp_params['keep'] == 'true':
+        print 'work dir: %s' % bench_dir
+    else:
+        shutil.rmtree(bench_dir)
+
+if __name__ == '__main__':
+    params = dict(BENCH_PARAMS)
+    config = []
+    for arg in sys.argv[1:]:
+        (key, value) = arg.split('=', 1)
+        if key in BENCH_PARAMS:
+            params[key] = value
+        else:
+            config.append((key, value))
+    main(params, config)
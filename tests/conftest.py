@@ -0,0 +1,158 @@
+#
+# conftest.py - fixtures of the VmBackup.py tests
+#
+# The tests run VmBackup.py (python 2) against the fake pool of benchmarks/fake,
+# the same stand-ins as benchmarks/window_benchmark.py: the fake XenAPI module,
+# the fake xe and the fake xapi http server (xapi_http.py) in a child process.
+#
+# usage: python -m pytest tests
+
+import sys, os, socket, subprocess, time
+import pytest
+
+tests_path = os.path.dirname(os.path.abspath(__file__))
+fake_path = os.path.join(tests_path, '..', 'benchmarks', 'fake')
+sys.path.insert(0, os.path.join(tests_path, '..'))
+# note - ahead of any real XenAPI module
+sys.path.insert(0, fake_path)
+import XenAPI
+import VmBackup
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+class Bench:
+    # a fake pool in bench_dir, backups go to bench_dir/backups
+
+    def __init__(self, bench_dir):
+        self.bench_dir = bench_dir
+        self.backup_dir = os.path.join(bench_dir, 'backups')
+        self.http_server = None
+        os.mkdir(self.backup_dir)
+
+    def make_pool(self, vms=2, disks=1, disk_mb=4, failure_rate=0, nbd=False, nbd_tls=False):
+        # nbd - VDI.get_nbd_info has the NBD server of xapi_http.py, nbd_tls - with a cert
+        # note - failure_rate and nbd_tls only apply to the http server the first make_pool starts
+        XenAPI.make_pool(self.bench_dir, vms, disks, disk_mb * 1024 * 1024)
+        os.environ['VMBACKUP_BENCH_DIR'] = self.bench_dir
+        os.environ['VMBACKUP_BENCH_MBPS'] = '0'
+        os.environ['VMBACKUP_BENCH_FAILURE_RATE'] = str(failure_rate)
+        os.environ['VMBACKUP_BENCH_MASTER'] = XenAPI.pool['host']['OpaqueRef:host0']['uuid']
+        os.environ['VMBACKUP_BENCH_NBD_CERT'] = self.bench_dir
+        if self.http_server is None:
+            if nbd_tls:
+                make_cert(self.bench_dir)
+            port = free_port()
+            self.nbd_port = free_port()
+            XenAPI.export_url = 'http://127.0.0.1:%s/' % port
+            self.http_server = subprocess.Popen([sys.executable, os.path.join(fake_path, 'xapi_http.py'), str(port), str(self.nbd_port)])
+            wait_for_port(port)
+            wait_for_port(self.nbd_port)
+        XenAPI.nbd_port = None
+        XenAPI.nbd_cert = ''
+        if nbd or nbd_tls:
+            XenAPI.nbd_port = self.nbd_port
+        if nbd_tls:
+            XenAPI.nbd_cert = open(os.path.join(self.bench_dir, 'cert.pem')).read()
+        # note - the fake xe runs with this python, also where /usr/bin/python is not python 2
+        VmBackup.xe_path = '%s %s' % (sys.executable, fake_path)
+        VmBackup.password = 'test'
+        VmBackup.session = VmBackup.xapi_login()
+        VmBackup.xapi_cache = VmBackup.XapiCache()
+        VmBackup.xapi_cache.prefetch()
+
+    def load_config(self, lines):
+        # what VmBackup.py does from the command line up to main()
+        lines = ['backup_dir=%s' % self.backup_dir, 'status_log=%s' % os.path.join(self.bench_dir, 'status.log'),
+            'max_backups=4', 'pool_db_backup=0'] + lines
+        cfg_file = os.path.join(self.bench_dir, 'test.cfg')
+        open(cfg_file, 'w').write('\n'.join(lines) + '\n')
+        reset_config()
+        VmBackup.config_specified = 1
+        VmBackup.set_all_vms(VmBackup.get_pool_vms())
+        assert VmBackup.config_load(cfg_file)
+        VmBackup.cleanup_vmexport_vdiexport_dups()
+        VmBackup.config_load_defaults()
+        assert VmBackup.is_config_valid() and VmBackup.verify_config_vms_exist()
+
+    def run(self):
+        # one VmBackup.main() run, returns its status counts
+        # note - the VmBackup output goes to bench_dir/VmBackup.log
+        for key in VmBackup.status_cnt.keys():
+            VmBackup.status_cnt[key] = 0
+        saved_stdout = sys.stdout
+        sys.stdout = LogFile(os.path.join(self.bench_dir, 'VmBackup.log'))
+        try:
+            VmBackup.main(VmBackup.session)
+        except SystemExit:
+            pass
+        finally:
+            sys.stdout = saved_stdout
+        # note - the backup dirs are named by the second
+        time.sleep(1.1)
+        return dict(VmBackup.status_cnt)
+
+    def backup_dirs(self, vm_name):
+        vm_dir = os.path.join(self.backup_dir, vm_name)
+        return [os.path.join(vm_dir, x) for x in sorted(os.listdir(vm_dir)) if x.startswith('backup-')]
+
+    def stop(self):
+        if self.http_server is not None:
+            self.http_server.terminate()
+            self.http_server.wait()
+
+class LogFile:
+    # stands in for sys.stdout around VmBackup.main(), which re-opens
+    # sys.stdout.fileno() unbuffered - on a dup, so that closing it does not
+    # close the fd of this file (or of the pytest capture)
+
+    def __init__(self, path):
+        self.out = open(path, 'a', 0)
+
+    def fileno(self):
+        return os.dup(self.out.fileno())
+
+    def write(self, data):
+        self.out.write(data)
+
+    def flush(self):
+        pass
+
+def make_cert(cert_dir):
+    # a self-signed cert.pem/key.pem for localhost, like the xapi NBD server has
+    subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=localhost',
+        '-addext', 'subjectAltName=DNS:localhost', '-keyout', os.path.join(cert_dir, 'key.pem'),
+        '-out', os.path.join(cert_dir, 'cert.pem')], stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+
+def wait_for_port(port):
+    for attempt in range(50):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise Exception('fake xapi http server did not start')
+
+def reset_config():
+    VmBackup.config.clear()
+    VmBackup.config['vm-export'] = []
+    VmBackup.config['vdi-export'] = []
+    VmBackup.config['exclude'] = []
+    VmBackup.vdi_export_disks.clear()
+    for name in ['preview', 'compress', 'ignore_extra_keys', 'pre_clean', 'daemon', 'warning_match', 'error_regex']:
+        setattr(VmBackup, name, False)
+
+@pytest.fixture
+def bench(tmpdir):
+    tmp_bench = Bench(str(tmpdir))
+    yield tmp_bench
+    tmp_bench.stop()
+    XenAPI.changed_blocks = None
+    XenAPI.nbd_port = None
+    XenAPI.nbd_cert = ''
+    VmBackup.thread_data.session = None
+    VmBackup.global_throttle = None
@@ -0,0 +1,139 @@
+#
+# vdi_export_cbt: deltas of the changed blocks and their restore
+#
+
+import os, shutil, distutils.spawn
+import pytest
+import XenAPI
+import VmBackup
+
+BLOCK = VmBackup.CBT_BLOCK_SIZE
+
+def make_bitmap(blocks, changed):
+    bitmap = [0] * ((blocks + 7) / 8)
+    for block in changed:
+        bitmap[block >> 3] |= 0x80 >> (block & 7)
+    return ''.join([chr(x) for x in bitmap])
+
+def make_sparse_image(path, blocks, data_blocks):
+    # a raw image of blocks CBT blocks, all holes but data_blocks {block: byte}
+    out = open(path, 'wb')
+    out.truncate(blocks * BLOCK)
+    for (block, byte) in data_blocks.items():
+        out.seek(block * BLOCK)
+        out.write(chr(byte) * BLOCK)
+    out.close()
+
+def feed(writer, path, chunk_size):
+    # note - odd chunk sizes, so that blocks span writes
+    src = open(path, 'rb')
+    data = src.read(chunk_size)
+    while data:
+        writer.write(data)
+        data = src.read(chunk_size)
+    src.close()
+    writer.close()
+
+def test_delta_holds_only_changed_blocks(tmpdir):
+    old_path = str(tmpdir.join('old.raw'))
+    new_path = str(tmpdir.join('new.raw'))
+    make_sparse_image(old_path, 64, {0: 1, 3: 2, 40: 3})
+    # 3 and 10 changed, 40 was zeroed, 63 (last block) is new
+    make_sparse_image(new_path, 64, {0: 1, 3: 4, 10: 5, 63: 6})
+    changed = [3, 10, 40, 63]
+    bitmap = make_bitmap(64, changed)
+
+    delta_path = str(tmpdir.join('new.raw.delta'))
+    feed(VmBackup.CbtDeltaWriter(delta_path, bitmap), new_path, 100000)
+    new_data = open(new_path, 'rb').read()
+    assert os.path.getsize(delta_path) == len(changed) * BLOCK
+    assert open(delta_path, 'rb').read() == ''.join([new_data[x * BLOCK:(x + 1) * BLOCK] for x in changed])
+
+    VmBackup.cbt_apply_delta(old_path, delta_path, bitmap)
+    assert open(old_path, 'rb').read() == new_data
+
+def test_cbt_backup_chain_restore(bench, tmpdir):
+    bench.make_pool(vms=1, disks=1, disk_mb=4)
+    bench.load_config(['vdi-export=vm0', 'export_method=http', 'vdi_export_cbt=true', 'cbt_full_every=3'])
+    assert bench.run()['success'] == 1
+    # the next backup has two changed blocks
+    XenAPI.changed_blocks = make_bitmap(64, [1, 33])
+    assert bench.run()['success'] == 1
+    (full_dir, delta_dir) = bench.backup_dirs('vm0')
+    full_raw = os.path.join(full_dir, 'DISK-xvda', 'vm0.raw')
+    delta = os.path.join(delta_dir, 'DISK-xvda', 'vm0.raw.delta')
+    assert VmBackup.cbt_read_cfg(os.path.join(delta_dir, 'DISK-xvda'))['base'] == os.path.basename(full_dir)
+    assert os.path.getsize(delta) == 2 * BLOCK
+
+    restored = str(tmpdir.join('restored.raw'))
+    VmBackup.cbt_restore(os.path.join(delta_dir, 'DISK-xvda'), restored)
+    assert open(restored, 'rb').read() == open(full_raw, 'rb').read()
+
+def test_cbt_gzipped_base(bench, tmpdir):
+    # a base gzipped by the nfs server side compression of an older version
+    bench.make_pool(vms=1, disks=1, disk_mb=4)
+    bench.load_config(['vdi-export=vm0', 'export_method=http', 'vdi_export_cbt=true'])
+    assert bench.run()['success'] == 1
+    (full_dir,) = bench.backup_dirs('vm0')
+    full_raw = os.path.join(full_dir, 'DISK-xvda', 'vm0.raw')
+    full_data = open(full_raw, 'rb').read()
+    os.system('gzip "%s"' % full_raw)
+    os.rename(os.path.join(full_dir, 'success'), os.path.join(full_dir, 'success_compress'))
+
+    XenAPI.changed_blocks = make_bitmap(64, [5])
+    assert bench.run()['success'] == 1
+    (full_dir, delta_dir) = bench.backup_dirs('vm0')
+    assert os.path.getsize(os.path.join(delta_dir, 'DISK-xvda', 'vm0.raw.delta')) == BLOCK
+    restored = str(tmpdir.join('restored.raw'))
+    VmBackup.cbt_restore(os.path.join(delta_dir, 'DISK-xvda'), restored)
+    assert open(restored, 'rb').read() == full_data
+
+    # retention merges the gzipped full into the delta
+    VmBackup.cbt_merge_forward(full_dir)
+    shutil.rmtree(full_dir)
+    assert VmBackup.cbt_read_cfg(os.path.join(delta_dir, 'DISK-xvda'))['type'] == 'full'
+    assert open(os.path.join(delta_dir, 'DISK-xvda', 'vm0.raw'), 'rb').read() == full_data
+
+def test_cbt_large_disk_not_left_to_nfs_compression(bench):
+    # no success_compress for a vdi_export_cbt backup over 60G, see final_cleanup
+    bench.make_pool(vms=1, disks=1, disk_mb=1)
+    bench.load_config(['vdi-export=vm0', 'export_method=http', 'vdi_export_cbt=true'])
+    vm_dir = os.path.join(bench.backup_dir, 'vm0')
+    for (dir, disk_cfg) in [('backup-cbt', 'cbt.cfg'), ('backup-plain', 'vdi.cfg')]:
+        os.makedirs(os.path.join(vm_dir, dir, 'DISK-xvda'))
+        VmBackup.write_disk_cfg(os.path.join(vm_dir, dir, 'DISK-xvda'), disk_cfg, {'type': 'full'})
+        VmBackup.final_cleanup(os.path.join(vm_dir, dir, 'DISK-xvda', 'vm0.raw'), 61, os.path.join(vm_dir, dir), vm_dir, 4)
+    assert os.path.exists(os.path.join(vm_dir, 'backup-cbt', 'success'))
+    assert os.path.exists(os.path.join(vm_dir, 'backup-plain', 'success_compress'))
+
+def test_changed_extents():
+    # runs of changed blocks, split at CBT_NBD_READ_SIZE, blocks beyond the bitmap are changed
+    run = VmBackup.CBT_NBD_READ_SIZE / BLOCK
+    bitmap = make_bitmap(8 + run + 1, [0, 1, 5] + range(8, 8 + run + 1))
+    size = (8 + run + 3) * BLOCK - 100
+    assert VmBackup.cbt_changed_extents(bitmap, size) == [(0, 2 * BLOCK), (5 * BLOCK, BLOCK),
+        (8 * BLOCK, run * BLOCK), ((8 + run) * BLOCK, BLOCK)] + \
+        [((x * BLOCK), min(BLOCK, size - x * BLOCK)) for x in range(len(bitmap) * 8, 8 + run + 3)]
+
+def get_nbd_reads(bench):
+    # [(offset, length)] of the reads of the fake nbd server
+    path = os.path.join(bench.bench_dir, 'nbd_reads.txt')
+    if not os.path.exists(path):
+        return []
+    return [(int(x.split()[1]), int(x.split()[2])) for x in open(path)]
+
+@pytest.mark.parametrize('tls', [False, True])
+def test_cbt_delta_reads_only_changed_blocks_over_nbd(bench, tmpdir, tls):
+    if tls and not distutils.spawn.find_executable('openssl'):
+        pytest.skip('the test cert needs openssl')
+    bench.make_pool(vms=1, disks=1, disk_mb=4, nbd=not tls, nbd_tls=tls)
+    bench.load_config(['vdi-export=vm0', 'export_method=http', 'vdi_export_cbt=true'])
+    assert bench.run()['success'] == 1
+    XenAPI.changed_blocks = make_bitmap(64, [1, 33, 34, 63])
+    assert bench.run()['success'] == 1
+    assert get_nbd_reads(bench) == [(BLOCK, BLOCK), (33 * BLOCK, 2 * BLOCK), (63 * BLOCK, BLOCK)]
+    (full_dir, delta_dir) = bench.backup_dirs('vm0')
+    assert os.path.getsize(os.path.join(delta_dir, 'DISK-xvda', 'vm0.raw.delta')) == 4 * BLOCK
+    restored = str(tmpdir.join('restored.raw'))
+    VmBackup.cbt_restore(os.path.join(delta_dir, 'DISK-xvda'), restored)
+    assert open(restored, 'rb').read() == open(os.path.join(full_dir, 'DISK-xvda', 'vm0.raw'), 'rb').read()
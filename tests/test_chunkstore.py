@@ -0,0 +1,35 @@
+#
+# backup_store=chunks: the ChunkStoreWriter cuts and the ManifestReader reads back
+#
+
+import os, hashlib
+import VmBackup
+
+def make_data():
+    # incompressible data around a run of zeros longer than CHUNK_MAX_SIZE
+    data = ''.join([hashlib.sha256(str(i)).digest() for i in range(100000)])
+    return data + '\0' * (VmBackup.CHUNK_MAX_SIZE + 12345) + data[:1000001]
+
+def write_chunks(tmpdir, name, data, write_size):
+    manifest = str(tmpdir.join(name))
+    out = VmBackup.ChunkStoreWriter(manifest, str(tmpdir.join(VmBackup.CHUNKSTORE_DIR)))
+    for pos in range(0, len(data), write_size):
+        out.write(data[pos:pos + write_size])
+    out.close()
+    return manifest
+
+def test_chunks_do_not_depend_on_the_write_size(tmpdir):
+    data = make_data()
+    chunks = VmBackup.read_manifest(write_chunks(tmpdir, 'whole.manifest', data, len(data)))
+    assert max([x[1] for x in chunks]) == VmBackup.CHUNK_MAX_SIZE
+    for write_size in [1000, 65536, 3 * 1024 * 1024]:
+        manifest = write_chunks(tmpdir, '%s.manifest' % write_size, data, write_size)
+        assert VmBackup.read_manifest(manifest) == chunks
+        (reader, length) = VmBackup.open_backup_reader(manifest)
+        assert length == len(data)
+        read_back = []
+        block = reader.read(100000)
+        while block:
+            read_back.append(block)
+            block = reader.read(100000)
+        assert ''.join(read_back) == data
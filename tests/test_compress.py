@@ -0,0 +1,56 @@
+#
+# compress_codec: CompressWriter compresses the export stream in blocks on the compress_pool
+#
+
+import os, zlib
+import pytest
+import VmBackup
+
+class Recorder:
+
+    def __init__(self):
+        self.data = []
+        self.closed = False
+
+    def write(self, data):
+        self.data.append(data)
+
+    def close(self):
+        self.closed = True
+
+def gunzip(data):
+    # note - one gzip member per block
+    result = []
+    while data:
+        d = zlib.decompressobj(31)
+        result.append(d.decompress(data))
+        data = d.unused_data
+    return ''.join(result)
+
+@pytest.fixture
+def compress_pool(monkeypatch):
+    monkeypatch.setitem(VmBackup.config, 'compress_procs', '2')
+    monkeypatch.setitem(VmBackup.config, 'compress_codec', 'gzip')
+    monkeypatch.setitem(VmBackup.config, 'compress_level', '1')
+    VmBackup.start_compress_pool()
+    yield
+    VmBackup.stop_compress_pool()
+
+def test_round_trip(compress_pool):
+    block_size = VmBackup.COMPRESS_BLOCK_SIZE
+    # each block differs, so blocks written out of order do not round-trip
+    data = ''.join([os.urandom(4096) + chr(ix) * (block_size / 2) for ix in range(11)])
+    data = data[:int(5.5 * block_size)]
+    out = Recorder()
+    writer = VmBackup.CompressWriter(out, 'gzip', 1)
+    # odd writes, one of them over two blocks
+    pos = 0
+    for size in [1, 4093, 3 * block_size, 65536]:
+        writer.write(data[pos:pos + size])
+        pos += size
+    writer.write(data[pos:])
+    writer.close()
+    assert out.closed
+    assert len(out.data) == 6
+    assert writer.bytes_out == sum([len(x) for x in out.data]) < len(data)
+    assert gunzip(''.join(out.data)) == data
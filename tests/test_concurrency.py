@@ -0,0 +1,77 @@
+#
+# adaptive_parallel: ConcurrencyController.adjust - AIMD on the number of exports
+#
+
+import pytest
+import VmBackup
+
+MB = 1024 * 1024
+
+class Scheduler:
+    # records the limits the controller sets
+
+    def __init__(self):
+        self.limits = []
+
+    def set_max_running(self, max_running):
+        self.limits.append(max_running)
+
+@pytest.fixture
+def controller(monkeypatch, tmpdir):
+    monkeypatch.setitem(VmBackup.config, 'backup_dir', str(tmpdir))
+    monkeypatch.setattr(VmBackup.multiprocessing, 'cpu_count', lambda: 4)
+    return VmBackup.ConcurrencyController(Scheduler(), 4)
+
+def settle(controller, rate):
+    # the sample after an increase only lets the added export get going
+    controller.adjust(rate, controller.limit, 10, 0.0)
+
+def test_clean_windows_add_one_export_each(controller):
+    controller.adjust(10 * MB, 1, 10, 0.0)
+    assert controller.limit == 2
+    settle(controller, 10 * MB)
+    assert controller.limit == 2
+    controller.adjust(20 * MB, 2, 10, 0.0)
+    assert controller.limit == 3
+    assert controller.scheduler.limits == [2, 2, 3]
+
+def test_window_without_gain_goes_back_one(controller):
+    controller.adjust(10 * MB, 1, 10, 0.0)
+    settle(controller, 10 * MB)
+    controller.adjust(10.2 * MB, 2, 10, 0.0)
+    assert controller.limit == 1
+    # and holds before probing again
+    for i in range(VmBackup.ADAPTIVE_HOLD_SAMPLES):
+        controller.adjust(50 * MB, 1, 10, 0.0)
+        assert controller.limit == 1
+    controller.adjust(50 * MB, 1, 10, 0.0)
+    assert controller.limit == 2
+
+@pytest.mark.parametrize('latency,load', [(200, 0.0), (10, 8.0)])
+def test_slow_storage_or_dom0_halves_the_exports(controller, latency, load):
+    controller.adjust(10 * MB, 1, 10, 0.0)
+    controller.limit = 4
+    controller.adjust(40 * MB, 4, latency, load)
+    assert controller.limit == 2
+    assert controller.last_rate is None and controller.hold == VmBackup.ADAPTIVE_HOLD_SAMPLES
+    assert controller.scheduler.limits[-1] == 2
+
+def test_limit_stays_within_1_and_max_parallel(controller):
+    controller.adjust(10 * MB, 1, 10, 0.0)
+    for i in range(3):
+        controller.adjust(10 * MB, controller.limit, 200, 0.0)
+    assert controller.scheduler.limits == [2, 1, 1, 1]
+    controller.hold = 0
+    rate = 10 * MB
+    for i in range(20):
+        rate *= 2
+        controller.adjust(rate, controller.limit, None, 0.0)
+    assert controller.limit == 4
+    assert max(controller.scheduler.limits) == 4
+
+def test_free_slots_leave_the_limit(controller):
+    controller.adjust(10 * MB, 1, 10, 0.0)
+    settle(controller, 10 * MB)
+    controller.adjust(5 * MB, 1, 10, 0.0)
+    assert controller.limit == 2
+    assert controller.scheduler.limits == [2, 2]
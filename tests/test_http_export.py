@@ -0,0 +1,93 @@
+#
+# export_method=http: the exports streamed from the fake xapi http server (xapi_http.py)
+#
+
+import os, hashlib, cStringIO, threading, BaseHTTPServer
+import xapi_http
+import VmBackup
+
+DISK_MB = 6
+
+def file_digest(path):
+    return hashlib.sha256(open(path, 'rb').read()).hexdigest()
+
+def export_digest(write, size):
+    # sha256 of what the fake xapi_http export of size bytes streams
+    out = cStringIO.StringIO()
+    write(out, size, 0)
+    return hashlib.sha256(out.getvalue()).hexdigest()
+
+def test_export_is_byte_identical(bench):
+    bench.make_pool(vms=1, disks=1, disk_mb=DISK_MB)
+    bench.load_config(['vm-export=vm0', 'export_method=http'])
+    assert bench.run()['success'] == 1
+    (backup_dir,) = bench.backup_dirs('vm0')
+    xva = os.path.join(backup_dir, 'vm0.xva')
+    assert os.path.getsize(xva) == xapi_http.xva_length(DISK_MB * 1024 * 1024)
+    assert file_digest(xva) == export_digest(xapi_http.write_xva, DISK_MB * 1024 * 1024)
+
+def test_http_500_is_an_error(bench):
+    bench.make_pool(vms=1, disks=1, disk_mb=DISK_MB, failure_rate=1)
+    bench.load_config(['vdi-export=vm0', 'export_method=http'])
+    assert bench.run()['error'] == 1
+    (backup_dir,) = bench.backup_dirs('vm0')
+    assert not VmBackup.is_backup_dir_success(backup_dir)
+
+class ShortReadHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # announces more data than it sends, like a connection dropped by xapi
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '1000000')
+        self.end_headers()
+        self.wfile.write('x' * 1000)
+
+    def log_message(self, format, *args):
+        pass
+
+def test_short_read_is_an_error(bench, tmpdir, monkeypatch):
+    bench.make_pool(vms=1, disks=1, disk_mb=DISK_MB)
+    bench.load_config(['vdi-export=vm0', 'export_method=http'])
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), ShortReadHandler)
+    thread = threading.Thread(target=server.handle_request)
+    thread.setDaemon(True)
+    thread.start()
+    monkeypatch.setattr(VmBackup.session, 'xapi_url', 'http://127.0.0.1:%s/' % server.server_address[1])
+    try:
+        assert not VmBackup.http_export('/export_raw_vdi', {'vdi': 'any'}, str(tmpdir.join('vm0.raw')))
+    finally:
+        thread.join(10)
+        server.server_close()
+
+def test_resume_after_a_broken_export(bench, monkeypatch):
+    # the first export breaks after 3.5M, the next run continues from the 1M checkpoints
+    bench.make_pool(vms=1, disks=1, disk_mb=DISK_MB)
+    bench.load_config(['vdi-export=vm0', 'export_method=http', 'resume_window=1'])
+    monkeypatch.setattr(VmBackup, 'RESUME_SEGMENT_SIZE', 1024 * 1024)
+    stream_to_file = VmBackup.stream_to_file
+
+    class BreakingWriter:
+        def __init__(self, out):
+            self.out = out
+            self.written = 0
+
+        def write(self, data):
+            if self.written + len(data) > 3584 * 1024:
+                raise IOError('connection reset')
+            self.out.write(data)
+            self.written += len(data)
+
+        def close(self):
+            self.out.close()
+
+    monkeypatch.setattr(VmBackup, 'stream_to_file', lambda src, out, size: stream_to_file(src, BreakingWriter(out), size))
+    assert bench.run()['error'] == 1
+    (failed_dir,) = bench.backup_dirs('vm0')
+    raw = os.path.join(failed_dir, 'DISK-xvda', 'vm0.raw')
+    assert len(VmBackup.read_checkpoint(raw + '.checkpoint')) == 3
+
+    monkeypatch.setattr(VmBackup, 'stream_to_file', stream_to_file)
+    assert bench.run()['success'] == 1
+    assert bench.backup_dirs('vm0') == [failed_dir]
+    assert file_digest(raw) == export_digest(xapi_http.write_raw, DISK_MB * 1024 * 1024)
+    assert 'resume: 3 of 3 checkpoints verified' in open(os.path.join(bench.bench_dir, 'VmBackup.log')).read()
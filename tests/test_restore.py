@@ -0,0 +1,132 @@
+#
+# restore=: import the backups into the fake import endpoint (xapi_http.py)
+#
+
+import os, hashlib
+import pytest
+import XenAPI
+import xapi_http
+import VmBackup
+
+DISK_MB = 2
+
+class HashOut:
+    def __init__(self):
+        self.hash = hashlib.sha256()
+
+    def write(self, data):
+        self.hash.update(data)
+
+def export_digest(write, size):
+    # sha256 of what the fake xapi_http export of size bytes streams
+    out = HashOut()
+    write(out, size, 0)
+    return out.hash.hexdigest()
+
+def get_imports(bench):
+    # [(path, bytes, sha256)] of the imports of the fake xapi http server
+    imports = []
+    for line in open(os.path.join(bench.bench_dir, 'imports.txt')):
+        (task, path, size, digest) = line.split()
+        imports.append((path, int(size), digest))
+    return imports
+
+@pytest.mark.parametrize('config', [[], ['export_method=http', 'compress_codec=gzip'],
+    ['export_method=http', 'backup_store=chunks']])
+def test_restore_vm_export_is_byte_identical(bench, config):
+    bench.make_pool(vms=2, disks=2, disk_mb=DISK_MB)
+    bench.load_config(['vm-export=vm.*'] + config)
+    assert bench.run()['success'] == 2
+    assert VmBackup.restore_main(bench.backup_dir, None, None, 2, False) == 0
+    expected = export_digest(xapi_http.write_xva, 2 * DISK_MB * 1024 * 1024)
+    assert sorted(get_imports(bench)) == [('/import', xapi_http.xva_length(2 * DISK_MB * 1024 * 1024), expected)] * 2
+
+@pytest.mark.skipif(not os.path.exists('/usr/bin/xmllint'), reason='vm-metadata.xml needs /usr/bin/xmllint')
+@pytest.mark.parametrize('config', [[], ['export_method=http', 'compress_codec=gzip']])
+def test_restore_vdi_export_reattaches_disks_and_vifs(bench, config):
+    bench.make_pool(vms=1, disks=2, disk_mb=DISK_MB)
+    bench.load_config(['vdi-export=vm0'] + config)
+    assert bench.run()['success'] == 1
+    vms_before = set(XenAPI.pool['VM'].keys())
+    assert VmBackup.restore_main(bench.backup_dir, 'vm0', 'bench-sr1', 1, False) == 0
+    expected = export_digest(xapi_http.write_raw, DISK_MB * 1024 * 1024)
+    imports = get_imports(bench)
+    assert [x for x in imports if x[0] == '/import_raw_vdi'] == [('/import_raw_vdi', DISK_MB * 1024 * 1024, expected)] * 2
+    assert len([x for x in imports if x[0] == '/import_metadata']) == 1
+
+    (vm_ref,) = set(XenAPI.pool['VM'].keys()) - vms_before
+    vm = XenAPI.pool['VM'][vm_ref]
+    vbds = sorted([XenAPI.pool['VBD'][x] for x in vm['VBDs']], key=lambda x: x['userdevice'])
+    assert [(x['userdevice'], x['bootable']) for x in vbds] == [('0', True), ('1', False)]
+    for vbd in vbds:
+        assert XenAPI.pool['VDI'][vbd['VDI']]['SR'] == 'OpaqueRef:sr1'
+    (vif,) = [XenAPI.pool['VIF'][x] for x in vm['VIFs']]
+    assert (vif['device'], vif['network'], vif['MAC']) == ('0', 'OpaqueRef:network0', '02:00:00:00:00:00')
+
+def test_restore_failed_disk_leaves_no_vdis(bench):
+    bench.make_pool(vms=1, disks=2, disk_mb=DISK_MB)
+    bench.load_config(['vdi-export=vm0'])
+    assert bench.run()['success'] == 1
+    (backup_dir,) = bench.backup_dirs('vm0')
+    # a malformed vdi.cfg of the second disk
+    vdi_cfg = VmBackup.read_disk_cfg(os.path.join(backup_dir, 'DISK-xvdb'), 'vdi.cfg')
+    del vdi_cfg['virtual_size']
+    VmBackup.write_disk_cfg(os.path.join(backup_dir, 'DISK-xvdb'), 'vdi.cfg', vdi_cfg)
+    vdis_before = set(XenAPI.pool['VDI'].keys())
+    assert VmBackup.restore_main(bench.backup_dir, None, None, 2, False) == 1
+    assert set(XenAPI.pool['VDI'].keys()) == vdis_before
+    # the first disk was imported before
+    assert [x[0] for x in get_imports(bench)] == ['/import_raw_vdi']
+
+def test_restore_unknown_sr(bench):
+    bench.make_pool(vms=2, disks=1, disk_mb=DISK_MB)
+    bench.load_config(['vm-export=vm.*'])
+    assert bench.run()['success'] == 2
+    assert VmBackup.restore_main(bench.backup_dir, None, 'no-such-sr', 2, False) == 2
+    assert get_imports(bench) == []
+
+def test_restore_finds_backup_file_of_older_layout(bench):
+    # an older version exported only xvda, into <backup dir>/<vm-name>.raw
+    bench.make_pool(vms=1, disks=2, disk_mb=DISK_MB)
+    bench.load_config(['vdi-export=vm0'])
+    assert bench.run()['success'] == 1
+    (backup_dir,) = bench.backup_dirs('vm0')
+    assert VmBackup.get_disk_backup_file(backup_dir, 'DISK-xvdb') == os.path.join(backup_dir, 'DISK-xvdb', 'vm0.raw')
+    os.rename(os.path.join(backup_dir, 'DISK-xvda', 'vm0.raw'), os.path.join(backup_dir, 'vm0.raw'))
+    os.remove(os.path.join(backup_dir, 'DISK-xvdb', 'vm0.raw'))
+    assert VmBackup.get_disk_backup_file(backup_dir, 'DISK-xvda') == os.path.join(backup_dir, 'vm0.raw')
+    assert VmBackup.get_disk_backup_file(backup_dir, 'DISK-xvdb') is None
+
+def test_restore_without_metadata_leaves_no_vdis(bench, monkeypatch):
+    bench.make_pool(vms=1, disks=2, disk_mb=DISK_MB)
+    bench.load_config(['vdi-export=vm0'])
+    assert bench.run()['success'] == 1
+    (backup_dir,) = bench.backup_dirs('vm0')
+    meta_path = os.path.join(backup_dir, 'vm-metadata.xml')
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    vdis_before = set(XenAPI.pool['VDI'].keys())
+    assert VmBackup.restore_main(bench.backup_dir, None, None, 1, False) == 1
+    assert set(XenAPI.pool['VDI'].keys()) == vdis_before
+
+    # /import_metadata fails
+    open(meta_path, 'w').write('<value></value>')
+    http_import = VmBackup.http_import
+    def metadata_fails(url_path, query, src, length=None):
+        if url_path == '/import_metadata':
+            return None
+        return http_import(url_path, query, src, length)
+    monkeypatch.setattr(VmBackup, 'http_import', metadata_fails)
+    assert VmBackup.restore_main(bench.backup_dir, None, None, 1, False) == 1
+    assert set(XenAPI.pool['VDI'].keys()) == vdis_before
+    assert [x[0] for x in get_imports(bench)] == ['/import_raw_vdi'] * 4
+
+def test_restores_of_failed_logins_are_errors(bench, monkeypatch):
+    bench.make_pool(vms=2, disks=1, disk_mb=DISK_MB)
+    bench.load_config(['vm-export=vm.*'])
+    assert bench.run()['success'] == 2
+    def login_fails():
+        raise IOError('connection refused')
+    monkeypatch.setattr(VmBackup, 'xapi_login', login_fails)
+    assert VmBackup.restore_main(bench.backup_dir, None, None, 2, False) == 2
+    assert get_imports(bench) == []
@@ -0,0 +1,50 @@
+#
+# run_report: the per phase timings and status of each vm backup
+#
+
+import os, json
+import XenAPI
+import VmBackup
+
+def read_report(bench):
+    # {vm_name: {phase: status}} of the json run_report
+    report = {}
+    for line in open(os.path.join(bench.bench_dir, 'status-report.json')):
+        job = json.loads(line)
+        report[job['vm_name']] = dict([(x['phase'], x['status']) for x in job['phases']])
+    return report
+
+def test_phases_of_a_success(bench):
+    bench.make_pool(vms=1, disks=1, disk_mb=1)
+    bench.load_config(['vm-export=vm0', 'run_report=json'])
+    assert bench.run()['success'] == 1
+    phases = read_report(bench)['vm0']
+    assert set(phases.values()) == set(['success'])
+    assert sorted(phases.keys()) == sorted(VmBackup.RUN_REPORT_PHASES)
+
+def test_failed_snapshot_is_an_error_phase(bench, monkeypatch):
+    bench.make_pool(vms=1, disks=1, disk_mb=1)
+    bench.load_config(['vm-export=vm0', 'run_report=json'])
+    call = XenAPI.call
+    def snapshot_fails(cls, name, args):
+        if cls == 'VM' and name == 'snapshot':
+            raise XenAPI.Failure(['SR_FULL'])
+        return call(cls, name, args)
+    monkeypatch.setattr(XenAPI, 'call', snapshot_fails)
+    assert bench.run()['error'] == 1
+    phases = read_report(bench)['vm0']
+    assert (phases['lookup'], phases['metadata'], phases['snapshot'], phases['export']) == ('success', 'success', 'error', '')
+
+def test_exception_in_export_is_an_error_phase(bench, monkeypatch):
+    # one of the two disks raises, the export phase of the vm is an error
+    bench.make_pool(vms=1, disks=2, disk_mb=1)
+    bench.load_config(['vdi-export=vm0', 'export_method=http', 'run_report=json'])
+    http_export = VmBackup.http_export
+    def export_raises(path, query, *args, **kwargs):
+        if VmBackup.thread_data.vm_name.endswith(':xvdb'):
+            raise IOError('connection reset')
+        return http_export(path, query, *args, **kwargs)
+    monkeypatch.setattr(VmBackup, 'http_export', export_raises)
+    assert bench.run()['error'] == 1
+    phases = read_report(bench)['vm0']
+    assert (phases['snapshot'], phases['export'], phases['snapshot_removal']) == ('success', 'error', 'success')
@@ -0,0 +1,26 @@
+#
+# selectors: exclude/vm-export/vdi-export lines select the pool vms in config file order
+#
+
+import VmBackup
+
+def test_lines_select_in_config_order(bench):
+    bench.make_pool(vms=6, disks=1)
+    bench.load_config(['exclude=vm1', 'vm-export=vm[0-2]', 'vdi-export=vm3:3', 'vm-export=vm[345]:2',
+        'vdi-export=vm5:disks=xvda', 'exclude=vm4', 'exclude=vm1'])
+    # note - RemoveDup does not keep the order
+    # exclude=vm4 comes after vm-export=vm[345], the exclude still wins
+    assert sorted(VmBackup.config['exclude']) == ['vm1', 'vm4']
+    assert sorted(VmBackup.config['vdi-export']) == ['vm3:3', 'vm5']
+    assert sorted(VmBackup.config['vm-export']) == ['vm0', 'vm2']
+    assert VmBackup.vdi_export_disks == {'vm5': ['xvda']}
+    assert sorted(VmBackup.all_vms) == ['vm0', 'vm2', 'vm3', 'vm5']
+    # exclude=vm1 again matches no vm that is left
+    assert VmBackup.warning_match and not VmBackup.error_regex
+
+def test_no_match_and_invalid_regex(bench):
+    bench.make_pool(vms=2, disks=1)
+    bench.load_config(['vm-export=vm0', 'vm-export=[bad', 'vdi-export=nomatch.*'])
+    assert VmBackup.config['vm-export'] == ['vm0']
+    assert VmBackup.config['vdi-export'] == []
+    assert VmBackup.warning_match and VmBackup.error_regex
@@ -0,0 +1,57 @@
+#
+# shard_by_host: workers in separate processes compete for the same ShardLeases dir
+#
+
+import os, time, multiprocessing
+import VmBackup
+
+WORKERS = 6
+VMS = ['vm%s' % ix for ix in range(40)]
+
+def compete(lease_dir, owner, start, results):
+    # lease as many of VMS as possible, report the ones this worker got
+    leases = VmBackup.ShardLeases(lease_dir, owner)
+    start.wait()
+    results.put((owner, [vm for vm in VMS if leases.acquire(vm) is None]))
+
+def run_workers(lease_dir):
+    # {vm: [owners]} of the leases the WORKERS processes acquired
+    start = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=compete, args=(lease_dir, 'host%s' % ix, start, results))
+        for ix in range(WORKERS)]
+    for worker in workers:
+        worker.start()
+    start.set()
+    owners = dict([(vm, []) for vm in VMS])
+    for worker in workers:
+        (owner, vms) = results.get(timeout=60)
+        for vm in vms:
+            owners[vm].append(owner)
+    for worker in workers:
+        worker.join(60)
+        assert worker.exitcode == 0
+    return owners
+
+def assert_one_owner(lease_dir, owners):
+    for vm in VMS:
+        assert len(owners[vm]) == 1, '%s: %s' % (vm, owners[vm])
+        assert open(os.path.join(lease_dir, vm + '.lease')).read().strip() == owners[vm][0]
+
+def test_one_owner_per_vm(tmpdir):
+    lease_dir = str(tmpdir.join(VmBackup.SHARD_LEASE_DIR))
+    assert_one_owner(lease_dir, run_workers(lease_dir))
+
+def test_one_owner_takes_over_a_stale_lease(tmpdir):
+    # the leases of a dead worker, last renewed before SHARD_LEASE_STALE_SECS
+    lease_dir = str(tmpdir.join(VmBackup.SHARD_LEASE_DIR))
+    os.makedirs(lease_dir)
+    stale_time = time.time() - VmBackup.SHARD_LEASE_STALE_SECS - 60
+    for vm in VMS:
+        open(os.path.join(lease_dir, vm + '.lease'), 'w').write('dead-host\n')
+        os.utime(os.path.join(lease_dir, vm + '.lease'), (stale_time, stale_time))
+    owners = run_workers(lease_dir)
+    assert_one_owner(lease_dir, owners)
+    assert 'dead-host' not in sum(owners.values(), [])
+    # no .stale file is left behind
+    assert sorted(os.listdir(lease_dir)) == sorted([vm + '.lease' for vm in VMS])
@@ -0,0 +1,43 @@
+#
+# sparse raw vdi-export: SparseWriter seeks over the all-zero blocks
+#
+
+import os
+import pytest
+import VmBackup
+
+BLOCK = VmBackup.SPARSE_BLOCK_SIZE
+
+def write_sparse(path, pieces, write_size=5000):
+    writer = VmBackup.SparseWriter(open(path, 'wb'))
+    data = ''.join(pieces)
+    # note - odd writes, so blocks span writes
+    for pos in range(0, len(data), write_size):
+        writer.write(data[pos:pos + write_size])
+    writer.close()
+    return (writer, data)
+
+def test_zero_blocks_are_holes(tmpdir):
+    path = str(tmpdir.join('disk.raw'))
+    zeros = '\0' * (16 * BLOCK)
+    (writer, data) = write_sparse(path, ['\1' * BLOCK, zeros, '\0' * 100 + '\2' * (BLOCK - 100), zeros, '\3' * 10])
+    assert open(path, 'rb').read() == data
+    assert os.path.getsize(path) == len(data)
+    assert writer.allocated == 2 * BLOCK + 10
+    # note - the file system may allocate in larger blocks, the 32 zero blocks stay holes
+    assert os.stat(path).st_blocks * 512 <= len(data) - 16 * BLOCK
+
+@pytest.mark.parametrize('tail', [BLOCK, 100])
+def test_file_ending_in_a_hole_has_its_size(tmpdir, tail):
+    path = str(tmpdir.join('disk.raw'))
+    (writer, data) = write_sparse(path, ['\1' * BLOCK, '\0' * (8 * BLOCK + tail)])
+    assert open(path, 'rb').read() == data
+    assert os.path.getsize(path) == len(data)
+    assert writer.allocated == BLOCK
+
+def test_all_zero_disk(tmpdir):
+    path = str(tmpdir.join('disk.raw'))
+    (writer, data) = write_sparse(path, ['\0' * (4 * BLOCK + 1)])
+    assert os.path.getsize(path) == len(data)
+    assert os.stat(path).st_blocks == 0
+    assert writer.allocated == 0
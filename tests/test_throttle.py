@@ -0,0 +1,17 @@
+#
+# throttle_mbps/throttle_mbps_job: the export data rate caps, also with export_method=xe
+#
+
+import time
+import pytest
+
+@pytest.mark.parametrize('config', [['export_method=http', 'throttle_mbps=2'], ['throttle_mbps=2'],
+    ['throttle_mbps_job=2'], ['throttle_window=00:00-12:00:2', 'throttle_window=12:00-00:00:2']])
+def test_throttled_export(bench, config):
+    # 4M at 2 MB/s, the token bucket starts empty
+    bench.make_pool(vms=1, disks=1, disk_mb=4)
+    bench.load_config(['vdi-export=vm0'] + config)
+    begin = time.time()
+    assert bench.run()['success'] == 1
+    # note - run() sleeps 1.1s after the backup
+    assert time.time() - begin - 1.1 >= 1.5
@@ -0,0 +1,38 @@
+#
+# max_parallel: the run_backup_jobs workers, each with its own xapi session
+#
+
+import os, threading
+import VmBackup
+
+def failing_logins(monkeypatch, failures):
+    # the first failures xapi_login calls fail, like a restarting pool master
+    xapi_login = VmBackup.xapi_login
+    lock = threading.Lock()
+    calls = []
+    def login():
+        lock.acquire()
+        try:
+            calls.append(1)
+            fail = len(calls) <= failures
+        finally:
+            lock.release()
+        if fail:
+            raise IOError('connection refused')
+        return xapi_login()
+    monkeypatch.setattr(VmBackup, 'xapi_login', login)
+
+def test_failed_login_leaves_the_jobs_to_the_other_workers(bench, monkeypatch):
+    bench.make_pool(vms=3, disks=1, disk_mb=1)
+    bench.load_config(['vm-export=vm.*', 'max_parallel=2'])
+    failing_logins(monkeypatch, 1)
+    status = bench.run()
+    assert (status['success'], status['error']) == (3, 0)
+
+def test_jobs_of_failed_logins_are_errors(bench, monkeypatch):
+    bench.make_pool(vms=3, disks=1, disk_mb=1)
+    bench.load_config(['vm-export=vm.*', 'max_parallel=2'])
+    failing_logins(monkeypatch, 2)
+    status = bench.run()
+    assert (status['success'], status['error']) == (0, 3)
+    assert not os.path.exists(os.path.join(bench.backup_dir, 'vm0'))
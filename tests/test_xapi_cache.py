@@ -0,0 +1,52 @@
+#
+# xapi_events: the XapiCache follows the scripted event.from batches of the fake XenAPI
+#
+
+import copy, time
+import XenAPI
+import VmBackup
+
+def wait_applied(cache, events_applied):
+    for attempt in range(100):
+        if cache.events_applied >= events_applied:
+            return
+        time.sleep(0.05)
+    raise Exception('events not applied: %s' % cache.events_applied)
+
+def test_events_update_the_cache(bench):
+    bench.make_pool(vms=2, disks=1)
+    cache = VmBackup.xapi_cache
+    assert cache.get_by_name_label('VM', 'vm1') == ['OpaqueRef:vm1']
+    vdi = copy.deepcopy(XenAPI.pool['VDI']['OpaqueRef:vdi0-0'])
+    vdi['name_label'] = 'renamed'
+    vm = copy.deepcopy(XenAPI.pool['VM']['OpaqueRef:vm0'])
+    vm.update({'uuid': XenAPI.new_uuid(), 'name_label': 'vm-new'})
+    XenAPI.event_batches.append([{'class': 'vm', 'operation': 'del', 'ref': 'OpaqueRef:vm1'},
+        {'class': 'vdi', 'operation': 'mod', 'ref': 'OpaqueRef:vdi0-0', 'snapshot': vdi}])
+    XenAPI.event_batches.append([{'class': 'vm', 'operation': 'add', 'ref': 'OpaqueRef:vm-new', 'snapshot': vm}])
+    # note - the rpc would find a deleted vm again, this must come from the cache
+    rpc_calls = XenAPI.rpc_calls['VM.get_record'] + XenAPI.rpc_calls['VDI.get_record']
+    cache.start_watch()
+    try:
+        wait_applied(cache, 3)
+    finally:
+        cache.stop_watch()
+    assert cache.get_by_name_label('VM', 'vm1') == []
+    assert 'OpaqueRef:vm1' not in cache.get_all_records('VM')
+    assert cache.get_record('VDI', 'OpaqueRef:vdi0-0')['name_label'] == 'renamed'
+    assert cache.get_by_name_label('VDI', 'vm0 xvda') == []
+    assert cache.get_by_name_label('VDI', 'renamed') == ['OpaqueRef:vdi0-0']
+    assert cache.get_by_uuid('VM', vm['uuid']) == 'OpaqueRef:vm-new'
+    assert XenAPI.rpc_calls['VM.get_record'] + XenAPI.rpc_calls['VDI.get_record'] == rpc_calls
+
+def test_get_record_of_a_ref_removed_meanwhile(bench):
+    # the xapi_events watcher removes the ref right after get_record added it
+    bench.make_pool(vms=1, disks=1)
+    cache = VmBackup.xapi_cache
+    cache.apply_events([{'class': 'vdi', 'operation': 'del', 'ref': 'OpaqueRef:vdi0-0'}])
+    add = cache.add
+    def add_then_del(cls, ref, record):
+        add(cls, ref, record)
+        cache.remove(cls, ref)
+    cache.add = add_then_del
+    assert cache.get_record('VDI', 'OpaqueRef:vdi0-0')['uuid'] == XenAPI.pool['VDI']['OpaqueRef:vdi0-0']['uuid']
@@ -0,0 +1,83 @@
+#
+# xva_validate: XvaValidator checks the xva stream of a vm-export on the way
+#
+
+import StringIO
+import pytest
+import VmBackup
+import xapi_http
+
+MB = 1024 * 1024
+
+def make_xva(nbytes):
+    out = StringIO.StringIO()
+    xapi_http.write_xva(out, nbytes, 0)
+    return out.getvalue()
+
+def gzip_members(data, size):
+    # as compress=true writes it, one gzip member per block
+    return ''.join([VmBackup.compress_block('gzip', 1, data[pos:pos + size]) for pos in range(0, len(data), size)])
+
+def validate(data, piece=7001):
+    # note - odd pieces, so tar headers and members span writes
+    validator = VmBackup.XvaValidator(None)
+    for pos in range(0, len(data), piece):
+        validator.write(data[pos:pos + piece])
+    validator.close()
+    return validator
+
+class Recorder:
+
+    def __init__(self):
+        self.data = []
+        self.closed = False
+
+    def write(self, data):
+        self.data.append(data)
+
+    def close(self):
+        self.closed = True
+
+def test_valid_xva():
+    data = make_xva(2 * MB + 4096)
+    out = Recorder()
+    validator = VmBackup.XvaValidator(out)
+    validator.write(data)
+    validator.close()
+    assert validator.error is None
+    assert validator.summary() == 'valid xva, 1 VDIs, 3 chunks (0 unverified)'
+    assert ''.join(out.data) == data and out.closed
+
+@pytest.mark.parametrize('cut', [1024, 512 + 100, 1 * MB])
+def test_truncated_xva(cut):
+    data = make_xva(2 * MB)
+    assert validate(data[:-cut]).error.startswith('truncated after ')
+
+def test_corrupt_chunk():
+    data = make_xva(2 * MB)
+    pos = data.index(xapi_http.BLOCK_DATA[:4096], MB)
+    data = data[:pos] + chr(ord(data[pos]) ^ 0xff) + data[pos + 1:]
+    assert validate(data).error == 'chunk Ref:1/00000001 sha1 does not match its checksum'
+
+def test_corrupt_tar_header():
+    data = make_xva(2 * MB)
+    pos = data.index('Ref:1/00000001.checksum')
+    data = data[:pos] + 'X' + data[pos + 1:]
+    assert validate(data).error == 'tar header checksum wrong after Ref:1/00000001'
+
+@pytest.mark.parametrize('size', [64 * 1024, MB])
+def test_multi_member_gzip(size):
+    data = make_xva(2 * MB + 4096)
+    validator = validate(gzip_members(data, size))
+    assert validator.error is None
+    assert validator.chunks == 3
+
+def test_multi_member_gzip_truncated():
+    data = gzip_members(make_xva(2 * MB), 64 * 1024)
+    assert validate(data[:len(data) / 2]).error.startswith('truncated after ')
+
+def test_multi_member_gzip_corrupt_chunk():
+    data = make_xva(2 * MB)
+    pos = data.index(xapi_http.BLOCK_DATA[:4096]) + 100
+    data = data[:pos] + chr(ord(data[pos]) ^ 0xff) + data[pos + 1:]
+    assert validate(gzip_members(data, 64 * 1024)).error == 'chunk Ref:1/00000000 sha1 does not match its checksum'